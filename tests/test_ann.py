@@ -0,0 +1,89 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils.ann import IVFIndex, exact_search, kmeans, assign_clusters
+
+
+def make_blobs(num_items=2000, num_blobs=16, dim=16, seed=0):
+    """ Items around random centers, and queries near random items
+    """
+    random = np.random.RandomState(seed)
+    centers = random.randn(num_blobs, dim) * 3
+    items = centers[random.randint(num_blobs, size=num_items)] + \
+        random.randn(num_items, dim)
+    queries = items[random.randint(num_items, size=100)] + \
+        random.randn(100, dim) * 0.5
+    return items.astype(np.float32), queries.astype(np.float32)
+
+
+def recall(ids, expected):
+    return np.mean([len(set(a) & set(b)) / float(len(b))
+                    for a, b in zip(ids, expected)])
+
+
+class ANNTest(unittest.TestCase):
+    def setUp(self):
+        self.items, self.queries = make_blobs()
+
+    def test_exact(self):
+        for metric in ['ip', 'l2']:
+            index = IVFIndex.build(self.items, num_lists=20, metric=metric)
+            expected_ids, expected_scores = exact_search(
+                self.items, self.queries, k=10, metric=metric)
+            # scanning every list is exact search
+            ids, scores = index.search(self.queries, k=10, nprobe=20)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-4,
+                                       atol=1e-3)
+
+    def test_recall(self):
+        index = IVFIndex.build(self.items, num_lists=40, metric='l2')
+        expected, _ = exact_search(self.items, self.queries, k=10,
+                                   metric='l2')
+        recalls = [recall(index.search(self.queries, 10, nprobe)[0],
+                          expected) for nprobe in [1, 4, 16, 40]]
+        self.assertTrue(np.all(np.diff(recalls) >= 0), recalls)
+        self.assertTrue(recalls[1] > 0.9, recalls)
+        self.assertEqual(recalls[-1], 1.)
+
+    def test_missing(self):
+        index = IVFIndex.build(self.items[:6], num_lists=3)
+        ids, scores = index.search(self.queries[:4], k=10, nprobe=3)
+        self.assertEqual(ids.shape, (4, 10))
+        self.assertTrue(np.all(ids[:, 6:] == -1))
+        self.assertTrue(np.all(np.isneginf(scores[:, 6:])))
+        for row in ids:
+            self.assertEqual(sorted(row[:6]), list(range(6)))
+
+    def test_save_load(self):
+        index = IVFIndex.build(self.items, num_lists=20, metric='l2')
+        index_dir = tempfile.mkdtemp()
+        try:
+            index.save(index_dir, 'top')
+            loaded = IVFIndex.load(index_dir, 'top')
+            self.assertEqual(loaded.metric, 'l2')
+            self.assertEqual(loaded.num_lists, 20)
+            self.assertTrue(isinstance(loaded.arrays['vectors'], np.memmap))
+            for expected, actual in zip(index.search(self.queries, 5, 4),
+                                        loaded.search(self.queries, 5, 4)):
+                np.testing.assert_array_equal(actual, expected)
+            del loaded
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_kmeans(self):
+        centroids = kmeans(self.items, 16, num_iters=30)
+        assign = assign_clusters(self.items, centroids, batch_size=300)
+        dists = ((self.items[:, None, :] - centroids[None, :, :]) ** 2).sum(
+            axis=2)
+        np.testing.assert_array_equal(assign, dists.argmin(axis=1))
+        # converged centroids are the means of their points
+        for n in range(16):
+            np.testing.assert_allclose(
+                centroids[n], self.items[assign == n].mean(axis=0),
+                atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
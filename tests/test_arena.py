@@ -0,0 +1,98 @@
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import config as cfg
+from utils.polyvore import Dataset
+from utils.data_utils import DataFile
+from utils.arena import ImageNames
+from tests.test_shards import make_datasets, write_image_list
+
+
+class ArenaTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.list_dir = os.path.join(cls.workdir, 'image_list')
+        cls.tuple_dir = os.path.join(cls.workdir, 'tuples')
+        cls.shard_dir = os.path.join(cls.workdir, 'shards')
+        write_image_list(cls.list_dir)
+        np.random.seed(0)
+        dataset = Dataset(make_datasets())
+        dataset.run(ratio=3)
+        dataset.save(cls.tuple_dir)
+        dataset.save(cls.shard_dir, num_shards=2)
+        cls.datafile = DataFile(cls.tuple_dir, cls.list_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def check(self, datafile, arena):
+        for phase in cfg.Phase:
+            for repeated in [True, False]:
+                expected = datafile.get_tuples(phase, repeated)
+                actual = arena.get_tuples(phase, repeated)
+                for e, a in zip(expected, actual):
+                    self.assertEqual(e.dtype, a.dtype)
+                    np.testing.assert_array_equal(e, a)
+        for expected, names in zip(datafile.image_list, arena.image_list):
+            self.assertEqual(list(names), expected)
+            self.assertEqual(type(names[0]), type(expected[0]))
+
+    def test_round_trip(self):
+        arena_dir = os.path.join(self.workdir, 'arena')
+        handle = self.datafile.export_arena(arena_dir)
+        # the handle is sent to workers
+        arena = pickle.loads(pickle.dumps(handle)).attach()
+        self.check(self.datafile, arena)
+        posi, _ = arena.get_tuples('train', repeated=False)
+        self.assertTrue(isinstance(posi, np.memmap))
+
+    def test_default_dir(self):
+        handle = self.datafile.export_arena()
+        self.assertEqual(handle.arena_dir,
+                         os.path.join(self.tuple_dir, 'arena'))
+
+    def test_sharded(self):
+        datafile = DataFile(self.shard_dir, self.list_dir)
+        arena_dir = os.path.join(self.workdir, 'shard_arena')
+        self.check(datafile, datafile.export_arena(arena_dir).attach())
+
+    def test_reuse(self):
+        arena_dir = os.path.join(self.workdir, 'reuse_arena')
+        self.datafile.export_arena(arena_dir)
+        meta_fn = os.path.join(arena_dir, 'arena.json')
+        fn = os.path.join(arena_dir, 'tuples_train_posi.npy')
+        os.remove(fn)
+        # an arena of the same sources is not written again
+        self.datafile.export_arena(arena_dir)
+        self.assertFalse(os.path.exists(fn))
+        # an arena of an older version is
+        with open(meta_fn, 'r') as f:
+            meta = json.load(f)
+        meta['version'] = 1
+        with open(meta_fn, 'w') as f:
+            json.dump(meta, f)
+        self.check(self.datafile,
+                   self.datafile.export_arena(arena_dir).attach())
+
+    def test_image_names(self):
+        names = [u'a.jpg', u'\xe9t\xe9.jpg', u'', u'b.png']
+        encoded = [name.encode('utf-8') for name in names]
+        offsets = np.cumsum([0] + [len(name) for name in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        image_names = ImageNames(blob, offsets)
+        expected = encoded if str is bytes else names
+        self.assertEqual(len(image_names), 4)
+        self.assertEqual(list(image_names), expected)
+        self.assertEqual(image_names[-1], expected[-1])
+        self.assertEqual(image_names[1:3], expected[1:3])
+        self.assertRaises(IndexError, image_names.__getitem__, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
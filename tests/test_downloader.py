@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from utils.check_utils import image_file_name
+from utils.downloader import ImageDownloader
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    import urllib2 as _request
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    import urllib.request as _request
+
+IMAGE = b''.join(bytes(bytearray([n % 256])) for n in range(5000))
+
+
+class Handler(BaseHTTPRequestHandler):
+    # {path: remaining responses with error codes before a success}
+    failures = {}
+    ranges = []
+
+    def do_GET(self):
+        if self.path == '/missing.jpg':
+            self.send_error(404)
+            return
+        codes = self.failures.get(self.path)
+        if codes:
+            self.send_error(codes.pop(0))
+            return
+        body = IMAGE
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            self.ranges.append(range_header)
+            offset = int(range_header.split('=')[1].rstrip('-'))
+            body = IMAGE[offset:]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.image_dir = tempfile.mkdtemp()
+        Handler.failures = {}
+        Handler.ranges = []
+        # no proxies from the environment for the local server
+        opener = _request.build_opener(_request.ProxyHandler({}))
+        self.downloader = ImageDownloader(
+            self.image_dir, num_workers=2, retries=2, backoff=0.,
+            timeout=5., opener=opener)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.image_dir)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        path = os.path.join(self.image_dir, 'image.jpg')
+        with open(path + '.part', 'wb') as f:
+            f.write(IMAGE[:1200])
+        error = self.downloader.fetch(self.base + '/image.jpg', path)
+        self.assertIsNone(error)
+        self.assertEqual(Handler.ranges, ['bytes=1200-'])
+        self.assertEqual(self.read(path), IMAGE)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    def test_retry(self):
+        Handler.failures = {'/flaky.jpg': [429, 503]}
+        path = os.path.join(self.image_dir, 'flaky.jpg')
+        error = self.downloader.fetch(self.base + '/flaky.jpg', path)
+        self.assertIsNone(error)
+        self.assertEqual(self.downloader.num_retries, 2)
+        self.assertEqual(self.read(path), IMAGE)
+
+    def test_retries_exhausted(self):
+        Handler.failures = {'/down.jpg': [503, 503, 503]}
+        path = os.path.join(self.image_dir, 'down.jpg')
+        error = self.downloader.fetch(self.base + '/down.jpg', path)
+        self.assertEqual(error.code, 503)
+        self.assertFalse(os.path.exists(path))
+
+    def test_not_found(self):
+        path = os.path.join(self.image_dir, 'missing.jpg')
+        error = self.downloader.fetch(self.base + '/missing.jpg', path)
+        self.assertEqual(error.code, 404)
+        # permanent errors are not retried
+        self.assertEqual(self.downloader.num_retries, 0)
+
+    def test_run(self):
+        urls = [self.base + '/image.jpg', self.base + '/missing.jpg',
+                'not a url']
+        failed_images = {'user': [([url], 'failed', 'items/full')
+                                  for url in urls]}
+        result = {}
+
+        def run():
+            result['report'] = self.downloader.run(failed_images)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'run() does not return')
+        report = result['report']
+        self.assertEqual(report['downloaded'], 1)
+        self.assertEqual(sorted(report['failed']), sorted(urls[1:]))
+        path = os.path.join(self.image_dir, 'user', 'items/full',
+                            image_file_name(urls[0]))
+        self.assertEqual(self.read(path), IMAGE)
+        # images that exist are skipped
+        report = self.downloader.run(failed_images)
+        self.assertEqual(report['existed'], 1)
+        self.assertEqual(report['downloaded'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
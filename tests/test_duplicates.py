@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+from utils import config as cfg
+from utils.check_utils import image_file_name
+from utils.polyvore import polyvore_parser
+
+# category and name of an item of each class
+ITEM_KINDS = [(['Tops', 'Clothing'], 'tee'),
+              (['Skirts', 'Clothing'], 'skirt'),
+              (['Shoes'], 'boots')]
+IMAGES = {'X': b'x' * 1000, 'Y': b'y' * 300, 'Z': b'z' * 50,
+          'W': b'w' * 70}
+# user: [(item id, class, image)], and sets of the user by item ids
+USERS = {
+    'user000000': ([('a', 0, 'X'), ('b', 0, 'X'), ('d', 2, 'X'),
+                    ('e', 1, 'Y'), ('f', 2, 'Z')],
+                   [['a', 'e', 'f'], ['b', 'e', 'd']]),
+    'user000001': ([('c', 0, 'X'), ('g', 1, 'Y'), ('h', 2, 'W')],
+                   [['c', 'g', 'h']]),
+}
+
+
+def item_url(user, item_id):
+    return '{}/{}/item?id={}'.format(cfg.BaseUrl, user, item_id)
+
+
+def make_raw(raw_dir):
+    """ Raw data where images of items are copies of the same files
+        Return
+        ------
+        names: pairs of {item id: image name}
+    """
+    names = {}
+    for sub_dir in ['items', 'sets']:
+        os.makedirs(os.path.join(raw_dir, sub_dir))
+    for user, (items, sets) in sorted(USERS.items()):
+        image_dir = os.path.join(raw_dir, 'images', user, 'items', 'full')
+        os.makedirs(image_dir)
+        with open(os.path.join(raw_dir, 'items', user + '_items.jsonl'),
+                  'w') as f:
+            for item_id, cls, image in items:
+                url = item_url(user, item_id)
+                name = image_file_name(url + '&image')
+                names[item_id] = name
+                with open(os.path.join(image_dir, name), 'wb') as image_f:
+                    image_f.write(IMAGES[image])
+                categories, item_name = ITEM_KINDS[cls]
+                f.write(json.dumps({
+                    'url': url, 'isfashion': True,
+                    'images': [{'url': url + '&image',
+                                'path': 'full/' + name,
+                                'checksum': hashlib.md5(
+                                    IMAGES[image]).hexdigest()}],
+                    'image_urls': [url + '&image'],
+                    'categories': categories, 'name': item_name,
+                    'price': '$10', 'description': ''}) + '\n')
+        set_dir = os.path.join(raw_dir, 'images', user, 'sets', 'full')
+        os.makedirs(set_dir)
+        with open(os.path.join(raw_dir, 'sets', user + '_sets.jsonl'),
+                  'w') as f:
+            for n, item_ids in enumerate(sets):
+                set_url = '{}/{}/set?id={}'.format(cfg.BaseUrl, user, n)
+                name = image_file_name(set_url)
+                with open(os.path.join(set_dir, name), 'wb') as image_f:
+                    image_f.write(b'set')
+                f.write(json.dumps({
+                    'url': set_url,
+                    'item_urls': ['.' + item_url(user, item_id)[
+                        len(cfg.BaseUrl):] for item_id in item_ids],
+                    'images': [{'url': set_url + '&image',
+                                'path': 'full/' + name}]}) + '\n')
+    return names
+
+
+class DuplicateTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.raw_dir = tempfile.mkdtemp()
+        cls.names = make_raw(cls.raw_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.raw_dir)
+
+    def parse(self, pipelined):
+        parser = polyvore_parser(self.raw_dir)
+        parser.run(pipelined)
+        return parser
+
+    def test_image_groups(self):
+        names = self.names
+        parser = polyvore_parser(self.raw_dir)
+        parser.parse_items()
+        canonical = parser.image_groups()
+        # tops of the same image merge to the smallest name, across users
+        top = min(names[i] for i in 'abc')
+        for item_id in 'abc':
+            self.assertEqual(canonical[names[item_id]], top)
+        # the shoe with the same image as the tops stays apart
+        self.assertEqual(canonical[names['d']], names['d'])
+        bottom = min(names['e'], names['g'])
+        self.assertEqual(canonical[names['e']], bottom)
+        self.assertEqual(canonical[names['g']], bottom)
+        for item_id in 'fh':
+            self.assertEqual(canonical[names[item_id]], names[item_id])
+
+    def test_clean(self):
+        names = self.names
+        top = min(names[i] for i in 'abc')
+        bottom = min(names['e'], names['g'])
+        for pipelined in [False, True]:
+            parser = self.parse(pipelined)
+            self.assertEqual(sorted(parser.fashion_items), sorted(
+                [top, bottom, names['d'], names['f'], names['h']]))
+            self.assertEqual(parser.fashion_items[top].cls, 'top')
+            self.assertEqual(parser.fashion_items[names['d']].cls, 'shoe')
+            sets = sorted(sorted(tuple(names) for names in one_set.items)
+                          for sets in parser.fashion_sets
+                          for one_set in sets)
+            self.assertEqual(sets, sorted(sorted(
+                [(top, ), (bottom, ), (names[shoe], )])
+                for shoe in 'fdh'))
+            # three files of X and two of Y, one of each is kept
+            self.assertEqual(parser.duplicate_report, {
+                'images': 2, 'files': 3, 'items_merged': 3,
+                'bytes_avoided': 2 * len(IMAGES['X']) + len(IMAGES['Y'])})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+from utils.instrument import Recorder, profile_from_env
+
+
+class Blob(object):
+    pass
+
+
+def busy(seconds):
+    """ Run python code for some seconds, for the sampler to see
+    """
+    end = time.time() + seconds
+    total = 0
+    while time.time() < end:
+        total += sum(range(100))
+    return total
+
+
+class RecorderTest(unittest.TestCase):
+    def test_nested(self):
+        recorder = Recorder()
+        with recorder.stage('outer'):
+            recorder.count('items', 2)
+            with recorder.stage('inner'):
+                recorder.count('items')
+        inner, outer = recorder.records
+        self.assertEqual(inner['name'], 'inner')
+        self.assertEqual(inner['parent'], 'outer')
+        self.assertEqual(outer['parent'], None)
+        self.assertEqual(inner['counters'], {'items': 1})
+        self.assertEqual(outer['counters'], {'items': 2})
+        self.assertEqual(recorder.summary()['outer']['calls'], 1)
+
+    def test_failed(self):
+        recorder = Recorder()
+
+        @recorder.stage('fail')
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertFalse(recorder.records[0]['succeeded'])
+
+    def test_threads(self):
+        recorder = Recorder()
+        started = threading.Event()
+
+        def work():
+            with recorder.stage('thread'):
+                started.wait()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        with recorder.stage('main'):
+            started.set()
+            thread.join()
+        parents = dict((record['name'], record['parent'])
+                       for record in recorder.records)
+        self.assertEqual(parents, {'thread': None, 'main': None})
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'reads /proc')
+    def test_rss(self):
+        recorder = Recorder()
+        with recorder.stage('allocate'):
+            data = np.ones(64 * 2 ** 20 // 8)
+        with recorder.stage('small'):
+            pass
+        allocate, small = recorder.records
+        # memory kept by the stage
+        self.assertTrue(allocate['rss_delta'] > 32 * 2 ** 20)
+        self.assertEqual(allocate['rss_end'] - allocate['rss_start'],
+                         allocate['rss_delta'])
+        self.assertTrue(abs(small['rss_delta']) < 32 * 2 ** 20)
+        # the peak of the process does not go down after a large stage
+        self.assertTrue(small['peak_rss'] >= allocate['peak_rss'])
+        del data
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def files(self):
+        return sorted(os.listdir(self.outdir))
+
+    def test_cprofile(self):
+        recorder = Recorder()
+        recorder.enable_profiling(['cprofile'], self.outdir)
+        with recorder.stage('outer'):
+            with recorder.stage('inner'):
+                busy(0.01)
+        self.assertEqual(self.files(), ['outer-1-prof.txt', 'outer-1.prof'])
+        inner, outer = recorder.records
+        # only the outermost stage is profiled
+        self.assertNotIn('profiles', inner)
+        self.assertEqual(sorted(outer['profiles']), [
+            os.path.join(self.outdir, fn) for fn in self.files()])
+        with open(os.path.join(self.outdir, 'outer-1-prof.txt')) as f:
+            self.assertIn('busy', f.read())
+
+    def test_sample(self):
+        recorder = Recorder()
+        recorder.enable_profiling(['sample'], self.outdir, interval=0.001)
+        for _ in range(2):
+            with recorder.stage('work'):
+                busy(0.05)
+        self.assertEqual(self.files(), ['work-1.folded', 'work-2.folded'])
+        with open(os.path.join(self.outdir, 'work-1.folded')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any('busy' in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(int(count) > 0)
+
+    def test_allocations(self):
+        recorder = Recorder()
+        recorder.enable_profiling(['tracemalloc'], self.outdir)
+        with recorder.stage('allocate'):
+            blobs = [Blob() for _ in range(20000)]
+        self.assertEqual(self.files(), ['allocate-1-alloc.txt'])
+        with open(os.path.join(self.outdir, 'allocate-1-alloc.txt')) as f:
+            summary = f.read()
+        if sys.version_info[0] == 2:
+            self.assertIn('Blob: +20000 objects', summary)
+        else:
+            self.assertIn('test_instrument.py', summary)
+        del blobs
+
+    def test_disabled(self):
+        recorder = Recorder()
+        recorder.enable_profiling(['cprofile', 'tracemalloc'], self.outdir,
+                                  stages=['other'])
+        with recorder.stage('work'):
+            busy(0.01)
+        recorder.disable_profiling()
+        with recorder.stage('other'):
+            busy(0.01)
+        self.assertEqual(self.files(), [])
+        self.assertNotIn('profiles', recorder.records[0])
+
+    def test_from_env(self):
+        recorder = Recorder()
+        profile_from_env(recorder, {})
+        self.assertIsNone(recorder.profiler)
+        profile_from_env(recorder, {
+            'POLYVORE_PROFILE': 'sample, tracemalloc',
+            'POLYVORE_PROFILE_DIR': self.outdir,
+            'POLYVORE_PROFILE_STAGES': 'parse_items,split_users'})
+        profiler = recorder.profiler
+        self.assertEqual(profiler.modes, ['sample', 'tracemalloc'])
+        self.assertEqual(profiler.outdir, self.outdir)
+        self.assertEqual(profiler.stages, set(['parse_items',
+                                               'split_users']))
+
+
+if __name__ == '__main__':
+    unittest.main()
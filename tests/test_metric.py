@@ -0,0 +1,275 @@
+import itertools
+import unittest
+import numpy as np
+from utils import metric
+
+
+def make_users(num_users=30, max_samples=12, seed=0):
+    """ Random scores with ties and binary labels of each user
+    """
+    random = np.random.RandomState(seed)
+    u_scores, u_labels = [], []
+    for _ in range(num_users):
+        n = random.randint(1, max_samples + 1)
+        u_scores.append(random.randint(5, size=n).astype(np.float64))
+        labels = (random.rand(n) < 0.3).astype(np.float64)
+        labels[random.randint(n)] = 1.
+        u_labels.append(labels)
+    return u_scores, u_labels
+
+
+def flatten(u_scores, u_labels):
+    offsets = np.concatenate(([0], np.cumsum([len(s) for s in u_scores])))
+    return np.concatenate(u_scores), np.concatenate(u_labels), offsets
+
+
+def reference_mean_ndcg(u_scores, u_labels, wtype='max'):
+    ndcgs = [metric.ndcg_score(s, l, wtype)
+             for s, l in zip(u_scores, u_labels)]
+    max_samples = max(len(ndcg) for ndcg in ndcgs)
+    total = np.zeros(max_samples)
+    count = np.zeros(max_samples)
+    for ndcg in ndcgs:
+        total[:len(ndcg)] += ndcg
+        count[:len(ndcg)] += 1
+    return np.array([ndcg.mean() for ndcg in ndcgs]), total / count
+
+
+class BatchNDCGTest(unittest.TestCase):
+    def test_mean_ndcg(self):
+        u_scores, u_labels = make_users()
+        for wtype in ['max', 'log']:
+            expected = reference_mean_ndcg(u_scores, u_labels, wtype)
+            actual = metric.mean_ndcg_score(u_scores, u_labels, wtype)
+            for e, a in zip(expected, actual):
+                np.testing.assert_allclose(a, e)
+
+    def test_batch_size(self):
+        u_scores, u_labels = make_users(num_users=50)
+        y_score, y_label, offsets = flatten(u_scores, u_labels)
+        expected = metric.flat_ndcg_score(y_score, y_label, offsets)
+        actual = metric.flat_ndcg_score(y_score, y_label, offsets,
+                                        batch_size=7)
+        for e, a in zip(expected, actual):
+            np.testing.assert_allclose(a, e)
+
+    def test_ragged_to_padded(self):
+        padded, lengths = metric.ragged_to_padded(
+            [np.array([1., 2.]), np.array([3.]), np.array([4., 5., 6.])],
+            fill=-1.)
+        np.testing.assert_array_equal(lengths, [2, 1, 3])
+        np.testing.assert_array_equal(
+            padded, [[1, 2, -1], [3, -1, -1], [4, 5, 6]])
+        padded, lengths = metric.ragged_to_padded(
+            np.arange(5.), offsets=[1, 3, 5])
+        np.testing.assert_array_equal(padded, [[1, 2], [3, 4]])
+
+    def test_discounts(self):
+        np.testing.assert_allclose(metric.get_discounts(4, 'max'),
+                                   np.log2([2, 2, 3, 4]))
+        np.testing.assert_allclose(metric.get_discounts(3, 'log'),
+                                   np.log2([2, 3, 4]))
+        self.assertEqual(len(metric.get_discounts(100)), 100)
+
+    def test_group_by_user(self):
+        posi = np.array([[2, 0, 0, 0], [0, 1, 1, 1], [2, 2, 2, 2]])
+        nega = np.array([[0, 3, 3, 3], [2, 4, 4, 4]])
+        scores = np.arange(5.)
+        users, y_score, y_label, offsets = metric.group_by_user(
+            posi, nega, scores)
+        np.testing.assert_array_equal(users, [0, 2])
+        np.testing.assert_array_equal(offsets, [0, 2, 5])
+        np.testing.assert_array_equal(y_score, [1, 3, 0, 2, 4])
+        np.testing.assert_array_equal(y_label, [1, 0, 1, 1, 0])
+        u_scores = metric.split_by_user(y_score, offsets)
+        np.testing.assert_array_equal(u_scores[1], [0, 2, 4])
+
+
+def reference_metrics(scores, labels, ks):
+    """ Ranking metrics of one user from the order of ndcg_score()
+    """
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    ranked = labels[order] > 0
+    ndcg = metric.ndcg_score(scores, labels)
+    num_posi = ranked.sum()
+    results = {}
+    for k in ks:
+        hits = ranked[:k].sum()
+        results['ndcg@{}'.format(k)] = ndcg[min(k, len(ndcg)) - 1]
+        results['recall@{}'.format(k)] = hits / float(num_posi)
+        results['hit@{}'.format(k)] = float(hits > 0)
+    results['mrr'] = 1. / (np.flatnonzero(ranked)[0] + 1)
+    posi = scores[labels > 0]
+    nega = scores[labels == 0]
+    if len(nega):
+        wins = (posi[:, None] > nega[None, :]).sum() + \
+            0.5 * (posi[:, None] == nega[None, :]).sum()
+        results['auc'] = wins / float(len(posi) * len(nega))
+    else:
+        results['auc'] = np.nan
+    return results
+
+
+class RankingTest(unittest.TestCase):
+    def test_ndcg_at_k(self):
+        u_scores, u_labels = make_users()
+        for scores, labels in zip(u_scores, u_labels):
+            for k in [1, 3, 20]:
+                np.testing.assert_allclose(
+                    metric.ndcg_at_k(scores, labels, k),
+                    metric.ndcg_score(scores, labels)[:k])
+
+    def test_batch_topk(self):
+        u_scores, u_labels = make_users()
+        padded, lengths = metric.ragged_to_padded(u_scores)
+        top = metric.batch_topk(padded, lengths, 4)
+        for scores, user_top in zip(u_scores, top):
+            order = np.argsort(scores, kind='mergesort')[::-1]
+            n = min(4, len(scores))
+            np.testing.assert_array_equal(user_top[:n], order[:n])
+            self.assertTrue(np.all(user_top[n:] >= len(scores)))
+
+    def test_ranking_metrics(self):
+        ks = (1, 3, 5)
+        u_scores, u_labels = make_users(num_users=40)
+        y_score, y_label, offsets = flatten(u_scores, u_labels)
+        expected = [reference_metrics(s, l, ks)
+                    for s, l in zip(u_scores, u_labels)]
+        # with 'auc' the top samples come from a full sort
+        for metrics in [('ndcg', 'recall', 'hit', 'mrr', 'auc'),
+                        ('ndcg', 'recall', 'hit', 'mrr')]:
+            results = metric.ranking_metrics(y_score, y_label, offsets, ks,
+                                             metrics, batch_size=9)
+            self.assertEqual(len(results), 3 * len(ks) + len(metrics) - 3)
+            for name, values in results.items():
+                np.testing.assert_allclose(
+                    values, [e[name] for e in expected], err_msg=name)
+
+    def test_no_positive(self):
+        results = metric.ranking_metrics(
+            np.array([1., 2., 3.]), np.zeros(3), [0, 3], ks=(1,))
+        for name in ['recall@1', 'hit@1', 'mrr', 'auc']:
+            self.assertTrue(np.isnan(results[name][0]), name)
+
+
+class AccumulatorTest(unittest.TestCase):
+    def chunks(self, u_scores, u_labels, size=5, seed=0):
+        """ Samples of all users shuffled into chunks
+        """
+        users = np.repeat(np.arange(len(u_scores)),
+                          [len(s) for s in u_scores])
+        y_score = np.concatenate(u_scores)
+        y_label = np.concatenate(u_labels)
+        # interleave users, the samples of each user stay in order
+        order = np.random.RandomState(seed).permutation(len(users))
+        for user in range(len(u_scores)):
+            slots = users[order] == user
+            order[slots] = np.sort(order[slots])
+        for start in range(0, len(order), size):
+            idxs = order[start:start + size]
+            yield users[idxs], y_score[idxs], y_label[idxs]
+
+    def test_chunks(self):
+        u_scores, u_labels = make_users()
+        expected = metric.mean_ndcg_score(u_scores, u_labels)
+        accumulator = metric.NDCGAccumulator()
+        for users, scores, labels in self.chunks(u_scores, u_labels):
+            accumulator.update(users, scores, labels)
+        self.assertEqual(accumulator.users, list(range(len(u_scores))))
+        for e, a in zip(expected, accumulator.finalize()):
+            np.testing.assert_allclose(a, e)
+
+    def test_finish(self):
+        u_scores, u_labels = make_users()
+        expected = metric.mean_ndcg_score(u_scores, u_labels)
+        accumulator = metric.NDCGAccumulator()
+        for user, (scores, labels) in enumerate(zip(u_scores, u_labels)):
+            accumulator.update(user, scores, labels)
+            accumulator.finish([user])
+            self.assertRaises(ValueError, accumulator.update, user,
+                              scores, labels)
+        for e, a in zip(expected, accumulator.finalize()):
+            np.testing.assert_allclose(a, e)
+
+    def test_merge(self):
+        u_scores, u_labels = make_users()
+        expected = metric.mean_ndcg_score(u_scores, u_labels)
+        workers = [metric.NDCGAccumulator() for _ in range(3)]
+        for user, (scores, labels) in enumerate(zip(u_scores, u_labels)):
+            half = len(scores) // 2
+            # the samples of a user can be split over workers, merged in
+            # the order of the samples
+            workers[user % 2].update(user, scores[:half], labels[:half])
+            workers[2].update(user, scores[half:], labels[half:])
+        accumulator = workers[0].merge(workers[1]).merge(workers[2])
+        for e, a in zip(expected, accumulator.finalize()):
+            np.testing.assert_allclose(a, e)
+        self.assertRaises(ValueError, metric.NDCGAccumulator().merge,
+                          metric.NDCGAccumulator('log'))
+        finished = metric.NDCGAccumulator()
+        finished.update(0, u_scores[0], u_labels[0])
+        finished.finish()
+        pending = metric.NDCGAccumulator()
+        pending.update(0, u_scores[0], u_labels[0])
+        self.assertRaises(ValueError, pending.merge, finished)
+
+
+class SignificanceTest(unittest.TestCase):
+    def test_bootstrap_ci(self):
+        values = np.random.RandomState(0).rand(200)
+        mean, low, high = metric.bootstrap_ci(values, num_samples=4000,
+                                              seed=1)
+        self.assertAlmostEqual(mean, values.mean())
+        # close to the normal approximation
+        half = 1.96 * values.std() / np.sqrt(len(values))
+        self.assertAlmostEqual(low, mean - half, delta=0.1 * half)
+        self.assertAlmostEqual(high, mean + half, delta=0.1 * half)
+
+    def test_bootstrap_nan(self):
+        values = np.array([0.2, np.nan, 0.4, 0.6, np.nan])
+        mean, low, high = metric.bootstrap_ci(values, num_samples=100,
+                                              seed=0)
+        self.assertAlmostEqual(mean, 0.4)
+        self.assertTrue(0.2 <= low <= mean <= high <= 0.6)
+
+    def test_workers(self):
+        values = np.random.RandomState(0).rand(50)
+        self.assertEqual(
+            metric.bootstrap_ci(values, 1000, seed=3, batch_size=300),
+            metric.bootstrap_ci(values, 1000, seed=3, batch_size=300,
+                                num_workers=2))
+        self.assertEqual(
+            metric.permutation_test(values, values[::-1], 1000, seed=3,
+                                    batch_size=300),
+            metric.permutation_test(values, values[::-1], 1000, seed=3,
+                                    batch_size=300, num_workers=2))
+
+    def test_permutation_exact(self):
+        random = np.random.RandomState(0)
+        values_a = random.rand(10)
+        values_b = values_a + random.randn(10) * 0.2
+        diffs = values_a - values_b
+        # all sign flips of the 10 users
+        signs = np.array(list(itertools.product([-1., 1.], repeat=10)))
+        means = signs.dot(diffs) / len(diffs)
+        expected = (np.abs(means) >= np.abs(diffs.mean()) - 1e-12).mean()
+        diff, p_value = metric.permutation_test(values_a, values_b,
+                                                num_samples=20000, seed=0)
+        self.assertAlmostEqual(diff, diffs.mean())
+        self.assertAlmostEqual(p_value, expected, delta=0.02)
+
+    def test_permutation_bounds(self):
+        values = np.random.RandomState(0).rand(30)
+        # no difference at all
+        diff, p_value = metric.permutation_test(values, values, 500, seed=0)
+        self.assertEqual(diff, 0.)
+        self.assertEqual(p_value, 1.)
+        # every permutation is less extreme than the observed difference
+        diff, p_value = metric.permutation_test(values + 1., values, 500,
+                                                seed=0)
+        self.assertAlmostEqual(diff, 1.)
+        self.assertAlmostEqual(p_value, 1. / 501)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+from utils.near_duplicate import MultiIndexHash, popcount, cluster
+
+
+def make_hashes(num=300, num_copies=100, num_blank=2000, seed=0):
+    """ Random hashes, near copies of some of them with a few bits
+        flipped, and many equal hashes of blank images
+    """
+    random = np.random.RandomState(seed)
+    hashes = list(random.randint(0, 2 ** 62, size=num, dtype=np.uint64))
+    for n in range(num_copies):
+        value = int(hashes[random.randint(num)])
+        for bit in random.choice(64, random.randint(0, 7), replace=False):
+            value ^= 1 << int(bit)
+        hashes.append(value)
+    hashes += [0] * num_blank
+    return np.array(hashes, dtype=np.uint64)
+
+
+def brute_force_pairs(hashes, radius):
+    i, j = np.triu_indices(len(hashes), 1)
+    dist = popcount(hashes[i] ^ hashes[j])
+    return np.c_[i, j][dist <= radius]
+
+
+class NearDuplicateTest(unittest.TestCase):
+    def test_popcount(self):
+        values = np.array([0, 1, 3, 2 ** 63, 2 ** 64 - 1], dtype=np.uint64)
+        np.testing.assert_array_equal(popcount(values), [0, 1, 2, 1, 64])
+
+    def test_pairs(self):
+        hashes = make_hashes(num_blank=30)
+        for radius in [0, 2, 4]:
+            for max_cells in [7, 1 << 20]:
+                index = MultiIndexHash(hashes, radius, max_cells)
+                np.testing.assert_array_equal(
+                    index.pairs(), brute_force_pairs(hashes, radius))
+
+    def test_links(self):
+        hashes = make_hashes()
+        names = ['{:05d}'.format(n) for n in range(len(hashes))]
+        index = MultiIndexHash(hashes, 4, max_cells=4096)
+        links = index.links()
+        # linear in the number of blank images, not quadratic
+        self.assertTrue(len(links) < len(hashes))
+        self.assertTrue(np.all(links[:, 0] < links[:, 1]))
+        expected = cluster(names, brute_force_pairs(hashes, 4))
+        self.assertEqual(cluster(names, links), expected)
+
+    def test_empty(self):
+        index = MultiIndexHash(np.zeros(0, dtype=np.uint64))
+        self.assertEqual(index.pairs().shape, (0, 2))
+        self.assertEqual(index.links().shape, (0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from utils.synthetic import make_raw
+from utils.polyvore import polyvore_parser
+
+
+class ParserTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.raw_dir = tempfile.mkdtemp()
+        make_raw(cls.raw_dir, num_users=20, sets_per_user=10,
+                 image_size=64)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.raw_dir)
+
+    def parse(self, pipelined):
+        parser = polyvore_parser(self.raw_dir)
+        parser.run(pipelined)
+        items = dict((name, info.to_dict())
+                     for name, info in parser.fashion_items.items())
+        # users of fashion_sets are in the order of a dict
+        sets = sorted([one_set.to_dict() for one_set in sets]
+                      for sets in parser.fashion_sets)
+        return items, sets
+
+    def test_pipelined(self):
+        self.assertEqual(self.parse(False), self.parse(True))
+
+    def jobs(self, parser):
+        users = sorted(jsonl.split('_items')[0]
+                       for jsonl in parser.item_jsonls)
+        return [(user, [user + '_items.jsonl'], [user + '_sets.jsonl'])
+                for user in users]
+
+    def test_prefetch_stops(self):
+        parser = polyvore_parser(self.raw_dir)
+        num_threads = threading.active_count()
+        jobs = parser._prefetch(self.jobs(parser), 1)
+        user, item_files, set_files = next(jobs)
+        self.assertEqual(user, self.jobs(parser)[0][0])
+        # the consumer stops early while the reader waits on a full queue
+        jobs.close()
+        self.assertEqual(threading.active_count(), num_threads)
+
+    def test_prefetch_raises(self):
+        parser = polyvore_parser(self.raw_dir)
+        num_threads = threading.active_count()
+        jobs = self.jobs(parser)[:2]
+        jobs.append(('missing', ['missing_items.jsonl'], []))
+        with self.assertRaises(EnvironmentError):
+            for job in parser._prefetch(jobs, 1):
+                pass
+        self.assertEqual(threading.active_count(), num_threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
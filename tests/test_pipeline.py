@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+from utils.pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.workdir, '.pipeline')
+        self.params = {'a': {'n': 1}, 'b': {'n': 2}, 'c': {'n': 3},
+                       'd': {'n': 4}}
+        self.failing = set()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def output(self, name):
+        return os.path.join(self.workdir, name + '.txt')
+
+    def pipeline(self):
+        """ a -> b -> c and a -> d, each stage writes one file
+        """
+        def stage(name):
+            def func():
+                self.calls.append(name)
+                if name in self.failing:
+                    raise ValueError(name)
+                with open(self.output(name), 'w') as f:
+                    f.write(name)
+            return func
+
+        pipeline = Pipeline(self.state_dir)
+        for name, deps in [('a', []), ('b', ['a']), ('c', ['b']),
+                           ('d', ['a'])]:
+            pipeline.add(name, stage(name), deps, self.params[name],
+                         [self.output(name)])
+        return pipeline
+
+    def run_pipeline(self, **kwargs):
+        self.calls = []
+        status = self.pipeline().run(**kwargs)
+        return sorted(name for name, state in status.items()
+                      if state == 'ran')
+
+    def test_skip(self):
+        self.assertEqual(self.run_pipeline(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.run_pipeline(), [])
+        self.assertEqual(self.calls, [])
+
+    def test_params(self):
+        self.run_pipeline()
+        self.params['b'] = {'n': 5}
+        self.assertEqual(self.run_pipeline(), ['b', 'c'])
+        self.assertEqual(self.run_pipeline(), [])
+
+    def test_force(self):
+        self.run_pipeline()
+        self.assertEqual(self.run_pipeline(force=['a']),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.run_pipeline(force=['b']), ['b', 'c'])
+        self.assertEqual(self.run_pipeline(), [])
+
+    def test_targets(self):
+        self.run_pipeline()
+        # a ran again without its dependents, they run on the next call
+        self.assertEqual(self.run_pipeline(targets=['a'], force=['a']),
+                         ['a'])
+        self.assertEqual(self.run_pipeline(), ['b', 'c', 'd'])
+
+    def test_missing_output(self):
+        self.run_pipeline()
+        os.remove(self.output('b'))
+        self.assertEqual(self.run_pipeline(), ['b', 'c'])
+
+    def test_failure(self):
+        self.run_pipeline()
+        self.params['b'] = {'n': 5}
+        self.failing.add('b')
+        with self.assertRaises(ValueError):
+            self.run_pipeline()
+        self.assertNotIn('c', self.calls)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.state_dir, 'b.json')))
+        self.failing.clear()
+        self.assertEqual(self.run_pipeline(), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
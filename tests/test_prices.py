@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from utils import config as cfg
+from utils.data_utils import DataFile, parse_prices
+from tests.test_shards import write_image_list
+
+
+class ParsePricesTest(unittest.TestCase):
+    def check(self, price, value, currency):
+        values, currencies = parse_prices([price])
+        if np.isnan(value):
+            self.assertTrue(np.isnan(values[0]), price)
+        else:
+            self.assertAlmostEqual(values[0], value, places=3, msg=price)
+        self.assertEqual(currencies[0], currency)
+
+    def test_formats(self):
+        self.check(u'$45', 45., u'$')
+        self.check(u'$ 1,234.50', 1234.5, u'$')
+        self.check(u'US$45', 45., u'US$')
+        self.check(u'45 USD', 45., u'USD')
+        self.check(u'$20 - $30', 25., u'$')
+
+    def test_decimal_comma(self):
+        self.check(u'\u20ac 99,95', 99.95, u'\u20ac')
+        self.check(u'\u20ac 1,234', 1234., u'\u20ac')
+        self.check(u'12,50 - 17,50 EUR', 15., u'EUR')
+
+    def test_unparseable(self):
+        self.check(u'', np.nan, u'')
+        self.check(u'call for price', np.nan, u'')
+        values, currencies = parse_prices([u'$5', u'n/a', u'7 GBP'])
+        np.testing.assert_allclose(values, [5., np.nan, 7.])
+        self.assertEqual(list(currencies), [u'$', u'', u'GBP'])
+
+
+class GetPricesTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.list_dir = os.path.join(self.workdir, 'image_list')
+        self.pkl_dir = os.path.join(self.workdir, 'pickles')
+        write_image_list(self.list_dir)
+        os.makedirs(self.pkl_dir)
+        items = {}
+        for cate in cfg.ClassName:
+            for n in range(5):
+                items['{}_{}.jpg'.format(cate, n)] = {
+                    'price': u'${}'.format(n + 1)}
+        with open(os.path.join(self.pkl_dir, 'fashion_sets.pickle'),
+                  'wb') as f:
+            pickle.dump([], f)
+        with open(os.path.join(self.pkl_dir, 'fashion_items.pickle'),
+                  'wb') as f:
+            pickle.dump(items, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_cache(self):
+        datafile = DataFile(self.workdir, self.list_dir)
+        self.assertRaises(IOError, datafile.get_prices)
+        prices, currencies = datafile.get_prices(self.pkl_dir)
+        np.testing.assert_allclose(prices[0][:6],
+                                   [1, 2, 3, 4, 5, np.nan])
+        self.assertEqual(currencies[0][0], u'$')
+        # saved prices are used without the pickles
+        prices, _ = DataFile(self.workdir, self.list_dir).get_prices()
+        self.assertEqual(len(prices[0]), len(datafile.image_list[0]))
+
+    def test_image_list_changed(self):
+        DataFile(self.workdir, self.list_dir).get_prices(self.pkl_dir)
+        fn = os.path.join(self.list_dir, 'image_list_top.txt')
+        with open(fn, 'r') as f:
+            names = f.read().split()
+        with open(fn, 'w') as f:
+            f.write('\n'.join(names[::-1]) + '\n')
+        datafile = DataFile(self.workdir, self.list_dir)
+        self.assertRaises(IOError, datafile.get_prices)
+        prices, _ = datafile.get_prices(self.pkl_dir)
+        np.testing.assert_allclose(prices[0][-5:], [5, 4, 3, 2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
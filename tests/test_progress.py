@@ -0,0 +1,90 @@
+import sys
+import unittest
+from utils import progress
+from utils.progress import ProgressBar
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class TTY(StringIO):
+    def isatty(self):
+        return True
+
+
+class ProgressBarTest(unittest.TestCase):
+    def setUp(self):
+        self.stdout = sys.stdout
+        self.clock = [100.]
+        self._time = progress._time
+        progress._time = lambda: self.clock[0]
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        progress._time = self._time
+
+    def redraws(self):
+        return sys.stdout.getvalue().count('\r')
+
+    def test_not_tty(self):
+        sys.stdout = StringIO()
+        bar = ProgressBar(100, 'Quiet')
+        for _ in range(100):
+            bar.forward()
+        bar.end()
+        self.assertEqual(bar.cur, 100)
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+    def test_enabled(self):
+        sys.stdout = StringIO()
+        bar = ProgressBar(3, 'Forced', enabled=True)
+        bar.forward(3)
+        bar.end()
+        self.assertEqual(self.redraws(), 1)
+
+    def test_throttle(self):
+        sys.stdout = TTY()
+        bar = ProgressBar(1000, 'Drawn')
+        for _ in range(100):
+            bar.forward()
+        # the first step draws, the others come too soon
+        self.assertEqual(self.redraws(), 1)
+        self.clock[0] += 0.05
+        bar.forward()
+        self.assertEqual(self.redraws(), 1)
+        self.clock[0] += 0.06
+        bar.forward()
+        self.assertEqual(self.redraws(), 2)
+        self.assertIn('102/1000', sys.stdout.getvalue())
+        # the last step is always drawn
+        bar.forward(898)
+        self.assertEqual(self.redraws(), 3)
+        bar.end()
+        self.assertEqual(self.redraws(), 3)
+        self.assertTrue(sys.stdout.getvalue().endswith('\n'))
+
+    def test_end_draws_last(self):
+        sys.stdout = TTY()
+        bar = ProgressBar(10, 'Drawn')
+        bar.forward()
+        bar.forward()
+        bar.end()
+        self.assertEqual(self.redraws(), 2)
+        self.assertIn('2/10', sys.stdout.getvalue().split('\r')[-1])
+
+    def test_forward(self):
+        sys.stdout = TTY()
+        bar = ProgressBar(12, 'Steps')
+        bar.forward(5)
+        self.assertEqual(bar.cur, 5)
+        bar.forward()
+        self.assertEqual(bar.cur, 6)
+        bar.forward(10)
+        self.assertEqual(bar.cur, 12)
+        bar.reset(4)
+        self.assertEqual(list(bar), [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from utils.retrieval import OutfitScorer, topk_outfits, brute_force_topk
+
+
+def make_scorer(num_items=(40, 30, 20), dim=8, user=True, seed=0):
+    random = np.random.RandomState(seed)
+    item_embs = [random.randn(n, dim) for n in num_items]
+    user_emb = random.randn(dim) if user else None
+    return OutfitScorer(item_embs, user_emb, pair_weight=0.5)
+
+
+class RetrievalTest(unittest.TestCase):
+    def check(self, scorer, k, **kwargs):
+        outfits, scores = topk_outfits(scorer, k, **kwargs)
+        expected_outfits, expected_scores = brute_force_topk(scorer, k)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-9)
+        np.testing.assert_array_equal(outfits, expected_outfits)
+        np.testing.assert_allclose(scorer.score(outfits), scores,
+                                   atol=1e-9)
+
+    def test_topk(self):
+        for seed in range(3):
+            for user in [True, False]:
+                scorer = make_scorer(user=user, seed=seed)
+                for k in [1, 10, 50]:
+                    self.check(scorer, k, batch_size=7)
+
+    def test_all_outfits(self):
+        scorer = make_scorer(num_items=(3, 4, 2))
+        outfits, scores = topk_outfits(scorer, k=100)
+        self.assertEqual(len(outfits), 24)
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_pair_rows(self):
+        scorer = make_scorer()
+        stats = {}
+        cached = topk_outfits(scorer, 20, batch_size=4, stats=stats)
+        # each bottom-shoe row is computed at most once
+        self.assertTrue(stats['pair_rows'] <= scorer.num_items[1])
+        stats = {}
+        uncached = topk_outfits(scorer, 20, batch_size=4, stats=stats,
+                                max_cells=0)
+        self.assertTrue(stats['pair_rows'] >= scorer.num_items[1])
+        np.testing.assert_array_equal(cached[0], uncached[0])
+        np.testing.assert_allclose(cached[1], uncached[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import config as cfg
+from utils.polyvore import Dataset, shard_users
+from utils.data_utils import DataFile
+
+NUM_USERS = 12
+NUM_ITEMS = 30
+
+
+def make_datasets(seed=0):
+    """ Random id tuples of each user for train / val / test
+    """
+    random = np.random.RandomState(seed)
+    datasets = []
+    for num_sets in [8, 3, 3]:
+        datasets.append([
+            set(tuple(random.randint(NUM_ITEMS, size=cfg.NumCate))
+                for _ in range(random.randint(1, num_sets + 1)))
+            for _ in range(NUM_USERS)])
+    return datasets
+
+
+def write_image_list(list_dir):
+    os.makedirs(list_dir)
+    for cate in cfg.ClassName:
+        with open(os.path.join(list_dir, 'image_list_{}.txt'.format(cate)),
+                  'w') as f:
+            for n in range(NUM_ITEMS):
+                f.write('{}_{}.jpg\n'.format(cate, n))
+
+
+class ShardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.list_dir = os.path.join(cls.workdir, 'image_list')
+        cls.full_dir = os.path.join(cls.workdir, 'full')
+        cls.shard_dir = os.path.join(cls.workdir, 'shards')
+        write_image_list(cls.list_dir)
+        np.random.seed(0)
+        dataset = Dataset(make_datasets())
+        dataset.run(ratio=3)
+        dataset.save(cls.full_dir)
+        dataset.save(cls.shard_dir, num_shards=3)
+        cls.full = DataFile(cls.full_dir, cls.list_dir)
+        cls.sharded = DataFile(cls.shard_dir, cls.list_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def test_shard_users(self):
+        bounds = shard_users(np.array([5, 1, 1, 1, 1, 1, 5, 5]), 3)
+        self.assertEqual(bounds[0], 0)
+        self.assertEqual(bounds[-1], 8)
+        self.assertEqual(len(bounds), 4)
+        self.assertTrue(np.all(np.diff(bounds) >= 0))
+
+    def test_round_trip(self):
+        for phase in cfg.Phase:
+            for repeated in [True, False]:
+                full = self.full.get_tuples(phase, repeated)
+                sharded = self.sharded.get_tuples(phase, repeated)
+                for expected, actual in zip(full, sharded):
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_shards(self):
+        manifest = self.sharded.get_manifest()
+        self.assertEqual(manifest['num_shards'], 3)
+        self.assertEqual(manifest['num_users'], NUM_USERS)
+        for phase in cfg.Phase:
+            posi, nega = self.full.get_tuples(phase, repeated=False)
+            parts = [self.sharded.get_tuples(phase, False, shard=n,
+                                             num_shards=3)
+                     for n in range(3)]
+            for n, (shard, (shard_posi, shard_nega)) in enumerate(
+                    zip(manifest['shards'], parts)):
+                start, end = shard['users']
+                for tuples in [shard_posi, shard_nega]:
+                    users = tuples[:, 0]
+                    self.assertTrue(np.all((users >= start) &
+                                           (users < end)))
+                self.assertEqual(shard['rows'][phase]['posi'],
+                                 len(shard_posi))
+                self.assertEqual(shard['rows'][phase]['nega'],
+                                 len(shard_nega))
+            np.testing.assert_array_equal(
+                np.vstack([p for p, _ in parts]), posi)
+            np.testing.assert_array_equal(
+                np.vstack([n for _, n in parts]), nega)
+
+    def test_num_shards_mismatch(self):
+        self.assertRaises(ValueError, self.sharded.get_tuples, 'train',
+                          shard=0, num_shards=2)
+
+    def test_index(self):
+        full = self.full.get_index('train')
+        sharded = self.sharded.get_index('train')
+        for cate in range(cfg.NumCate):
+            for item in range(NUM_ITEMS):
+                np.testing.assert_array_equal(
+                    full.outfits(cate, item), sharded.outfits(cate, item))
+                np.testing.assert_array_equal(
+                    full.users(cate, item), sharded.users(cate, item))
+
+    def test_matrices(self):
+        for full, sharded in zip(self.full.get_user_item('val'),
+                                 self.sharded.get_user_item('val')):
+            self.assertEqual((full != sharded).nnz, 0)
+        full = self.full.get_item_item('val')
+        sharded = self.sharded.get_item_item('val')
+        for key in full:
+            self.assertEqual((full[key] != sharded[key]).nnz, 0)
+
+
+class TinyIndexTest(unittest.TestCase):
+    """ Index and count matrices of a few hand-written positive tuples
+    """
+    # rows of (user, top, bottom, shoe)
+    posi = [[0, 1, 2, 3], [0, 1, 4, 3], [1, 1, 2, 5], [2, 0, 2, 3]]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        list_dir = os.path.join(cls.workdir, 'image_list')
+        write_image_list(list_dir)
+        with open(os.path.join(cls.workdir, 'tuples_train_posi'), 'w') as f:
+            f.write('user,top,bottom,shoe\n')
+            for row in cls.posi:
+                f.write(','.join(str(n) for n in row) + '\n')
+        cls.datafile = DataFile(cls.workdir, list_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def test_index(self):
+        index = self.datafile.get_index('train')
+        # {(cate, item): (rows of tuples, users)}
+        expected = {(0, 0): ([3], [2]), (0, 1): ([0, 1, 2], [0, 1]),
+                    (1, 2): ([0, 2, 3], [0, 1, 2]), (1, 4): ([1], [0]),
+                    (2, 3): ([0, 1, 3], [0, 2]), (2, 5): ([2], [1])}
+        for cate in range(cfg.NumCate):
+            for item in range(NUM_ITEMS):
+                rows, users = expected.get((cate, item), ([], []))
+                self.assertEqual(list(index.outfits(cate, item)), rows)
+                self.assertEqual(list(index.users(cate, item)), users)
+                self.assertEqual(index.num_outfits(cate, item), len(rows))
+
+    def dense(self, shape, counts):
+        matrix = np.zeros(shape, dtype=np.int64)
+        for (row, col), count in counts.items():
+            matrix[row, col] = count
+        return matrix
+
+    def test_user_item(self):
+        expected = [{(0, 1): 2, (1, 1): 1, (2, 0): 1},
+                    {(0, 2): 1, (0, 4): 1, (1, 2): 1, (2, 2): 1},
+                    {(0, 3): 2, (1, 5): 1, (2, 3): 1}]
+        for matrix, counts in zip(self.datafile.get_user_item('train'),
+                                  expected):
+            np.testing.assert_array_equal(
+                matrix.toarray(), self.dense((3, NUM_ITEMS), counts))
+
+    def test_item_item(self):
+        expected = {(0, 1): {(1, 2): 2, (1, 4): 1, (0, 2): 1},
+                    (1, 2): {(2, 3): 2, (4, 3): 1, (2, 5): 1},
+                    (0, 2): {(1, 3): 2, (1, 5): 1, (0, 3): 1}}
+        matrices = self.datafile.get_item_item('train')
+        self.assertEqual(sorted(matrices), sorted(expected))
+        for key, counts in expected.items():
+            np.testing.assert_array_equal(
+                matrices[key].toarray(),
+                self.dense((NUM_ITEMS, NUM_ITEMS), counts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+from utils import config as cfg
+from utils.polyvore import concise_sets, polyvore_spliter
+
+MIN_SIZE = [10, 3, 3]
+
+
+def make_fashion_sets(num_users=12, seed=0):
+    """ Fashion sets of each user, items are drawn from a small pool of
+        each user so that they can be split
+    """
+    random = np.random.RandomState(seed)
+    fashion_sets = []
+    for u in range(num_users):
+        sets = []
+        for _ in range(random.randint(10, 60)):
+            items = [['u{}_{}_{}.jpg'.format(u, cate, random.randint(40))]
+                     for cate in cfg.ClassName]
+            sets.append({'items': items})
+        fashion_sets.append(sets)
+    return fashion_sets
+
+
+def split(sets, seed=0, usize=2):
+    spliter = polyvore_spliter(sets, MIN_SIZE, seed)
+    spliter.run(usize)
+    return spliter
+
+
+class SplitTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fashion_sets = make_fashion_sets()
+
+    def sets(self, form):
+        concise = concise_sets(self.fashion_sets)
+        if form == 'list':
+            return concise.run(sum(MIN_SIZE))
+        return concise.iter_sets(sum(MIN_SIZE))
+
+    def test_list_and_stream(self):
+        in_memory = split(self.sets('list'))
+        streamed = split(self.sets('iter'))
+        self.assertEqual(in_memory.digest(), streamed.digest())
+        self.assertEqual(in_memory.digest(True), streamed.digest(True))
+        self.assertEqual(in_memory.image_list, streamed.image_list)
+        self.assertEqual(in_memory.get_datesets(False),
+                         streamed.get_datesets(False))
+
+    def test_reproducible(self):
+        first = split(self.sets('list'))
+        second = split(self.sets('list'))
+        self.assertEqual(first.digest(), second.digest())
+        # run() again restarts the random state
+        first.run(2)
+        self.assertEqual(first.digest(), second.digest())
+        other = split(self.sets('list'), seed=1)
+        self.assertNotEqual(first.digest(), other.digest())
+
+    def test_independent_users(self):
+        # changing the sets of one user does not change the other users
+        sets = self.sets('list')
+        changed = [set(sorted(sets[0])[:len(sets[0]) // 2])] + sets[1:]
+        first = split(sets, usize=0).get_datesets(False, dtype='raw')
+        other = split(changed, usize=0).get_datesets(False, dtype='raw')
+        users = [tuple(sorted(sets) for sets in phases)
+                 for phases in zip(*other)]
+        kept = 0
+        for phases in zip(*first):
+            phases = tuple(sorted(sets) for sets in phases)
+            if phases[0][0][0].startswith('u0_'):
+                continue
+            kept += 1
+            self.assertIn(phases, users)
+        self.assertTrue(kept > 0)
+
+    def test_constrains(self):
+        spliter = split(self.sets('list'), usize=0)
+        datasets = spliter.get_datesets(False, dtype='raw')
+        self.assertTrue(len(datasets[0]) > 0)
+        for n in range(cfg.NumPhase):
+            for sets in datasets[n]:
+                self.assertTrue(MIN_SIZE[n] <= len(sets) <= MIN_SIZE[n] + 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
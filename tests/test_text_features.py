@@ -0,0 +1,119 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils import config as cfg
+from utils import text_features
+from utils.data_utils import DataFile
+from tests.test_shards import write_image_list, NUM_ITEMS
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+WORDS = ['red', 'blue', 'cotton', 'silk', 'leather']
+
+
+def make_items():
+    """ Items of the image lists of write_image_list(), a few missing
+    """
+    random = np.random.RandomState(0)
+    items = {}
+    for cate in cfg.ClassName:
+        for n in range(NUM_ITEMS - 2):
+            words = random.choice(WORDS, 3)
+            items['{}_{}.jpg'.format(cate, n)] = {
+                'name': u'{} {}'.format(words[0], cate),
+                'text': u' '.join(words[1:]),
+                'categories': [u'Clothing']}
+    return items
+
+
+class TextFeaturesTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.list_dir = os.path.join(self.workdir, 'image_list')
+        self.pkl_dir = os.path.join(self.workdir, 'pickles')
+        write_image_list(self.list_dir)
+        os.makedirs(self.pkl_dir)
+        with open(os.path.join(self.pkl_dir, 'fashion_items.pickle'),
+                  'wb') as f:
+            pickle.dump(make_items(), f)
+        self.datafile = DataFile(self.workdir, self.list_dir)
+        self.builds = 0
+        self._build = text_features.build_text_features
+
+        def build(*args, **kwargs):
+            self.builds += 1
+            return self._build(*args, **kwargs)
+        text_features.build_text_features = build
+
+    def tearDown(self):
+        text_features.build_text_features = self._build
+        shutil.rmtree(self.workdir)
+
+    def load(self, image_list=None, min_df=2):
+        image_list = image_list or self.datafile.image_list
+        return text_features.load_text_features(
+            self.pkl_dir, image_list, self.list_dir, min_df=min_df,
+            num_workers=1)
+
+    def cache_files(self):
+        return glob.glob(os.path.join(self.list_dir, 'text_features_*.npz'))
+
+    def test_features(self):
+        features, vocab = self.datafile.get_text_features(
+            self.pkl_dir, min_df=2, num_workers=1)
+        self.assertEqual(vocab, sorted(vocab))
+        for token in WORDS + ['top', 'cate:clothing']:
+            self.assertIn(token, vocab)
+        for n, matrix in enumerate(features):
+            self.assertEqual(matrix.shape, (NUM_ITEMS, len(vocab)))
+            self.assertEqual(matrix.dtype, np.float64)
+            norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(
+                axis=1)).ravel())
+            np.testing.assert_allclose(norms[:-2], 1.)
+            # missing items have empty rows
+            np.testing.assert_array_equal(norms[-2:], 0.)
+
+    def test_cache(self):
+        features, vocab = self.load()
+        cached, cached_vocab = self.load()
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(cached_vocab, vocab)
+        for matrix, cached_matrix in zip(features, cached):
+            self.assertEqual((matrix != cached_matrix).nnz, 0)
+
+    def test_params(self):
+        self.load()
+        self.load(min_df=3)
+        self.assertEqual(self.builds, 2)
+        # only the latest cache is kept
+        self.assertEqual(len(self.cache_files()), 1)
+        self.load(min_df=3)
+        self.assertEqual(self.builds, 2)
+
+    def test_vocab(self):
+        self.load()
+        cfg.FashionWords.add('polka')
+        try:
+            _, vocab = self.load()
+        finally:
+            cfg.FashionWords.discard('polka')
+        self.assertEqual(self.builds, 2)
+        self.assertIn('polka', vocab)
+
+    def test_image_list(self):
+        self.load()
+        image_list = [images[::-1] for images in self.datafile.image_list]
+        features, _ = self.load(image_list)
+        self.assertEqual(self.builds, 2)
+        # rows follow the new image list
+        self.assertEqual(features[0][:2].nnz, 0)
+        self.assertEqual(len(self.cache_files()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
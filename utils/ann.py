@@ -0,0 +1,216 @@
+""" Approximate nearest neighbour search over item embeddings.
+    Usage
+    -----
+    >> index = IVFIndex.build(embeddings, num_lists=256)
+    >> index.save(list_dir, 'top')
+    >> index = DataFile(tuple_dir, list_dir).get_ann_index('top')
+    >> ids, scores = index.search(queries, k=10, nprobe=8)
+"""
+import os
+import json
+import numpy as np
+from .inverted_index import csr_groups
+
+# arrays of an index
+_fields = ['centroids', 'list_ptr', 'ids', 'vectors', 'norms']
+
+
+def _scores(queries, vectors, norms, metric):
+    """ Similarities of each query with each vector, larger is closer:
+        inner products for 'ip', negative squared distances for 'l2'
+    """
+    scores = queries.dot(vectors.T)
+    if metric == 'l2':
+        scores *= 2
+        scores -= norms[None, :]
+        scores -= (queries ** 2).sum(axis=1)[:, None]
+    return scores
+
+
+def _topk(scores, k):
+    """ Indices of the k largest scores of each row, best first
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(k), (len(scores), 1))
+    rows = np.arange(len(scores))[:, None]
+    order = np.argsort(-scores[rows, idx], axis=1, kind='mergesort')
+    return idx[rows, order]
+
+
+def kmeans(data, num_clusters, num_iters=20, seed=0, batch_size=4096):
+    """ Lloyd's k-means, initialized with random points
+        Return
+        ------
+        centroids: array of shape (num_clusters, dim)
+    """
+    random = np.random.RandomState(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[random.choice(len(data), num_clusters, replace=False)]
+    norms = (data ** 2).sum(axis=1)
+    for _ in range(num_iters):
+        assign = assign_clusters(data, centroids, batch_size)
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = np.stack([np.bincount(assign, data[:, d], num_clusters)
+                         for d in range(data.shape[1])], axis=1)
+        empty = np.flatnonzero(counts == 0)
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        if len(empty):
+            # restart empty clusters at the farthest points
+            dist = norms - 2 * np.einsum(
+                'ij,ij->i', data, centroids[assign]) + (
+                centroids[assign] ** 2).sum(axis=1)
+            centroids[empty] = data[np.argsort(-dist)[:len(empty)]]
+    return centroids
+
+
+def assign_clusters(data, centroids, batch_size=4096):
+    """ Nearest centroid of each point
+    """
+    norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), batch_size):
+        batch = data[start:start + batch_size]
+        assign[start:start + batch_size] = _scores(
+            batch, centroids, norms, 'l2').argmax(axis=1)
+    return assign
+
+
+class IVFIndex(object):
+    """ Inverted file index: items are clustered by k-means, and a query
+        only scans the nprobe lists whose centroids are closest to it.
+        A larger nprobe gives a higher recall and a higher latency, nprobe
+        = num_lists is exact search.
+        Constructor
+        -----------
+        IVFIndex.build(embeddings, num_lists=None, metric='ip')
+            embeddings: array of shape (num_items, dim), rows are in the
+                        order of DataFile.image_list[cate]
+            num_lists: number of clusters, about sqrt(num_items) if None
+            metric: 'ip' for inner product, 'l2' for euclidean distance
+        IVFIndex.load(index_dir, cate, mmap_mode='r')
+        Methods
+        -------
+        search(queries, k=10, nprobe=8): ids and scores of k nearest items
+        save(index_dir, cate): save as .npy files
+    """
+    def __init__(self, arrays, metric):
+        self.arrays = arrays
+        self.metric = metric
+
+    @classmethod
+    def build(cls, embeddings, num_lists=None, metric='ip', num_iters=20,
+              max_train=256, seed=0):
+        """ Build index
+            Parameters
+            ----------
+            num_iters: iterations of k-means
+            max_train: k-means is trained on at most max_train points for
+                       each list
+        """
+        assert metric in ['ip', 'l2']
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        num_items = len(embeddings)
+        if num_lists is None:
+            num_lists = int(np.sqrt(num_items))
+        num_lists = max(1, min(num_lists, num_items))
+        random = np.random.RandomState(seed)
+        train = embeddings
+        if num_items > max_train * num_lists:
+            train = embeddings[random.choice(
+                num_items, max_train * num_lists, replace=False)]
+        centroids = kmeans(train, num_lists, num_iters, seed)
+        assign = assign_clusters(embeddings, centroids)
+        list_ptr, ids = csr_groups(assign, num_lists)
+        vectors = embeddings[ids]
+        arrays = {'centroids': centroids, 'list_ptr': list_ptr, 'ids': ids,
+                  'vectors': vectors, 'norms': (vectors ** 2).sum(axis=1)}
+        return cls(arrays, metric)
+
+    @property
+    def num_lists(self):
+        return len(self.arrays['centroids'])
+
+    def search(self, queries, k=10, nprobe=8):
+        """ Approximate k nearest items of each query
+            Parameters
+            ----------
+            queries: array of shape (num_queries, dim)
+            k: number of items for each query
+            nprobe: number of lists scanned for each query
+            Return
+            ------
+            ids: array of shape (num_queries, k), item ids, best first,
+                 -1 if less than k items are found
+            scores: array of shape (num_queries, k), inner products or
+                    negative squared distances, -inf for missing items
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        num_queries = len(queries)
+        nprobe = min(nprobe, self.num_lists)
+        arrays = self.arrays
+        list_ptr = arrays['list_ptr']
+        # lists to scan for each query
+        centroids = arrays['centroids']
+        probes = _topk(_scores(queries, centroids,
+                               (centroids ** 2).sum(axis=1), 'l2'), nprobe)
+        # candidates of each query, k from each probed list
+        cand_ids = np.full((num_queries, nprobe * k), -1, dtype=np.int64)
+        cand_scores = np.full((num_queries, nprobe * k), -np.inf,
+                              dtype=np.float32)
+        for lst in np.unique(probes):
+            start, end = list_ptr[lst], list_ptr[lst + 1]
+            if start == end:
+                continue
+            qs, slots = np.nonzero(probes == lst)
+            scores = _scores(queries[qs], arrays['vectors'][start:end],
+                             arrays['norms'][start:end], self.metric)
+            idx = _topk(scores, k)
+            cols = slots[:, None] * k + np.arange(idx.shape[1])[None, :]
+            cand_ids[qs[:, None], cols] = arrays['ids'][start:end][idx]
+            cand_scores[qs[:, None], cols] = scores[
+                np.arange(len(qs))[:, None], idx]
+        idx = _topk(cand_scores, k)
+        rows = np.arange(num_queries)[:, None]
+        return cand_ids[rows, idx], cand_scores[rows, idx]
+
+    @staticmethod
+    def _fn(index_dir, cate, field):
+        return os.path.join(index_dir, 'ann_{}_{}.npy'.format(cate, field))
+
+    def save(self, index_dir, cate):
+        """ Save the index of category cate (e.g. 'top') in index_dir
+        """
+        for field in _fields:
+            np.save(self._fn(index_dir, cate, field), self.arrays[field])
+        with open(os.path.join(index_dir, 'ann_{}.json'.format(cate)),
+                  'w') as f:
+            json.dump({'metric': self.metric}, f)
+
+    @classmethod
+    def load(cls, index_dir, cate, mmap_mode='r'):
+        with open(os.path.join(index_dir, 'ann_{}.json'.format(cate)),
+                  'r') as f:
+            meta = json.load(f)
+        arrays = dict((field, np.load(cls._fn(index_dir, cate, field),
+                                      mmap_mode=mmap_mode))
+                      for field in _fields)
+        return cls(arrays, meta['metric'])
+
+
+def exact_search(embeddings, queries, k=10, metric='ip', batch_size=1024):
+    """ Exact k nearest items of each query, see IVFIndex.search()
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    norms = (embeddings ** 2).sum(axis=1)
+    ids, scores = [], []
+    for start in range(0, len(queries), batch_size):
+        batch = _scores(queries[start:start + batch_size], embeddings,
+                        norms, metric)
+        idx = _topk(batch, k)
+        ids.append(idx)
+        scores.append(batch[np.arange(len(idx))[:, None], idx])
+    return np.vstack(ids), np.vstack(scores)
@@ -0,0 +1,144 @@
+""" Memory-mapped arena of tuples and image lists shared by processes.
+    The arena is written once, and every process maps the same files, so
+    the pages are shared through the page cache and memory does not grow
+    with the number of loader processes. Put the arena on /dev/shm to keep
+    it in memory.
+    Usage
+    -----
+    >> handle = DataFile(tuple_dir, list_dir).export_arena('/dev/shm/polyvore')
+    >> # pass handle to workers, e.g. as an argument of multiprocessing.Pool
+    >> arena = handle.attach()
+    >> posi, nega = arena.get_tuples('train')
+    >> arena.image_list[0][i]
+"""
+import os
+import json
+import numpy as np
+from . import config as cfg
+
+# format of the arena files, arenas of other versions are rewritten
+ArenaVersion = 2
+
+
+class ImageNames(object):
+    """ Read-only list of image names stored as one utf-8 blob and offsets,
+        names are str as in DataFile.image_list, decoded when they are
+        accessed on python 3.
+    """
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[n] for n in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('image index out of range')
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        name = self._blob[start:end].tobytes()
+        # the type of names read by DataFile, str of either python
+        return name if str is bytes else name.decode('utf-8')
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+class ArenaHandle(object):
+    """ Picklable handle of an arena, which is cheap to send to workers
+    """
+    def __init__(self, arena_dir):
+        self.arena_dir = arena_dir
+
+    def attach(self):
+        return Arena(self.arena_dir)
+
+
+class Arena(object):
+    """ Memory-mapped tuples and image lists of an arena
+        Members
+        -------
+        image_list: ImageNames for each category
+        Methods
+        -------
+        get_tuples(phase, repeated=True): see DataFile.get_tuples()
+    """
+    def __init__(self, arena_dir):
+        self.arena_dir = arena_dir
+        self._image_list = None
+
+    def _load(self, name):
+        return np.load(os.path.join(self.arena_dir, name + '.npy'),
+                       mmap_mode='r')
+
+    @property
+    def image_list(self):
+        if self._image_list is None:
+            self._image_list = [
+                ImageNames(self._load('names_' + cate),
+                           self._load('offsets_' + cate))
+                for cate in cfg.ClassName]
+        return self._image_list
+
+    def get_tuples(self, phase, repeated=True):
+        """ Positive and negative tuples of phase, as read-only views of the
+            arena. If repeated, positive tuples are repeated into a private
+            array as DataFile.get_tuples() does, use repeated=False to avoid
+            the copy.
+        """
+        assert phase in cfg.PhaseIdx
+        posi_tpls = self._load('tuples_{}_posi'.format(phase))
+        nega_tpls = self._load('tuples_{}_nega'.format(phase))
+        if repeated:
+            ratio = len(nega_tpls) // max(len(posi_tpls), 1)
+            posi_tpls = posi_tpls.repeat(ratio, axis=0)
+        return posi_tpls, nega_tpls
+
+
+def export_arena(datafile, arena_dir, signatures):
+    """ Write tuples of all phases and image lists of datafile to arena_dir,
+        unless the arena of the same ArenaVersion was exported from tuple
+        files of the same signatures.
+        Parameters
+        ----------
+        datafile: DataFile
+        arena_dir: where to save the arena
+        signatures: signatures of the source files, see file_signature()
+        Return
+        ------
+        handle: ArenaHandle
+    """
+    meta_fn = os.path.join(arena_dir, 'arena.json')
+    if os.path.isfile(meta_fn):
+        with open(meta_fn, 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') == ArenaVersion and \
+                meta['signatures'] == signatures:
+            return ArenaHandle(arena_dir)
+        os.remove(meta_fn)
+    if not os.path.isdir(arena_dir):
+        os.makedirs(arena_dir)
+    for phase in cfg.Phase:
+        posi_tpls, nega_tpls = datafile.get_tuples(phase, repeated=False)
+        for kind, tuples in [('posi', posi_tpls), ('nega', nega_tpls)]:
+            # int64 as DataFile.get_tuples(), so views need no cast
+            np.save(os.path.join(arena_dir, 'tuples_{}_{}.npy'.format(
+                phase, kind)), tuples.astype(np.int64))
+    for cate, names in zip(cfg.ClassName, datafile.image_list):
+        encoded = [name.encode('utf-8') if not isinstance(name, bytes)
+                   else name for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        np.save(os.path.join(arena_dir, 'names_{}.npy'.format(cate)), blob)
+        np.save(os.path.join(arena_dir, 'offsets_{}.npy'.format(cate)),
+                offsets)
+    # write meta last, so an arena is complete if its meta exists
+    with open(meta_fn, 'w') as f:
+        json.dump({'version': ArenaVersion, 'signatures': signatures}, f)
+    return ArenaHandle(arena_dir)
@@ -0,0 +1,261 @@
+""" Benchmark the kit on synthetic data at several scales.
+    Usage
+    -----
+    python -m utils.benchmark --scales 50 200 800 --output bench.json
+    python -m utils.benchmark --scales --retrieval 100 200 400
+    python -m utils.benchmark --scales --ann 10000 100000
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from . import config as cfg
+from .instrument import Recorder
+from .synthetic import make_raw
+from .polyvore import polyvore_parser, concise_sets, polyvore_spliter, Dataset
+from .data_utils import DataFile
+from .metric import group_by_user, flat_ndcg_score, split_by_user
+from .metric import mean_ndcg_score
+from .retrieval import OutfitScorer, topk_outfits, brute_force_topk
+from .ann import IVFIndex, exact_search
+
+
+def bench_pipeline(workdir, num_users, sets_per_user=60, skew=1.,
+                   overlap=0.1, min_size=(20, 5, 5), pipelined=False,
+                   seed=0):
+    """ Run the whole pipeline on synthetic data of num_users users.
+        Return
+        ------
+        records: Pairs of {stage: record}, see instrument.Recorder
+    """
+    recorder = Recorder()
+    raw_dir = os.path.join(workdir, 'raw')
+    out_dir = os.path.join(workdir, 'processed')
+    list_dir = os.path.join(out_dir, 'image_list')
+    tuple_dir = os.path.join(out_dir, 'tuples')
+    with recorder.stage('make_raw'):
+        make_raw(raw_dir, num_users, sets_per_user, skew, overlap, seed=seed)
+    with recorder.stage('polyvore_parser.run'):
+        parser = polyvore_parser(raw_dir)
+        parser.run(pipelined)
+    with recorder.stage('concise_sets.run'):
+        sets = concise_sets(parser.fashion_sets).run(sum(min_size))
+    del parser
+    with recorder.stage('polyvore_spliter.run'):
+        spliter = polyvore_spliter(sets, list(min_size), seed)
+        spliter.run(usize=max(1, len(sets) // 10))
+    spliter.save_list(list_dir)
+    dataset = Dataset(spliter.get_datesets(False))
+    with recorder.stage('Dataset.run'):
+        dataset.run()
+    with recorder.stage('Dataset.save'):
+        dataset.save(tuple_dir)
+    with recorder.stage('DataFile.get_tuples'):
+        datafile = DataFile(tuple_dir, list_dir)
+        posi, nega = datafile.get_tuples('test', repeated=False)
+    # random scores for each user
+    random = np.random.RandomState(seed)
+    scores = random.rand(len(posi) + len(nega))
+    with recorder.stage('group_by_user'):
+        users, y_score, y_label, offsets = group_by_user(posi, nega, scores)
+    with recorder.stage('flat_ndcg_score'):
+        flat_ndcg_score(y_score, y_label, offsets)
+    # the same scores through the user-facing function
+    u_scores = split_by_user(y_score, offsets)
+    u_labels = split_by_user(y_label, offsets)
+    with recorder.stage('mean_ndcg_score'):
+        mean_ndcg_score(u_scores, u_labels)
+    return OrderedDict((record['name'], record)
+                       for record in recorder.records)
+
+
+def bench_retrieval(num_items, dim=32, k=10, num_users=5, seed=0):
+    """ Compare topk_outfits() with brute_force_topk() on a random catalog
+        of num_items items in each category.
+        Return
+        ------
+        result: {'num_items', 'exact_seconds', 'brute_seconds',
+                 'outfits_scored': fraction of outfits scored by
+                 topk_outfits(), 'matched': whether the scores agree}
+    """
+    random = np.random.RandomState(seed)
+    item_embs = [random.randn(num_items, dim) / np.sqrt(dim)
+                 for _ in range(cfg.NumCate)]
+    result = {'num_items': num_items, 'exact_seconds': 0.,
+              'brute_seconds': 0., 'outfits_scored': 0., 'matched': True}
+    for _ in range(num_users):
+        scorer = OutfitScorer(item_embs, random.randn(dim))
+        stats = {}
+        start = time.time()
+        _, scores = topk_outfits(scorer, k, stats=stats)
+        result['exact_seconds'] += time.time() - start
+        start = time.time()
+        _, brute_scores = brute_force_topk(scorer, k)
+        result['brute_seconds'] += time.time() - start
+        result['outfits_scored'] += 1. * stats['outfits'] / (
+            num_items ** cfg.NumCate * num_users)
+        result['matched'] &= bool(np.allclose(scores, brute_scores))
+    return result
+
+
+def format_retrieval(results):
+    lines = ['{:<12}{:>14}{:>14}{:>10}{:>10}'.format(
+        'items', 'exact', 'brute force', 'scored', 'matched')]
+    for r in results:
+        lines.append('{:<12}{:>14}{:>14}{:>10}{:>10}'.format(
+            r['num_items'], '{:.3f}s'.format(r['exact_seconds']),
+            '{:.3f}s'.format(r['brute_seconds']),
+            '{:.2%}'.format(r['outfits_scored']), str(r['matched'])))
+    return '\n'.join(lines)
+
+
+def bench_ann(num_items, dim=32, k=10, nprobes=(1, 4, 16, 64),
+              num_queries=1000, seed=0):
+    """ Recall and latency of IVFIndex for each nprobe, against
+        exact_search() on clustered random embeddings.
+        Return
+        ------
+        result: {'num_items', 'build_seconds', 'exact_seconds',
+                 'nprobe': [{'nprobe', 'seconds', 'recall'}]}
+    """
+    random = np.random.RandomState(seed)
+    centers = random.randn(max(num_items // 100, 1), dim)
+    embeddings = centers[random.randint(len(centers), size=num_items)] + \
+        0.5 * random.randn(num_items, dim)
+    queries = embeddings[random.randint(num_items, size=num_queries)] + \
+        0.1 * random.randn(num_queries, dim)
+    start = time.time()
+    index = IVFIndex.build(embeddings)
+    result = {'num_items': num_items, 'build_seconds': time.time() - start}
+    start = time.time()
+    exact_ids, _ = exact_search(embeddings, queries, k)
+    result['exact_seconds'] = time.time() - start
+    result['nprobe'] = []
+    for nprobe in nprobes:
+        start = time.time()
+        ids, _ = index.search(queries, k, nprobe)
+        seconds = time.time() - start
+        recall = np.mean([len(np.intersect1d(a, b)) for a, b in
+                          zip(ids, exact_ids)]) / k
+        result['nprobe'].append({'nprobe': nprobe, 'seconds': seconds,
+                                 'recall': recall})
+    return result
+
+
+def format_ann(results):
+    lines = ['{:<12}{:>8}{:>12}{:>12}{:>10}'.format(
+        'items', 'nprobe', 'ivf', 'exact', 'recall')]
+    for r in results:
+        for probe in r['nprobe']:
+            lines.append('{:<12}{:>8}{:>12}{:>12}{:>10}'.format(
+                r['num_items'], probe['nprobe'],
+                '{:.3f}s'.format(probe['seconds']),
+                '{:.3f}s'.format(r['exact_seconds']),
+                '{:.2%}'.format(probe['recall'])))
+    return '\n'.join(lines)
+
+
+def _bench_job(args):
+    workdir, num_users, kwargs = args
+    workdir = os.path.join(workdir, 'users{}'.format(num_users))
+    try:
+        return bench_pipeline(workdir, num_users, **kwargs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmarks(scales, workdir=None, **kwargs):
+    """ Run bench_pipeline() for each number of users in scales, each in a
+        new process so that the peak RSS is measured for each scale.
+        Return
+        ------
+        results: list of {'num_users': scale, 'stages': records}
+    """
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix='polyvore-bench-')
+    results = []
+    try:
+        for num_users in scales:
+            pool = multiprocessing.Pool(1)
+            try:
+                records = pool.apply(_bench_job,
+                                     ((workdir, num_users, kwargs),))
+            finally:
+                pool.close()
+                pool.join()
+            results.append({'num_users': num_users, 'stages': records})
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def format_results(results):
+    """ Table of seconds and RSS kept (MB) of each stage at each scale
+    """
+    stages = list(results[0]['stages'])
+    header = '{:<24}'.format('stage') + ''.join(
+        '{:>20}'.format('{} users'.format(r['num_users'])) for r in results)
+    lines = [header]
+    for stage in stages:
+        line = '{:<24}'.format(stage)
+        for r in results:
+            record = r['stages'][stage]
+            # memory kept by the stage, peak_rss is the peak of the process
+            rss = record['rss_delta']
+            rss = '-' if rss is None else '{:+.0f}MB'.format(rss / 2. ** 20)
+            line += '{:>20}'.format('{:.3f}s {}'.format(
+                record['seconds'], rss))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark polyvore-kit on synthetic data')
+    parser.add_argument('--scales', type=int, nargs='*',
+                        default=[50, 200, 800], help='numbers of users')
+    parser.add_argument('--sets-per-user', type=int, default=60)
+    parser.add_argument('--skew', type=float, default=1.)
+    parser.add_argument('--overlap', type=float, default=0.1)
+    parser.add_argument('--pipelined', action='store_true',
+                        help='parse items and sets in one pass')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None,
+                        help='where to write synthetic data')
+    parser.add_argument('--retrieval', type=int, nargs='*', default=[],
+                        help='numbers of items in each category to '
+                             'benchmark top-k outfit retrieval')
+    parser.add_argument('--ann', type=int, nargs='*', default=[],
+                        help='numbers of items to benchmark the nearest '
+                             'neighbour index')
+    parser.add_argument('--output', default=None,
+                        help='save results as JSON')
+    args = parser.parse_args()
+    results = {}
+    if args.scales:
+        results['pipeline'] = run_benchmarks(
+            args.scales, args.workdir, sets_per_user=args.sets_per_user,
+            skew=args.skew, overlap=args.overlap, pipelined=args.pipelined,
+            seed=args.seed)
+        print (format_results(results['pipeline']))
+    if args.retrieval:
+        results['retrieval'] = [bench_retrieval(n, seed=args.seed)
+                                for n in args.retrieval]
+        print (format_retrieval(results['retrieval']))
+    if args.ann:
+        results['ann'] = [bench_ann(n, seed=args.seed) for n in args.ann]
+        print (format_ann(results['ann']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import hashlib
 
 
 def check_dirs(folders, action='check', verbose=True):
@@ -57,3 +58,19 @@ def list_files(folder, suffix):
     """ List all files in with given suffix
     """
     return [f for f in os.listdir(folder) if f.endswith(suffix)]
+
+
+def image_file_name(url):
+    """ Name of a downloaded image, the sha1 of its url as in the crawled data
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest() + '.jpg'
+
+
+def file_checksum(path):
+    """ md5 checksum of a file as recorded by the crawler
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
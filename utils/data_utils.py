@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import pandas as pd
 import numpy as np
 try:
@@ -7,6 +9,9 @@ except ImportError:
     import pickle
 
 from . import config as cfg
+from .inverted_index import InvertedIndex
+from .ann import IVFIndex
+from .arena import export_arena
 
 
 def load_pkl(pkl_dir='/data/polyvore/processed/pickles'):
@@ -23,6 +28,107 @@ def load_pkl(pkl_dir='/data/polyvore/processed/pickles'):
     return sets, items
 
 
+# a price like '$45', '$ 1,234.50', 'US$45', '45 USD', '$20 - $30' or
+# '\u20ac 99,95'
+_price_pattern = (
+    u'^\\s*(?P<prefix>[^\\d\\s.,]*)\\s*(?P<low>\\d[\\d,]*(?:\\.\\d+)?)'
+    u'(?:\\s*(?:-|\u2013|to)\\s*[^\\d\\s.,]*\\s*'
+    u'(?P<high>\\d[\\d,]*(?:\\.\\d+)?))?\\s*(?P<suffix>[^\\d\\s.,]*)')
+
+
+def _to_number(numbers):
+    """ Numbers of the price pattern to floats. A comma followed by two
+        digits at the end is a decimal comma if there is no '.', other
+        commas separate thousands.
+    """
+    decimal = numbers.str.match(u'^[\\d,]*,\\d{2}$').fillna(False)
+    numbers = numbers.where(~decimal.astype(bool),
+                            numbers.str.replace(u',(\\d{2})$', u'.\\1'))
+    return pd.to_numeric(numbers.str.replace(u',', u''), errors='coerce')
+
+
+def parse_prices(prices):
+    """ Parse price strings with one vectorized regex pass
+        Parameters
+        ----------
+        prices: list of price strings, e.g. item_info['price']
+        Return
+        ------
+        values: float32 array, the midpoint for a range of prices, nan if
+                the price can not be parsed
+        currencies: array of currency symbols or codes, e.g. '$', 'USD',
+                    empty if unknown
+    """
+    matches = pd.Series(prices, dtype=object).str.extract(
+        _price_pattern, expand=True)
+    low = _to_number(matches['low'])
+    high = _to_number(matches['high'])
+    values = np.where(high.notnull(), (low + high) / 2., low)
+    currencies = matches['prefix'].where(
+        matches['prefix'].str.len() > 0, matches['suffix']).fillna(u'')
+    return values.astype(np.float32), np.array(currencies, dtype='U')
+
+
+def image_list_sha1(image_list):
+    """ sha1 of the image lists, to key results computed for them
+    """
+    return hashlib.sha1(u'\n'.join(
+        u'\t'.join(images) for images in image_list).encode(
+            'utf-8')).hexdigest()
+
+
+def save_prices(fashion_items, image_list, outdir):
+    """ Save parsed prices of items in image_list as price_{cate}.npy and
+        currency_{cate}.npy, the i-th value is that of image_list[n][i].
+        The sha1 of image_list is saved in prices.json.
+    """
+    for n, cate in enumerate(cfg.ClassName):
+        prices = [fashion_items[name]['price'] if name in fashion_items
+                  else u'' for name in image_list[n]]
+        values, currencies = parse_prices(prices)
+        np.save(os.path.join(outdir, 'price_{}.npy'.format(cate)), values)
+        np.save(os.path.join(outdir, 'currency_{}.npy'.format(cate)),
+                currencies)
+    with open(os.path.join(outdir, 'prices.json'), 'w') as f:
+        json.dump({'image_list': image_list_sha1(image_list)}, f)
+
+
+# pairs of categories for item-item co-occurrence
+CatePairs = [(0, 1), (1, 2), (0, 2)]
+
+
+def count_matrix(rows, cols, shape):
+    """ Sparse matrix of the number of times each (row, col) occurs
+        Return
+        ------
+        matrix: scipy.sparse.csr_matrix of int64 counts, sorted indices
+    """
+    from scipy import sparse
+    num_rows, num_cols = shape
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    codes, counts = np.unique(rows * num_cols + cols, return_counts=True)
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes // num_cols, minlength=num_rows),
+              out=indptr[1:])
+    return sparse.csr_matrix((counts, codes % num_cols, indptr), shape=shape)
+
+
+def shard_file(outdir, phase, kind, shard, num_shards):
+    """ File of shard-th shard of tuples, kind is 'posi' or 'nega'
+    """
+    return os.path.join(outdir, 'tuples_{}_{}-{:05d}-of-{:05d}'.format(
+        phase, kind, shard, num_shards))
+
+
+def file_signature(fn):
+    """ Size and modification time of a file, to tell whether results
+        computed from it are stale
+    """
+    stat = os.stat(fn)
+    return [stat.st_size, stat.st_mtime]
+
+
 class DataFile(object):
     """ Class DataFile(data_dir):
         Members
@@ -34,7 +140,17 @@ class DataFile(object):
         image_list: image list for each category
         Methods
         -------
-        get_tuples(phase, repeated=True): Return postive and negative tuples
+        get_tuples(phase, repeated=True, shard=None, num_shards=None):
+            Return postive and negative tuples, of one shard of users if
+            shard is given
+        get_index(phase): Return inverted index of positive tuples
+        get_user_item(phase): Return user-item count matrices
+        get_item_item(phase): Return item-item co-occurrence matrices
+        get_ann_index(cate): Return nearest neighbour index of items
+        get_text_features(pkl_dir): Return TF-IDF features of items
+        get_prices(pkl_dir=None): Return parsed prices of items
+        export_arena(arena_dir=None): Share tuples and image lists with
+            other processes, see utils.arena
     """
     def __init__(self, tuple_dir, list_dir):
         tuple_dir = os.path.abspath(tuple_dir)
@@ -42,47 +158,280 @@ class DataFile(object):
         self._tpldir = tuple_dir
         self._listdir = list_dir
         self._image_list = self._load_image_list(list_dir)
+        self._indexes = {}
+        self._matrices = {}
 
     @property
     def image_list(self):
         return self._image_list
 
+    def _image_list_files(self, data_dir):
+        files = []
+        for cate in cfg.ClassName:
+            fn = os.path.join(data_dir, 'image_list_{}'.format(cate))
+            if not os.path.isfile(fn):
+                # polyvore_spliter.save_list() names them with '.txt'
+                fn += '.txt'
+            files.append(fn)
+        return files
+
     def _load_image_list(self, data_dir):
         """ Read image list for each category
         """
-        image_list_fn = ['image_list_{}'.format(cate)
-                         for cate in cfg.ClassName]
         image_list = [list() for i in range(cfg.NumCate)]
-        for n in range(cfg.NumCate):
-            with open(os.path.join(data_dir, image_list_fn[n]), 'r') as f:
+        for n, fn in enumerate(self._image_list_files(data_dir)):
+            with open(fn, 'r') as f:
                 for line in f:
                     image_list[n].append(line.strip('\n'))
         return image_list
 
-    def get_tuples(self, phase, repeated=True):
+    def get_tuples(self, phase, repeated=True, shard=None, num_shards=None):
         """ open tuples file for given phase and return two tuples
             Parameter
             ---------
             phase: tuple for given phase
+            shard: read only the tuples of shard-th shard of users, which
+                   are saved by Dataset.save(outdir, num_shards)
+            num_shards: number of shards, which must be the number of saved
+                        shards
             Return
             ------
             positive_tuples: shape of (N, 4) or (N * ratio, 4) if repeated
             negative_tuples: shape of (N * ratio, 4)
             ratio: repeated times
         """
-        idx = cfg.PhaseIdx[phase]
-        posi_tpl_file = ['{}/tuples_{}_posi'.format(self._tpldir, p)
-                         for p in cfg.Phase]
-        nega_tpl_file = ['{}/tuples_{}_nega'.format(self._tpldir, p)
-                         for p in cfg.Phase]
-        posi_fn = posi_tpl_file[idx]
-        nega_fn = nega_tpl_file[idx]
-        posi_tpls = np.array(pd.read_csv(posi_fn))
-        nega_tpls = np.array(pd.read_csv(nega_fn))
+        if shard is None:
+            posi_tpls = self._read_tuples(phase, 'posi')
+            nega_tpls = self._read_tuples(phase, 'nega')
+        else:
+            manifest = self.get_manifest()
+            if num_shards is not None and \
+                    num_shards != manifest['num_shards']:
+                raise ValueError('{} shards are saved, not {}'.format(
+                    manifest['num_shards'], num_shards))
+            posi_tpls = self._read_shard(phase, 'posi', shard)
+            nega_tpls = self._read_shard(phase, 'nega', shard)
         # reshape
         num_posi = posi_tpls.shape[0]
         num_nega = nega_tpls.shape[0]
-        ratio = num_nega / num_posi
+        ratio = num_nega / max(num_posi, 1)
         if repeated:
             posi_tpls = posi_tpls.repeat(ratio, axis=0)
         return posi_tpls, nega_tpls
+
+    def _tuple_file(self, phase, kind):
+        """ Tuple file of phase, kind is 'posi' or 'nega'
+        """
+        assert phase in cfg.PhaseIdx
+        return '{}/tuples_{}_{}'.format(self._tpldir, phase, kind)
+
+    def _read_tuples(self, phase, kind):
+        fn = self._tuple_file(phase, kind)
+        if not os.path.isfile(fn) and os.path.isfile(self._manifest_file()):
+            # only shards are saved
+            num_shards = self.get_manifest()['num_shards']
+            return np.vstack([self._read_shard(phase, kind, n)
+                              for n in range(num_shards)])
+        return np.array(pd.read_csv(fn))
+
+    def _manifest_file(self):
+        return os.path.join(self._tpldir, 'manifest.json')
+
+    def get_manifest(self):
+        """ Manifest of shards saved by Dataset.save(outdir, num_shards)
+        """
+        with open(self._manifest_file(), 'r') as f:
+            return json.load(f)
+
+    def _tuple_signature(self, phase, kind):
+        """ Signature of the tuples of phase, that of the tuple file, or
+            of the manifest and every shard file if only shards are saved
+            Return
+            ------
+            signature: flat list of sizes and modification times
+        """
+        fn = self._tuple_file(phase, kind)
+        if os.path.isfile(fn) or not os.path.isfile(self._manifest_file()):
+            return file_signature(fn)
+        num_shards = self.get_manifest()['num_shards']
+        signature = file_signature(self._manifest_file())
+        for n in range(num_shards):
+            signature += file_signature(
+                shard_file(self._tpldir, phase, kind, n, num_shards))
+        return signature
+
+    def _read_shard(self, phase, kind, shard):
+        num_shards = self.get_manifest()['num_shards']
+        fn = shard_file(self._tpldir, phase, kind, shard, num_shards)
+        return np.array(pd.read_csv(fn))
+
+    def get_index(self, phase):
+        """ Inverted index from items to positive tuples and users.
+            The index is built on the first call, saved next to the tuple
+            files and rebuilt when the positive tuples (their file, or the
+            manifest and shard files) change.
+            Return
+            ------
+            index: InvertedIndex with memory-mapped arrays, e.g.
+                   index.outfits(cate, item) are the rows of
+                   get_tuples(phase, repeated=False)[0] with item in
+                   category cate
+        """
+        signature = self._tuple_signature(phase, 'posi')
+        index = self._indexes.get(phase)
+        if index is not None and index[0] == signature:
+            return index[1]
+        if InvertedIndex.signature(self._tpldir, phase) != signature:
+            posi_tpls = self._read_tuples(phase, 'posi')
+            num_items = [len(image_list) for image_list in self._image_list]
+            InvertedIndex.build(posi_tpls, num_items).save(
+                self._tpldir, phase, signature)
+        index = InvertedIndex.load(self._tpldir, phase)
+        self._indexes[phase] = (signature, index)
+        return index
+
+    def _matrix_names(self):
+        names = ['user_' + cate for cate in cfg.ClassName]
+        names += ['{}_{}'.format(cfg.ClassName[m], cfg.ClassName[n])
+                  for m, n in CatePairs]
+        return names
+
+    def _build_matrices(self, posi_tpls):
+        num_users = int(posi_tpls[:, 0].max()) + 1 if len(posi_tpls) else 0
+        num_items = [len(image_list) for image_list in self._image_list]
+        matrices = []
+        for n in range(cfg.NumCate):
+            matrices.append(count_matrix(
+                posi_tpls[:, 0], posi_tpls[:, n + 1],
+                (num_users, num_items[n])))
+        for m, n in CatePairs:
+            matrices.append(count_matrix(
+                posi_tpls[:, m + 1], posi_tpls[:, n + 1],
+                (num_items[m], num_items[n])))
+        return dict(zip(self._matrix_names(), matrices))
+
+    def _get_matrices(self, phase):
+        """ Count matrices of phase, cached in memory and in
+            matrices_{phase}.npz next to the tuple files
+        """
+        from scipy import sparse
+        signature = self._tuple_signature(phase, 'posi')
+        cached = self._matrices.get(phase)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        fn = os.path.join(self._tpldir, 'matrices_{}.npz'.format(phase))
+        matrices = None
+        if os.path.isfile(fn):
+            with np.load(fn) as data:
+                if list(data['signature']) == signature:
+                    matrices = dict(
+                        (name, sparse.csr_matrix(
+                            (data[name + '_data'], data[name + '_indices'],
+                             data[name + '_indptr']),
+                            shape=tuple(data[name + '_shape'])))
+                        for name in self._matrix_names())
+        if matrices is None:
+            matrices = self._build_matrices(self._read_tuples(phase, 'posi'))
+            arrays = {'signature': np.array(signature, dtype=np.float64)}
+            for name, matrix in matrices.items():
+                arrays[name + '_data'] = matrix.data
+                arrays[name + '_indices'] = matrix.indices
+                arrays[name + '_indptr'] = matrix.indptr
+                arrays[name + '_shape'] = np.array(matrix.shape)
+            np.savez(fn, **arrays)
+        self._matrices[phase] = (signature, matrices)
+        return matrices
+
+    def get_user_item(self, phase='train'):
+        """ Number of positive tuples of each user with each item
+            Return
+            ------
+            matrices: list of scipy.sparse.csr_matrix of shape
+                      (num_users, num_items), one for each category
+        """
+        matrices = self._get_matrices(phase)
+        return [matrices['user_' + cate] for cate in cfg.ClassName]
+
+    def get_item_item(self, phase='train'):
+        """ Number of positive tuples with each pair of items
+            Return
+            ------
+            matrices: pairs of {(m, n): scipy.sparse.csr_matrix} for (m, n)
+                      in CatePairs, the matrix is of shape
+                      (num_items[m], num_items[n]), e.g. (0, 1) for
+                      top-bottom co-occurrence
+        """
+        matrices = self._get_matrices(phase)
+        return dict(((m, n), matrices['{}_{}'.format(
+            cfg.ClassName[m], cfg.ClassName[n])]) for m, n in CatePairs)
+
+    def get_ann_index(self, cate, mmap_mode='r'):
+        """ Nearest neighbour index of items in category cate (e.g. 'top'),
+            saved in the image list folder by IVFIndex.save(list_dir, cate).
+            Ids of the index are positions in image_list.
+        """
+        return IVFIndex.load(self._listdir, cate, mmap_mode)
+
+    def get_text_features(self, pkl_dir, min_df=5, max_features=20000,
+                          num_workers=None):
+        """ TF-IDF features of items aligned to image_list, cached in the
+            image list folder, see text_features.load_text_features()
+            Return
+            ------
+            features: list of scipy.sparse.csr_matrix for each category,
+                      the i-th row is the feature of image_list[n][i]
+            vocab: list of tokens for the columns
+        """
+        from .text_features import load_text_features
+        return load_text_features(pkl_dir, self._image_list, self._listdir,
+                                  min_df, max_features, num_workers)
+
+    def get_prices(self, pkl_dir=None, mmap_mode='r'):
+        """ Prices of items aligned to image_list, saved in the image list
+            folder by save_prices(), which is run if pkl_dir is given and
+            the prices have not been saved for the current image_list.
+            Return
+            ------
+            prices: list of float32 arrays for each category, nan for
+                    unknown prices
+            currencies: list of arrays of currency for each category
+        """
+        fns = [os.path.join(self._listdir, '{}_{}.npy'.format(name, cate))
+               for name in ['price', 'currency'] for cate in cfg.ClassName]
+        meta_fn = os.path.join(self._listdir, 'prices.json')
+        saved = None
+        if os.path.isfile(meta_fn) and all(
+                os.path.isfile(fn) for fn in fns):
+            with open(meta_fn, 'r') as f:
+                saved = json.load(f)['image_list']
+        if saved != image_list_sha1(self._image_list):
+            if pkl_dir is None:
+                raise IOError('prices are not saved in {} for the current '
+                              'image list'.format(self._listdir))
+            _, items = load_pkl(pkl_dir)
+            save_prices(items, self._image_list, self._listdir)
+        prices = [np.load(fn, mmap_mode=mmap_mode)
+                  for fn in fns[:cfg.NumCate]]
+        currencies = [np.load(fn) for fn in fns[cfg.NumCate:]]
+        return prices, currencies
+
+    def export_arena(self, arena_dir=None):
+        """ Write tuples and image lists to a memory-mapped arena, which
+            worker processes attach to without copies. The arena is only
+            rewritten when the tuple files or image lists change.
+            Parameter
+            ---------
+            arena_dir: where to save the arena, {tuple_dir}/arena if None,
+                       a folder in /dev/shm keeps it in memory
+            Return
+            ------
+            handle: picklable ArenaHandle, handle.attach() in a worker
+                    returns an Arena with get_tuples() and image_list
+        """
+        if arena_dir is None:
+            arena_dir = os.path.join(self._tpldir, 'arena')
+        signatures = [self._tuple_signature(phase, kind)
+                      for phase in cfg.Phase for kind in ['posi', 'nega']]
+        signatures += [file_signature(fn)
+                       for fn in self._image_list_files(self._listdir)]
+        return export_arena(self, arena_dir, signatures)
@@ -0,0 +1,257 @@
+""" Fetch the images that failed to download during the crawl.
+    Usage
+    -----
+    >> parser = utils.polyvore.polyvore_parser('~/data/polyvore/raw')
+    >> parser.parse_items()
+    >> downloader = utils.downloader.ImageDownloader(parser.image_dir)
+    >> report = downloader.run(parser.failed_images)
+    >> parser.parse_items() # fetched images are picked up
+"""
+import os
+import time
+import threading
+from .check_utils import check_dir, image_file_name
+from .instrument import recorder
+from .progress import ProgressBar
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    import urllib2 as _request
+    from urllib2 import HTTPError
+    from urlparse import urlparse
+    from httplib import HTTPException
+except ImportError:
+    import urllib.request as _request
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
+    from http.client import HTTPException
+
+# HTTP errors worth retrying, other 4xx errors are permanent
+RetryCodes = (408, 429)
+
+
+class HostLimiter(object):
+    """ Bound the number of open connections and the rate of requests to
+        each host.
+        Constructor
+        -----------
+        HostLimiter(connections, rate)
+            connections: maximum number of connections to each host
+            rate: maximum requests per second to each host, None for no limit
+        Usage
+        -----
+        limiter.acquire(host)
+        # request
+        limiter.release(host)
+    """
+    def __init__(self, connections=4, rate=None):
+        self.connections = connections
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        # the earliest time of next request to each host
+        self._next_time = {}
+
+    def acquire(self, host):
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.Semaphore(self.connections)
+                self._semaphores[host] = semaphore
+        semaphore.acquire()
+        if self.rate:
+            with self._lock:
+                now = time.time()
+                slot = max(now, self._next_time.get(host, now))
+                self._next_time[host] = slot + 1. / self.rate
+            if slot > now:
+                time.sleep(slot - now)
+
+    def release(self, host):
+        self._semaphores[host].release()
+
+
+class ImageDownloader(object):
+    """ Download images with a pool of threads, with per-host limits,
+        retries with exponential backoff, and resume of partial downloads.
+        Images are saved as {image_dir}/{user}/{sub_dir}/{sha1 of url}.jpg,
+        so polyvore_parser.check_download() finds them.
+        Constructor
+        -----------
+        ImageDownloader(image_dir, num_workers=8, connections=4, rate=None,
+                        retries=3, backoff=1., timeout=30., opener=None)
+            image_dir: images folder of the raw data, see polyvore_parser
+            num_workers: number of downloading threads
+            connections: maximum number of connections to each host
+            rate: maximum requests per second to each host
+            retries: number of retries after a failed attempt
+            backoff: seconds before the first retry, doubled for each retry
+            timeout: socket timeout in seconds
+            opener: urllib2 opener, e.g. with a ProxyHandler
+        Methods
+        -------
+        jobs(failed_images): (url, path) of images to download
+        fetch(url, path): Download one image
+        run(failed_images): Download all failed images
+    """
+    # size of each read from a response
+    chunk_size = 1 << 16
+    user_agent = 'polyvore-kit'
+
+    def __init__(self, image_dir, num_workers=8, connections=4, rate=None,
+                 retries=3, backoff=1., timeout=30., opener=None):
+        self.image_dir = image_dir
+        self.num_workers = num_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = HostLimiter(connections, rate)
+        self.opener = opener if opener is not None else _request.build_opener()
+        # retries of all fetch() calls, counted here since fetch() runs in
+        # worker threads
+        self.num_retries = 0
+        self._lock = threading.Lock()
+
+    def jobs(self, failed_images):
+        """ Images to download
+            Parameters
+            ----------
+            failed_images: see polyvore_parser.parse_items()
+            Return
+            ------
+            jobs: list of (url, path), one for each image
+        """
+        jobs = []
+        paths = set()
+        for user in sorted(failed_images):
+            for image_urls, status, sub_dir in failed_images[user]:
+                if len(image_urls) == 0:
+                    continue
+                url = image_urls[0]
+                path = os.path.join(self.image_dir, user, sub_dir,
+                                    image_file_name(url))
+                if path not in paths:
+                    paths.add(path)
+                    jobs.append((url, path))
+        return jobs
+
+    def fetch(self, url, path):
+        """ Download one image to path, a partial download is saved as
+            path.part and resumed by the next attempt.
+            Return
+            ------
+            error: None if succeeded, otherwise the last error
+        """
+        part = path + '.part'
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                self._fetch_once(url, part)
+                os.rename(part, path)
+                return None
+            except HTTPError as e:
+                error = e
+                if e.code == 416 and os.path.exists(part):
+                    # the partial download is broken, start again
+                    os.remove(part)
+                elif e.code < 500 and e.code not in RetryCodes:
+                    break
+            except (EnvironmentError, HTTPException) as e:
+                error = e
+            with self._lock:
+                self.num_retries += 1
+        return error
+
+    def _fetch_once(self, url, part):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        request = _request.Request(url, headers={'User-Agent':
+                                                 self.user_agent})
+        if offset > 0:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        host = urlparse(url).netloc
+        self.limiter.acquire(host)
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+            try:
+                if response.getcode() != 206:
+                    # range is not supported, download the whole image
+                    offset = 0
+                with open(part, 'ab' if offset > 0 else 'wb') as f:
+                    while True:
+                        chunk = response.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                length = response.info().get('Content-Length')
+                if length is not None and \
+                        os.path.getsize(part) != offset + int(length):
+                    raise IOError('incomplete image from {}'.format(url))
+            finally:
+                response.close()
+        finally:
+            self.limiter.release(host)
+
+    @recorder.stage('download_images')
+    def run(self, failed_images):
+        """ Download all failed images, images that exist are skipped.
+            Return
+            ------
+            report: {'downloaded': number of downloaded images,
+                     'existed': number of images that exist,
+                     'failed': pairs of {url: error message}}
+        """
+        report = {'downloaded': 0, 'existed': 0, 'failed': {}}
+        num_retries = self.num_retries
+        jobs = []
+        for url, path in self.jobs(failed_images):
+            if os.path.isfile(path):
+                report['existed'] += 1
+            else:
+                jobs.append((url, path))
+        for folder in set(os.path.dirname(path) for _, path in jobs):
+            check_dir(folder, action='mkdir')
+        job_queue = Queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                try:
+                    url, path = job_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    error = self.fetch(url, path)
+                except Exception as e:
+                    # e.g. ValueError of a malformed url, every job must
+                    # put a result or the loop below waits forever
+                    error = e
+                results.put((url, error))
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(min(self.num_workers, len(jobs)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        progress_bar = ProgressBar(max(len(jobs), 1), 'Downloading images')
+        for _ in range(len(jobs)):
+            url, error = results.get()
+            progress_bar.forward()
+            if error is None:
+                report['downloaded'] += 1
+            else:
+                report['failed'][url] = str(error)
+        progress_bar.end()
+        for worker in workers:
+            worker.join()
+        recorder.count('images_downloaded', report['downloaded'])
+        recorder.count('images_failed', len(report['failed']))
+        recorder.count('retries', self.num_retries - num_retries)
+        print ("{} images are downloaded, {} failed".format(
+            report['downloaded'], len(report['failed'])))
+        return report
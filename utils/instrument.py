@@ -0,0 +1,480 @@
+import os
+import re
+import gc
+import sys
+import json
+import time
+import functools
+import threading
+from collections import Counter
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, see _object_counts()
+    tracemalloc = None
+
+ProfileModes = ['cprofile', 'sample', 'tracemalloc']
+
+
+def peak_rss():
+    """ Peak resident set size of this process so far in bytes, None if
+        unknown. It is the high-water mark since the process started, not
+        the peak of any stage.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS and in kilobytes on Linux
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def current_rss():
+    """ Resident set size of this process now in bytes, None if unknown
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def cpu_time():
+    """ User and system time of this process in seconds
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _object_counts():
+    """ Number and total size of live objects tracked by gc for each type,
+        the allocation summary of python 2 without tracemalloc
+    """
+    counts, sizes = Counter(), Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counts[cls] += 1
+        sizes[cls] += sys.getsizeof(obj, 0)
+    return counts, sizes
+
+
+def _megabytes(size):
+    return 'unknown' if size is None else '{:.1f}MB'.format(size / 2. ** 20)
+
+
+class _Sampler(object):
+    """ Count the stacks of a thread every interval seconds, in a thread
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _Session(object):
+    """ Profilers of one running stage, see Profiler.start()
+    """
+    def __init__(self, profiler, prefix):
+        self.profiler = profiler
+        self.prefix = prefix
+        self.cprofile = None
+        self.sampler = None
+        self.snapshot = None
+        self.objects = None
+        self.rss = None
+        self.started_tracing = False
+
+    def stop(self):
+        """ Stop profilers and write their results
+            Return
+            ------
+            files: list of written files
+        """
+        profiler = self.profiler
+        files = []
+        # before the other profilers allocate to write their results
+        if self.snapshot is not None:
+            files.append(self._write_allocations())
+        if self.objects is not None:
+            files.append(self._write_objects())
+        if self.cprofile is not None:
+            import pstats
+            self.cprofile.disable()
+            profiler.local.active = False
+            fn = self.prefix + '.prof'
+            self.cprofile.dump_stats(fn)
+            with open(self.prefix + '-prof.txt', 'w') as f:
+                stats = pstats.Stats(fn, stream=f)
+                stats.sort_stats('cumulative').print_stats(profiler.top)
+            files += [fn, self.prefix + '-prof.txt']
+        if self.sampler is not None:
+            self.sampler.stop()
+            profiler.local.active = False
+            fn = self.prefix + '.folded'
+            with open(fn, 'w') as f:
+                for stack, count in sorted(self.sampler.counts.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            files.append(fn)
+        return files
+
+    def _write_objects(self):
+        profiler = self.profiler
+        counts, sizes = _object_counts()
+        start_counts, start_sizes = self.objects
+        self.objects = None
+        with profiler.lock:
+            profiler.tracing = False
+        counts.subtract(start_counts)
+        sizes.subtract(start_sizes)
+        types = sorted((cls for cls in counts if counts[cls] > 0),
+                       key=lambda cls: (-sizes[cls], -counts[cls],
+                                        cls.__name__))
+        fn = self.prefix + '-alloc.txt'
+        with open(fn, 'w') as f:
+            f.write('rss: {} at start, {} at end, peak {}\n'.format(
+                _megabytes(self.rss), _megabytes(current_rss()),
+                _megabytes(peak_rss())))
+            f.write('top {} types by growth of live objects tracked by gc '
+                    'during the stage:\n'.format(profiler.top))
+            for cls in types[:profiler.top]:
+                f.write('{}.{}: {:+d} objects, {:+d} bytes\n'.format(
+                    cls.__module__, cls.__name__, counts[cls], sizes[cls]))
+        return fn
+
+    def _write_allocations(self):
+        profiler = self.profiler
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, '<frozen importlib.*>'),
+                   tracemalloc.Filter(False, '<unknown>'))
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+        current, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.compare_to(
+            self.snapshot.filter_traces(ignored), 'lineno')
+        with profiler.lock:
+            if self.started_tracing:
+                tracemalloc.stop()
+            profiler.tracing = False
+        self.snapshot = None
+        fn = self.prefix + '-alloc.txt'
+        with open(fn, 'w') as f:
+            f.write('traced memory: {:.1f}MB, peak {:.1f}MB\n'.format(
+                current / 2. ** 20, peak / 2. ** 20))
+            f.write('top {} allocations by line, growth during the '
+                    'stage:\n'.format(profiler.top))
+            for stat in stats[:profiler.top]:
+                f.write('{}\n'.format(stat))
+        return fn
+
+
+class Profiler(object):
+    """ Profile stages of a Recorder, see Recorder.enable_profiling().
+        A stage is profiled only if no enclosing stage of the same thread
+        is, so the profile of an outer stage includes its inner stages.
+        Modes
+        -----
+        cprofile: deterministic profile of cProfile, saved as
+                  {stage}-{n}.prof for pstats or snakeviz, and its top
+                  functions by cumulative time as {stage}-{n}-prof.txt
+        sample: stacks of the thread sampled every interval seconds by
+                another thread, saved as {stage}-{n}.folded with one
+                'frame;frame;... count' line for each stack, which
+                flamegraph.pl and speedscope read. Its overhead is much
+                lower than cprofile.
+        tracemalloc: top allocations by line during the stage, and the
+                     traced and peak memory, saved as {stage}-{n}-alloc.txt.
+                     Tracing is process wide, so only one stage is traced
+                     at a time. Without tracemalloc (python 2), the file
+                     has the RSS at start and end of the stage, and the
+                     types whose live objects grew the most, counted by gc.
+                     gc only tracks containers (not even dicts or tuples
+                     of atomic values), so strings, numbers and the
+                     buffers of numpy arrays only show in the RSS.
+        Parameters
+        ----------
+        modes: list of modes
+        outdir: where to write profiles
+        stages: names of stages to profile, all stages if None
+        interval: seconds between samples of 'sample'
+        top: number of functions or allocations in summaries
+        frames: number of frames saved for each allocation by tracemalloc
+    """
+    def __init__(self, modes, outdir='profiles', stages=None,
+                 interval=0.005, top=25, frames=1):
+        for mode in modes:
+            assert mode in ProfileModes, 'Unknown mode {}'.format(mode)
+        if 'cprofile' in modes and 'sample' in modes:
+            raise ValueError('Use only one of cprofile and sample')
+        self.modes = list(modes)
+        self.outdir = outdir
+        self.stages = None if stages is None else set(stages)
+        self.interval = interval
+        self.top = top
+        self.frames = frames
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tracing = False
+        self._calls = Counter()
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    def start(self, name):
+        """ Start profiling a stage
+            Return
+            ------
+            session: _Session to stop, None if the stage is not profiled
+        """
+        if self.stages is not None and name not in self.stages:
+            return None
+        session = None
+        with self.lock:
+            self._calls[name] += 1
+            prefix = os.path.join(self.outdir, '{}-{}'.format(
+                re.sub(r'[^\w.-]', '_', name), self._calls[name]))
+            if 'tracemalloc' in self.modes and not self.tracing:
+                self.tracing = True
+                session = _Session(self, prefix)
+                if tracemalloc is not None and \
+                        not tracemalloc.is_tracing():
+                    tracemalloc.start(self.frames)
+                    session.started_tracing = True
+        if session is not None:
+            if tracemalloc is not None:
+                session.snapshot = tracemalloc.take_snapshot()
+            else:
+                session.rss = current_rss()
+                session.objects = _object_counts()
+        active = getattr(self.local, 'active', False)
+        if not active and ('cprofile' in self.modes or
+                           'sample' in self.modes):
+            session = session or _Session(self, prefix)
+            self.local.active = True
+            if 'cprofile' in self.modes:
+                import cProfile
+                session.cprofile = cProfile.Profile()
+                try:
+                    session.cprofile.enable()
+                except ValueError:
+                    # another profiler is running, e.g. in another thread
+                    # since python 3.12
+                    session.cprofile = None
+                    self.local.active = False
+            else:
+                session.sampler = _Sampler(
+                    threading.current_thread().ident, self.interval)
+        return session
+
+
+class Stage(object):
+    """ A named stage of a Recorder, used as a context manager or decorator
+        Usage
+        -----
+        with recorder.stage('parse_items'):
+            # executions
+
+        @recorder.stage('parse_items')
+        def parse_items(self):
+            # executions
+    """
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.recorder._push(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder._pop(exc_type is None)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Stage(self.recorder, self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Recorder(object):
+    """ Record wall time, cpu time, counters and peak RSS of named stages.
+        Usage
+        -----
+        with recorder.stage('parse_items'):
+            recorder.count('items_parsed', num_items)
+        recorder.save('report.json')
+        Members
+        -------
+        records: One dict for each finished stage, in the order they finish
+            {'name': stage name,
+             'parent': name of the enclosing stage or None,
+             'start': seconds since the recorder was created,
+             'seconds': wall time,
+             'cpu_seconds': user and system time,
+             'peak_rss': peak RSS of the process so far at the end of the
+                         stage, in bytes. It is a process-lifetime
+                         high-water mark, so stages after the largest one
+                         all report the same value
+             'rss_growth': how much the stage raised that high-water mark,
+                           0 if it stayed below an earlier peak
+             'rss_start', 'rss_end': current RSS at entry and exit, None
+                                     if unknown (only read on Linux)
+             'rss_delta': rss_end - rss_start, memory the stage kept,
+             'counters': {counter name: value},
+             'throughput': {counter name: value per second},
+             'succeeded': False if the stage raised an exception,
+             'profiles': files written by the profiler, if the stage was
+                         profiled}
+        Stages are nested per thread, so stages may run in several threads.
+        Profiling
+        ---------
+        enable_profiling(modes, outdir) profiles stages, see Profiler. It
+        is disabled by default and then costs one check for each stage.
+        The recorder of the pipeline is also enabled by the environment:
+        POLYVORE_PROFILE: comma separated modes, e.g. 'sample,tracemalloc'
+        POLYVORE_PROFILE_DIR: where to write profiles, 'profiles' by default
+        POLYVORE_PROFILE_STAGES: comma separated stages, e.g.
+                                 'parse_items,split_users,negative_train'
+    """
+    def __init__(self):
+        self.records = []
+        self.profiler = None
+        self._local = threading.local()
+        self._created = time.time()
+
+    @property
+    def _stack(self):
+        # running stages of the current thread, innermost last
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def enable_profiling(self, modes=('sample', ), outdir='profiles',
+                         stages=None, **kwargs):
+        """ Profile stages that start from now on, see Profiler for the
+            parameters
+        """
+        self.profiler = Profiler(modes, outdir, stages, **kwargs)
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def count(self, key, n=1):
+        """ Add n to the counter of the innermost running stage, ignored if
+            no stage is running
+        """
+        if self._stack:
+            counters = self._stack[-1]['counters']
+            counters[key] = counters.get(key, 0) + n
+
+    def reset(self):
+        self.records = []
+        self._local = threading.local()
+        self._created = time.time()
+
+    def summary(self):
+        """ Total seconds, number of calls and counters for each stage name
+        """
+        summary = {}
+        for record in self.records:
+            info = summary.setdefault(
+                record['name'], {'calls': 0, 'seconds': 0., 'counters': {}})
+            info['calls'] += 1
+            info['seconds'] += record['seconds']
+            for key, value in record['counters'].items():
+                info['counters'][key] = info['counters'].get(key, 0) + value
+        return summary
+
+    def report(self):
+        return {'created': time.strftime(
+                    '%Y-%m-%dT%H:%M:%S', time.localtime(self._created)),
+                'peak_rss': peak_rss(),
+                'stages': self.records,
+                'summary': self.summary()}
+
+    def save(self, path):
+        """ Save report() as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def _push(self, name):
+        parent = self._stack[-1]['name'] if self._stack else None
+        self._stack.append({
+            'name': name, 'parent': parent, 'counters': {},
+            'start': time.time() - self._created,
+            '_time': time.time(), '_cpu': cpu_time(), '_rss': peak_rss(),
+            'rss_start': current_rss()})
+        if self.profiler is not None:
+            self._stack[-1]['_profile'] = self.profiler.start(name)
+
+    def _pop(self, succeeded):
+        record = self._stack.pop()
+        seconds = time.time() - record.pop('_time')
+        rss = peak_rss()
+        start_rss = record.pop('_rss')
+        record['seconds'] = seconds
+        record['cpu_seconds'] = cpu_time() - record.pop('_cpu')
+        record['peak_rss'] = rss
+        record['rss_growth'] = None if rss is None else rss - start_rss
+        record['rss_end'] = current_rss()
+        record['rss_delta'] = None if record['rss_start'] is None or \
+            record['rss_end'] is None else \
+            record['rss_end'] - record['rss_start']
+        record['throughput'] = dict(
+            (key, value / seconds if seconds > 0 else None)
+            for key, value in record['counters'].items())
+        record['succeeded'] = succeeded
+        session = record.pop('_profile', None)
+        if session is not None:
+            record['profiles'] = session.stop()
+        self.records.append(record)
+
+
+def profile_from_env(recorder, environ=None):
+    """ Enable profiling of recorder by POLYVORE_PROFILE and related
+        variables, see Recorder
+    """
+    environ = os.environ if environ is None else environ
+    modes = environ.get('POLYVORE_PROFILE', '')
+    modes = [mode.strip() for mode in modes.split(',') if mode.strip()]
+    if not modes:
+        return
+    stages = environ.get('POLYVORE_PROFILE_STAGES')
+    if stages is not None:
+        stages = [stage.strip() for stage in stages.split(',')]
+    recorder.enable_profiling(
+        modes, environ.get('POLYVORE_PROFILE_DIR', 'profiles'), stages)
+
+
+# the recorder used by the preprocessing pipeline
+recorder = Recorder()
+profile_from_env(recorder)
@@ -0,0 +1,143 @@
+import os
+import json
+import numpy as np
+from . import config as cfg
+
+# arrays of the index for each category
+_fields = ['row_ptr', 'rows', 'user_ptr', 'users']
+
+
+def csr_groups(keys, num_keys, values=None):
+    """ Group values by keys in CSR layout
+        Parameters
+        ----------
+        keys: int array of keys in [0, num_keys)
+        num_keys: number of keys
+        values: array of values for each key, np.arange(len(keys)) if None
+        Return
+        ------
+        indptr: array of shape (num_keys + 1, ), values of key k are
+                indices[indptr[k]:indptr[k + 1]]
+        indices: values sorted by keys, in the original order for each key
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+    indptr = np.zeros(num_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=num_keys), out=indptr[1:])
+    if values is None:
+        return indptr, order
+    return indptr, np.asarray(values)[order]
+
+
+class InvertedIndex(object):
+    """ Inverted index from items to the outfits and users that have them.
+        For each category, outfits and users of each item are saved in
+        CSR layout, so a lookup is two array reads.
+        Constructor
+        -----------
+        InvertedIndex.build(tuples, num_items): Build from positive tuples
+        InvertedIndex.load(index_dir, phase, mmap_mode='r'): Load saved one
+        Methods
+        -------
+        outfits(cate, item): Rows of tuples that have the item
+        users(cate, item): Users that have the item in an outfit
+        num_outfits(cate, item): Number of outfits that have the item
+        save(index_dir, phase, signature=None): Save the index
+    """
+    def __init__(self, arrays, num_users):
+        # arrays[n][field]: arrays of n-th category
+        self.arrays = arrays
+        self.num_users = num_users
+
+    @classmethod
+    def build(cls, tuples, num_items, num_users=None):
+        """ Build index from positive tuples
+            Parameters
+            ----------
+            tuples: array of shape (N, NumCate + 1), rows of
+                    (user, top, bottom, shoe), see DataFile.get_tuples()
+            num_items: number of items of each category
+            num_users: number of users, max user + 1 if None
+        """
+        tuples = np.asarray(tuples, dtype=np.int64)
+        users = tuples[:, 0]
+        if num_users is None:
+            num_users = int(users.max()) + 1 if len(users) else 0
+        stride = max(num_users, 1)
+        arrays = []
+        for n in range(cfg.NumCate):
+            items = tuples[:, n + 1]
+            row_ptr, rows = csr_groups(items, num_items[n])
+            # distinct (item, user) pairs, sorted by item then user
+            pairs = np.unique(items * stride + users)
+            user_ptr, item_users = csr_groups(
+                pairs // stride, num_items[n], pairs % stride)
+            arrays.append({'row_ptr': row_ptr, 'rows': rows,
+                           'user_ptr': user_ptr, 'users': item_users})
+        return cls(arrays, num_users)
+
+    @staticmethod
+    def _fn(index_dir, phase, cate, field):
+        return os.path.join(index_dir, 'index_{}_{}_{}.npy'.format(
+            phase, cfg.ClassName[cate], field))
+
+    @staticmethod
+    def _meta_fn(index_dir, phase):
+        return os.path.join(index_dir, 'index_{}.json'.format(phase))
+
+    def save(self, index_dir, phase, signature=None):
+        """ Save arrays as .npy files next to the tuple files
+            Parameters
+            ----------
+            signature: signature of the tuple file the index is built from,
+                       see data_utils.file_signature()
+        """
+        for n in range(cfg.NumCate):
+            for field in _fields:
+                np.save(self._fn(index_dir, phase, n, field),
+                        self.arrays[n][field])
+        # write meta last, so an index is complete if its meta exists
+        with open(self._meta_fn(index_dir, phase), 'w') as f:
+            json.dump({'num_users': self.num_users,
+                       'signature': signature}, f)
+
+    @classmethod
+    def signature(cls, index_dir, phase):
+        """ Signature saved with the index, None if there is no index
+        """
+        fn = cls._meta_fn(index_dir, phase)
+        if not os.path.isfile(fn):
+            return None
+        with open(fn, 'r') as f:
+            return json.load(f)['signature']
+
+    @classmethod
+    def load(cls, index_dir, phase, mmap_mode='r'):
+        with open(cls._meta_fn(index_dir, phase), 'r') as f:
+            meta = json.load(f)
+        arrays = [dict((field, np.load(cls._fn(index_dir, phase, n, field),
+                                       mmap_mode=mmap_mode))
+                       for field in _fields)
+                  for n in range(cfg.NumCate)]
+        return cls(arrays, meta['num_users'])
+
+    def num_items(self, cate):
+        return len(self.arrays[cate]['row_ptr']) - 1
+
+    def outfits(self, cate, item):
+        """ Rows of positive tuples that have item in category cate
+        """
+        arrays = self.arrays[cate]
+        row_ptr = arrays['row_ptr']
+        return arrays['rows'][row_ptr[item]:row_ptr[item + 1]]
+
+    def num_outfits(self, cate, item):
+        row_ptr = self.arrays[cate]['row_ptr']
+        return int(row_ptr[item + 1] - row_ptr[item])
+
+    def users(self, cate, item):
+        """ Sorted users that have item of category cate in an outfit
+        """
+        arrays = self.arrays[cate]
+        user_ptr = arrays['user_ptr']
+        return arrays['users'][user_ptr[item]:user_ptr[item + 1]]
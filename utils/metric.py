@@ -1,5 +1,35 @@
+import multiprocessing
 import numpy as np
 
+# cached discounts for each wtype, see get_discounts()
+_discounts = {}
+
+
+def get_discounts(size, wtype='max'):
+    """ Discounts of the first size positions.
+        The table is computed once for each wtype and only grows when a
+        longer one is required.
+        Parameters
+        ----------
+        size : number of positions
+        wtype : 'log' or 'max'
+            type for discounts
+        Returns
+        -------
+        discounts : array, shape = [size]
+    """
+    wtype = 'max' if wtype.lower() == 'max' else 'log'
+    table = _discounts.get(wtype)
+    if table is None or len(table) < size:
+        # grow to the next power of two
+        length = 1 << int(max(size - 1, 1)).bit_length()
+        if wtype == 'max':
+            table = np.log2(np.maximum(np.arange(length) + 1, 2.))
+        else:
+            table = np.log2(np.arange(length) + 2)
+        _discounts[wtype] = table
+    return table[:size]
+
 
 def ndcg_score(y_score, y_label, wtype='max'):
     """ Normalize Discounted cumulative gain (NDCG).
@@ -15,20 +45,376 @@ def ndcg_score(y_score, y_label, wtype='max'):
         -------
         score : ndcg@m
     """
-    order = np.argsort(y_score)[::-1]
+    order = np.argsort(y_score, kind='mergesort')[::-1]
     p_label = np.take(y_label, order)
     i_label = np.sort(y_label)[::-1]
     p_gain = 2 ** p_label - 1
     i_gain = 2 ** i_label - 1
-    if wtype.lower() == 'max':
-        discounts = np.log2(np.maximum(np.arange(len(y_label)) + 1, 2.))
-    else:
-        discounts = np.log2(np.arange(len(y_label)) + 2)
+    discounts = get_discounts(len(y_label), wtype)
+    dcg_score = (p_gain / discounts).cumsum()
+    idcg_score = (i_gain / discounts).cumsum()
+    return (dcg_score / idcg_score)
+
+
+def ndcg_at_k(y_score, y_label, k, wtype='max'):
+    """ NDCG of the top k positions, same as ndcg_score()[:k] but only the
+        top k scores are selected (np.partition) and sorted.
+        Parameters
+        ----------
+        y_score : array, shape = [n_samples]
+            Predicted scores.
+        y_label : array, shape = [n_samples]
+            Ground truth lambel (binary).
+        k : number of top positions
+        wtype : 'log' or 'max'
+            type for discounts
+        Returns
+        -------
+        score : ndcg@1, ..., ndcg@k
+    """
+    y_score = np.asarray(y_score)
+    y_label = np.asarray(y_label)
+    k = min(k, len(y_score))
+    top = _select_topk(y_score[None, :], k)[0]
+    order = top[np.lexsort((top, y_score[top]))[::-1]]
+    p_label = np.take(y_label, order)
+    i_label = np.sort(-np.partition(-y_label, k - 1)[:k])[::-1]
+    p_gain = 2 ** p_label - 1
+    i_gain = 2 ** i_label - 1
+    discounts = get_discounts(k, wtype)
     dcg_score = (p_gain / discounts).cumsum()
     idcg_score = (i_gain / discounts).cumsum()
     return (dcg_score / idcg_score)
 
 
+def ragged_to_padded(values, offsets=None, fill=0.):
+    """ Convert ragged arrays to a padded 2-D array.
+        Parameters
+        ----------
+        values : array of arrays, shape = [num_users]
+            or a flat array if offsets is given
+        offsets : array, shape = [num_users + 1]
+            values[offsets[u]:offsets[u + 1]] is the array of u-th user
+        fill : value for padded positions
+        Returns
+        -------
+        padded : array, shape = [num_users, max(n_samples)]
+        lengths : array, shape = [num_users]
+    """
+    if offsets is None:
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        values = np.concatenate(values) if len(values) else np.zeros(0)
+        offsets = np.concatenate(([0], lengths.cumsum()))
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+    values = np.asarray(values)
+    num_users = len(lengths)
+    width = lengths.max() if num_users else 0
+    padded = np.full((num_users, width), fill, dtype=np.float64)
+    rows = np.repeat(np.arange(num_users), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(offsets[:-1] - offsets[0],
+                                                lengths)
+    padded[rows, cols] = values[offsets[0]:offsets[-1]]
+    return padded, lengths
+
+
+def batch_ndcg_score(y_score, y_label, lengths, wtype='max'):
+    """ NDCG for a batch of users at once, see ndcg_score().
+        Parameters
+        ----------
+        y_score : array, shape = [num_users, width]
+            Padded predicted scores, see ragged_to_padded()
+        y_label : array, shape = [num_users, width]
+            Padded ground truth label (binary)
+        lengths : array, shape = [num_users]
+            Number of valid samples for each user
+        wtype : 'log' or 'max'
+            type for discounts
+        Returns
+        -------
+        score : array, shape = [num_users, width], ndcg@m for each user,
+            padded positions are zero
+    """
+    num_users, width = y_score.shape
+    valid = np.arange(width) < np.asarray(lengths)[:, None]
+    # valid samples first, then scores in descending order, ties are
+    # broken in the same way as ndcg_score()
+    order = np.lexsort((y_score, valid), axis=-1)[:, ::-1]
+    p_label = y_label[np.arange(num_users)[:, None], order]
+    i_label = np.sort(np.where(valid, y_label, -np.inf), axis=1)[:, ::-1]
+    p_gain = np.where(valid, 2 ** p_label - 1, 0.)
+    i_gain = np.where(valid, 2 ** i_label - 1, 0.)
+    discounts = get_discounts(width, wtype)
+    dcg_score = (p_gain / discounts).cumsum(axis=1)
+    idcg_score = (i_gain / discounts).cumsum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = dcg_score / idcg_score
+    score[~valid] = 0.
+    return score
+
+
+def batch_topk(y_score, lengths, k):
+    """ Indices of the top k scores for a batch of users, in the same order
+        as batch_ndcg_score() ranks them. Only the top k are sorted.
+        Parameters
+        ----------
+        y_score : array, shape = [num_users, width]
+            Padded predicted scores, see ragged_to_padded()
+        lengths : array, shape = [num_users]
+            Number of valid samples for each user
+        k : number of top positions, k <= width
+        Returns
+        -------
+        top : array, shape = [num_users, k]
+            Indices of top k samples, padded samples come last
+    """
+    num_users, width = y_score.shape
+    rows = np.arange(num_users)[:, None]
+    valid = np.arange(width) < np.asarray(lengths)[:, None]
+    top = _select_topk(np.where(valid, y_score, -np.inf), k)
+    order = np.lexsort((top, y_score[rows, top], valid[rows, top]),
+                       axis=-1)[:, ::-1]
+    return top[rows, order]
+
+
+def _select_topk(y_score, k):
+    """ Unsorted indices of the top k scores in each row, in O(width).
+        Of the scores tied with the k-th one, the later ones are selected
+        as the sorted order in ndcg_score() does.
+    """
+    num_users, width = y_score.shape
+    kth = -np.partition(-y_score, k - 1, axis=1)[:, k - 1:k]
+    greater = y_score > kth
+    tied = y_score == kth
+    # number of tied scores to select and the rank of each from the end
+    need = k - greater.sum(axis=1)
+    rank = tied[:, ::-1].cumsum(axis=1)[:, ::-1]
+    selected = greater | (tied & (rank <= need[:, None]))
+    return np.nonzero(selected)[1].reshape(num_users, k)
+
+
+def flat_ndcg_score(y_score, y_label, offsets, wtype='max', batch_size=1024):
+    """ mean_ndcg_score() for flat arrays grouped by user.
+        Parameters
+        ----------
+        y_score : array, shape = [n_samples]
+            Predicted scores of all users
+        y_label : array, shape = [n_samples]
+            Ground truth label of all users
+        offsets : array, shape = [num_users + 1]
+            y_score[offsets[u]:offsets[u + 1]] are the scores of u-th user
+        wtype : 'log' or 'max'
+            type for discounts
+        batch_size : number of users computed at once, users are batched
+            by their number of samples to reduce the padding
+        Returns
+        -------
+        mean_ndcg, avg_ndcg: see mean_ndcg_score()
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    max_sample = lengths.max()
+    count = np.bincount(lengths, minlength=max_sample + 1)
+    count = count[::-1].cumsum()[::-1][1:]
+    mean_ndcg = np.zeros(len(lengths))
+    avg_ndcg = np.zeros(max_sample)
+    for batch, scores, labels in _iter_batches(y_score, y_label, offsets,
+                                               batch_size):
+        ndcg = batch_ndcg_score(scores, labels, lengths[batch], wtype)
+        mean_ndcg[batch] = ndcg.sum(axis=1) / lengths[batch]
+        avg_ndcg[:ndcg.shape[1]] += ndcg.sum(axis=0)
+    return mean_ndcg, avg_ndcg / count
+
+
+def ranking_metrics(y_score, y_label, offsets, ks=(1, 5, 10),
+                    metrics=('ndcg', 'recall', 'hit', 'mrr', 'auc'),
+                    wtype='max', batch_size=1024):
+    """ Ranking metrics for flat arrays grouped by user, computed in one
+        pass from the same ranking of each user.
+        The top max(ks) samples are selected by np.argpartition, unless
+        'auc' is required, in which case every user is sorted once and the
+        top samples are taken from that order.
+        Parameters
+        ----------
+        y_score : array, shape = [n_samples]
+            Predicted scores of all users
+        y_label : array, shape = [n_samples]
+            Ground truth label (binary) of all users
+        offsets : array, shape = [num_users + 1]
+            y_score[offsets[u]:offsets[u + 1]] are the scores of u-th user
+        ks : cutoffs for ndcg@k, recall@k and hit@k
+        metrics : subset of ('ndcg', 'recall', 'hit', 'mrr', 'auc')
+        wtype : 'log' or 'max'
+            type for discounts
+        batch_size : number of users computed at once
+        Returns
+        -------
+        scores : dict, each value is an array of shape [num_users]
+            'ndcg@k', 'recall@k', 'hit@k' for each k in ks, 'mrr', 'auc'.
+            Users without positive (or negative for 'auc') labels are nan.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    num_users = len(lengths)
+    names = []
+    for name in metrics:
+        if name in ('ndcg', 'recall', 'hit'):
+            names += ['{}@{}'.format(name, k) for k in ks]
+        else:
+            names.append(name)
+    results = dict((name, np.zeros(num_users)) for name in names)
+    for batch, scores, labels in _iter_batches(y_score, y_label, offsets,
+                                               batch_size):
+        batch_lengths = lengths[batch]
+        width = scores.shape[1]
+        rows = np.arange(len(batch))[:, None]
+        valid = np.arange(width) < batch_lengths[:, None]
+        positive = valid & (labels > 0)
+        num_posi = positive.sum(axis=1)
+        kmax = min(max(ks), width)
+        if 'auc' in metrics:
+            # valid samples by score in ascending order, padding first
+            order = np.lexsort((scores, valid), axis=-1)
+            top = order[:, ::-1][:, :kmax]
+            results['auc'][batch] = _batch_auc(
+                scores[rows, order], positive[rows, order],
+                valid[rows, order] & ~positive[rows, order])
+        else:
+            top = batch_topk(scores, batch_lengths, kmax)
+        top_valid = valid[rows, top]
+        top_label = np.where(top_valid, labels[rows, top], 0.)
+        hits = (top_label > 0).cumsum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'ndcg' in metrics:
+                discounts = get_discounts(kmax, wtype)
+                i_label = np.where(valid, labels, -np.inf)
+                i_label = -np.partition(-i_label, kmax - 1, axis=1)[:, :kmax]
+                i_label = np.sort(i_label, axis=1)[:, ::-1]
+                i_gain = np.where(np.isfinite(i_label), 2 ** i_label - 1, 0.)
+                dcg_score = ((2 ** top_label - 1) / discounts).cumsum(axis=1)
+                idcg_score = (i_gain / discounts).cumsum(axis=1)
+            for k in ks:
+                col = min(k, kmax) - 1
+                if 'ndcg' in metrics:
+                    results['ndcg@{}'.format(k)][batch] = \
+                        dcg_score[:, col] / idcg_score[:, col]
+                if 'recall' in metrics:
+                    results['recall@{}'.format(k)][batch] = \
+                        hits[:, col] / num_posi.astype(np.float64)
+                if 'hit' in metrics:
+                    results['hit@{}'.format(k)][batch] = np.where(
+                        num_posi > 0, hits[:, col] > 0, np.nan)
+            if 'mrr' in metrics:
+                results['mrr'][batch] = _batch_reciprocal_rank(
+                    scores, valid, positive)
+    return results
+
+
+def _batch_reciprocal_rank(y_score, valid, positive):
+    """ Reciprocal rank of the first positive sample, ties are broken in
+        the same way as batch_ndcg_score(), without sorting.
+    """
+    width = y_score.shape[1]
+    index = np.arange(width)
+    best = np.where(positive, y_score, -np.inf).max(axis=1)[:, None]
+    best_idx = np.where(positive & (y_score == best), index, -1).max(axis=1)
+    ahead = valid & ((y_score > best) |
+                     ((y_score == best) & (index > best_idx[:, None])))
+    rank = ahead.sum(axis=1) + 1.
+    return np.where(positive.any(axis=1), 1. / rank, np.nan)
+
+
+def _batch_auc(y_score, positive, negative):
+    """ AUC for each row of scores sorted in ascending order, tied scores
+        count as half.
+    """
+    # number of negatives before each position and up to it
+    num_nega = negative.cumsum(axis=1)
+    before = num_nega - negative
+    # the start and end of each group of tied scores
+    tie = np.zeros(y_score.shape, dtype=bool)
+    tie[:, 1:] = (y_score[:, 1:] == y_score[:, :-1]) & \
+        (positive[:, 1:] | negative[:, 1:]) & \
+        (positive[:, :-1] | negative[:, :-1])
+    first = np.maximum.accumulate(np.where(tie, 0, before), axis=1)
+    last = np.where(np.roll(tie, -1, axis=1), np.iinfo(np.int64).max,
+                    num_nega)
+    last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+    wins = np.where(positive, first + 0.5 * (last - first), 0.).sum(axis=1)
+    pairs = positive.sum(axis=1) * negative.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(pairs > 0, wins / pairs, np.nan)
+
+
+def _iter_batches(y_score, y_label, offsets, batch_size):
+    """ Yield users (batched by their number of samples to reduce the
+        padding) with their padded scores and labels.
+    """
+    y_score = np.asarray(y_score)
+    y_label = np.asarray(y_label)
+    lengths = np.diff(offsets)
+    users = np.argsort(lengths, kind='mergesort')
+    for start in range(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+        batch_offsets = np.concatenate(([0], lengths[batch].cumsum()))
+        idxs = np.arange(batch_offsets[-1]) + np.repeat(
+            offsets[batch] - batch_offsets[:-1], lengths[batch])
+        scores, _ = ragged_to_padded(y_score[idxs], batch_offsets)
+        labels, _ = ragged_to_padded(y_label[idxs], batch_offsets)
+        yield batch, scores, labels
+
+
+def group_by_user(posi_tuples, nega_tuples, scores):
+    """ Group scored tuples by user for flat_ndcg_score() and
+        ranking_metrics(), with one stable sort.
+        Parameters
+        ----------
+        posi_tuples : array, shape = [n_posi, NumCate + 1]
+            Positive tuples with the user in the first column, e.g. from
+            DataFile.get_tuples(phase, repeated=False)
+        nega_tuples : array, shape = [n_nega, NumCate + 1]
+            Negative tuples
+        scores : array, shape = [n_posi + n_nega]
+            Predicted scores of np.vstack((posi_tuples, nega_tuples))
+        Returns
+        -------
+        users : array, shape = [num_users]
+            Sorted user ids
+        y_score : array, shape = [n_posi + n_nega]
+            Scores grouped by user, in the original order for each user
+        y_label : array, shape = [n_posi + n_nega]
+            1 for positive tuples and 0 for negative ones
+        offsets : array, shape = [num_users + 1]
+            y_score[offsets[u]:offsets[u + 1]] are the scores of users[u]
+        Usage
+        -----
+        users, y_score, y_label, offsets = group_by_user(posi, nega, scores)
+        mean_ndcg, avg_ndcg = flat_ndcg_score(y_score, y_label, offsets)
+    """
+    num_posi = len(posi_tuples)
+    user_ids = np.concatenate((np.asarray(posi_tuples)[:, 0],
+                               np.asarray(nega_tuples)[:, 0]))
+    scores = np.asarray(scores)
+    assert (len(scores) == len(user_ids)), 'One score for each tuple'
+    order = np.argsort(user_ids, kind='mergesort')
+    sorted_ids = user_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    if len(order) == 0:
+        starts = starts[:0]
+    users = sorted_ids[starts]
+    offsets = np.r_[starts, len(order)].astype(np.int64)
+    y_label = (order < num_posi).astype(np.float64)
+    return users, scores[order], y_label, offsets
+
+
+def split_by_user(values, offsets):
+    """ Views of values for each user, e.g. u_scores of mean_ndcg_score()
+    """
+    return [values[offsets[u]:offsets[u + 1]]
+            for u in range(len(offsets) - 1)]
+
+
 def mean_ndcg_score(u_scores, u_labels, wtype='max'):
     """ mean Normalize Discounted cumulative gain (NDCG) for all users
         Parameters
@@ -46,17 +432,221 @@ def mean_ndcg_score(u_scores, u_labels, wtype='max'):
         avg_ndcg : array, shape = [max(n_samples)], averaged ndcg at each
             position (averaged among all users for given rank)
     """
-    num_users = len(u_scores)
     n_samples = [len(scores) for scores in u_scores]
-    max_sample = max(n_samples)
-    count = np.zeros(max_sample)
-    mean_ndcg = np.zeros(num_users)
-    avg_ndcg = np.zeros(max_sample)
-    for u in range(num_users):
-        y_score = u_scores[u]
-        y_label = u_labels[u]
-        ndcg = ndcg_score(y_score, y_label, wtype)
-        avg_ndcg[:n_samples[u]] += ndcg
-        count[:n_samples[u]] += 1
-        mean_ndcg[u] = ndcg.mean()
-    return mean_ndcg, avg_ndcg / count
+    offsets = np.concatenate(([0], np.cumsum(n_samples)))
+    y_score = np.concatenate(u_scores)
+    y_label = np.concatenate(u_labels)
+    return flat_ndcg_score(y_score, y_label, offsets, wtype)
+
+
+def bootstrap_ci(values, num_samples=10000, alpha=0.05, seed=None,
+                 num_workers=1, batch_size=500):
+    """ Bootstrap confidence interval of the mean over users.
+        Parameters
+        ----------
+        values : array, shape = [num_users]
+            Value for each user, e.g. mean_ndcg of mean_ndcg_score(), or the
+            difference between two models for a paired interval.
+            Users with nan are dropped.
+        num_samples : number of bootstrap replicates
+        alpha : the interval covers 1 - alpha
+        seed : seed for resampling, results do not depend on num_workers
+        num_workers : number of processes to draw replicates
+        batch_size : number of replicates drawn at once in each job
+        Returns
+        -------
+        mean : mean over users
+        low, high : the confidence interval
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    means = _run_replicates(_bootstrap_means, values, num_samples, seed,
+                            num_workers, batch_size)
+    low, high = np.percentile(means, [50. * alpha, 100. - 50. * alpha])
+    return values.mean(), low, high
+
+
+def permutation_test(values_a, values_b, num_samples=10000, seed=None,
+                     num_workers=1, batch_size=500):
+    """ Paired permutation test for the mean difference of two models over
+        the same users, by randomly swapping the two values of each user.
+        Parameters
+        ----------
+        values_a, values_b : array, shape = [num_users]
+            Value for each user, e.g. mean_ndcg of mean_ndcg_score().
+            Users with nan in either one are dropped.
+        num_samples : number of permutations
+        seed : seed for permutations, results do not depend on num_workers
+        num_workers : number of processes to draw permutations
+        batch_size : number of permutations drawn at once in each job
+        Returns
+        -------
+        diff : mean(values_a - values_b)
+        p_value : two-sided p-value for no difference
+    """
+    diffs = np.asarray(values_a, dtype=np.float64) - \
+        np.asarray(values_b, dtype=np.float64)
+    diffs = diffs[np.isfinite(diffs)]
+    means = _run_replicates(_sign_flip_means, diffs, num_samples, seed,
+                            num_workers, batch_size)
+    diff = diffs.mean()
+    extreme = (np.abs(means) >= np.abs(diff) - 1e-12).sum()
+    return diff, (extreme + 1.) / (num_samples + 1.)
+
+
+def _run_replicates(func, values, num_samples, seed, num_workers,
+                    batch_size):
+    """ Split replicates into jobs with their own seeds and run them.
+    """
+    sizes = [batch_size] * (num_samples // batch_size)
+    if num_samples % batch_size:
+        sizes.append(num_samples % batch_size)
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=len(sizes))
+    jobs = [(values, size, s) for size, s in zip(sizes, seeds)]
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            results = pool.map(func, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [func(job) for job in jobs]
+    return np.concatenate(results)
+
+
+def _bootstrap_means(job):
+    values, size, seed = job
+    random = np.random.RandomState(seed)
+    idxs = random.randint(len(values), size=(size, len(values)))
+    return values[idxs].mean(axis=1)
+
+
+def _sign_flip_means(job):
+    diffs, size, seed = job
+    random = np.random.RandomState(seed)
+    signs = random.randint(2, size=(size, len(diffs))) * 2. - 1.
+    return signs.dot(diffs) / len(diffs)
+
+
+class NDCGAccumulator(object):
+    """ Accumulate NDCG from chunks of (user, score, label) as the model
+        produces them, see mean_ndcg_score().
+        Usage
+        -----
+        accumulator = NDCGAccumulator()
+        for users, scores, labels in chunks:
+            accumulator.update(users, scores, labels)
+            accumulator.finish(finished_users) # optional, release memory
+        mean_ndcg, avg_ndcg = accumulator.finalize()
+        Accumulators built in other processes can be combined with merge()
+    """
+    def __init__(self, wtype='max'):
+        self.wtype = wtype
+        # chunks of (scores, labels) of users that are not finished
+        self._pending = {}
+        # mean ndcg of finished users
+        self._mean = {}
+        # sum of ndcg and number of finished users at each position
+        self._sum = np.zeros(0)
+        self._count = np.zeros(0, dtype=np.int64)
+
+    @property
+    def users(self):
+        """ All users in ascending order, the order of finalize()
+        """
+        return sorted(set(self._mean) | set(self._pending))
+
+    def update(self, users, scores, labels):
+        """ Add one chunk.
+            Parameters
+            ----------
+            users : array, shape = [n_samples], or one user for the chunk
+            scores : array, shape = [n_samples]
+            labels : array, shape = [n_samples]
+        """
+        scores = np.asarray(scores)
+        labels = np.asarray(labels)
+        users = np.asarray(users)
+        if users.ndim == 0:
+            users = np.repeat(users, len(scores))
+        if len(users) == 0:
+            return
+        order = np.argsort(users, kind='mergesort')
+        users = users[order]
+        scores = scores[order]
+        labels = labels[order]
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+        ends = np.r_[starts[1:], len(users)]
+        for user, start, end in zip(users[starts].tolist(), starts, ends):
+            if user in self._mean:
+                raise ValueError("User {} has been finished".format(user))
+            self._pending.setdefault(user, []).append(
+                (scores[start:end], labels[start:end]))
+
+    def finish(self, users=None):
+        """ Compute NDCG of the given users (all pending users if None) and
+            drop their scores and labels. No more samples of these users
+            can be added.
+        """
+        if users is None:
+            users = list(self._pending)
+        users = [u for u in users if u in self._pending]
+        if len(users) == 0:
+            return
+        y_score, y_label, lengths = [], [], []
+        for user in users:
+            chunks = self._pending.pop(user)
+            y_score += [scores for scores, _ in chunks]
+            y_label += [labels for _, labels in chunks]
+            lengths.append(sum(len(scores) for scores, _ in chunks))
+        lengths = np.array(lengths, dtype=np.int64)
+        offsets = np.concatenate(([0], lengths.cumsum()))
+        self._grow(lengths.max())
+        for batch, scores, labels in _iter_batches(
+                np.concatenate(y_score), np.concatenate(y_label),
+                offsets, 1024):
+            ndcg = batch_ndcg_score(scores, labels, lengths[batch],
+                                    self.wtype)
+            width = ndcg.shape[1]
+            self._sum[:width] += ndcg.sum(axis=0)
+            self._count[:width] += (np.arange(width) <
+                                    lengths[batch][:, None]).sum(axis=0)
+            for user, score in zip(np.take(users, batch).tolist(),
+                                   ndcg.sum(axis=1) / lengths[batch]):
+                self._mean[user] = score
+
+    def merge(self, other):
+        """ Merge the accumulator of another worker into this one.
+        """
+        if other.wtype != self.wtype:
+            raise ValueError("Can not merge NDCG with different wtype")
+        finished = set(self._mean) | set(other._mean)
+        if (len(finished) != len(self._mean) + len(other._mean) or
+                finished & (set(self._pending) | set(other._pending))):
+            raise ValueError("Users finished in one accumulator "
+                             "can not be merged")
+        for user, chunks in other._pending.items():
+            self._pending.setdefault(user, []).extend(chunks)
+        self._mean.update(other._mean)
+        self._grow(len(other._sum))
+        self._sum[:len(other._sum)] += other._sum
+        self._count[:len(other._count)] += other._count
+        return self
+
+    def finalize(self):
+        """ Finish all users.
+            Returns
+            -------
+            mean_ndcg, avg_ndcg: see mean_ndcg_score(), users are in the
+                order of self.users
+        """
+        self.finish()
+        mean_ndcg = np.array([self._mean[u] for u in self.users])
+        return mean_ndcg, self._sum / self._count
+
+    def _grow(self, size):
+        if size > len(self._sum):
+            self._sum = np.r_[self._sum, np.zeros(size - len(self._sum))]
+            self._count = np.r_[self._count, np.zeros(
+                size - len(self._count), dtype=np.int64)]
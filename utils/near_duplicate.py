@@ -0,0 +1,236 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+from . import config as cfg
+from .check_utils import list_files
+from .instrument import recorder
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# number of bits of a hash
+HashBits = 64
+
+
+def dhash(path, size=8):
+    """ Difference hash of an image: the image is shrunk to gray
+        (size + 1) x size pixels and each bit tells whether a pixel is
+        brighter than its right neighbour.
+        Return
+        ------
+        hash: int of size * size bits, None if the image can not be read
+    """
+    if Image is None:
+        raise ImportError("PIL is required to hash images")
+    try:
+        image = Image.open(path).convert('L').resize(
+            (size + 1, size), Image.BILINEAR)
+    except (IOError, OSError):
+        return None
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hash_images(pathes, num_workers=None):
+    """ dhash() of images in a process pool
+        Return
+        ------
+        hashes: list of hash (or None) for each path
+    """
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        return pool.map(dhash, pathes, chunksize=256)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def popcount(values):
+    """ Number of set bits of each uint64 value
+    """
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    bits = np.unpackbits(values.view(np.uint8))
+    return bits.reshape(-1, HashBits).sum(axis=1)
+
+
+class MultiIndexHash(object):
+    """ Multi-index hashing for pairs of hashes within a hamming radius.
+        The bits are split into radius + 1 blocks, and by the pigeonhole
+        principle two hashes within the radius have at least one equal
+        block. So only hashes sharing a block are compared.
+        Buckets of hashes sharing a block are compared a chunk of rows at a
+        time, so memory is bounded by max_cells instead of growing with the
+        square of the bucket size.
+        Constructor
+        -----------
+        MultiIndexHash(hashes, radius, max_cells)
+            hashes: array of uint64 hashes
+            radius: maximum hamming distance
+            max_cells: maximum number of distances computed at once
+        Methods
+        -------
+        pairs(): All pairs (i, j), i < j, within the radius
+        links(): Fewer pairs that connect the same hashes as pairs()
+    """
+    def __init__(self, hashes, radius=4, max_cells=1 << 20):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+        self.max_cells = max_cells
+        num_blocks = radius + 1
+        sizes = [HashBits // num_blocks + (n < HashBits % num_blocks)
+                 for n in range(num_blocks)]
+        shifts = np.cumsum([0] + sizes[:-1])
+        # (mask, shift) of each block
+        self.blocks = [(np.uint64((1 << int(size)) - 1), np.uint64(shift))
+                       for size, shift in zip(sizes, shifts)]
+
+    def _close_pairs(self, hashes):
+        """ Pairs (i, j), i < j, of hashes within the radius
+        """
+        num = len(hashes)
+        codes = []
+        for mask, shift in self.blocks:
+            keys = (hashes >> shift) & mask
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            # buckets of more than one hash
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            ends = np.r_[starts[1:], num]
+            for start, end in zip(starts, ends):
+                if end - start < 2:
+                    continue
+                ids = np.sort(order[start:end])
+                size = len(ids)
+                step = max(1, self.max_cells // size)
+                for row in range(0, size - 1, step):
+                    rows = np.arange(row, min(row + step, size - 1))
+                    dist = popcount(
+                        (hashes[ids[rows]][:, None] ^
+                         hashes[ids][None, :]).ravel()).reshape(
+                        len(rows), size)
+                    # only pairs with the later hashes of the bucket
+                    close = (dist <= self.radius) & (
+                        np.arange(size)[None, :] > rows[:, None])
+                    r, c = np.nonzero(close)
+                    codes.append(ids[rows[r]] * num + ids[c])
+        if len(codes) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        codes = np.unique(np.concatenate(codes))
+        return np.c_[codes // num, codes % num]
+
+    def pairs(self):
+        """ All pairs within the radius
+            Return
+            ------
+            pairs: array, shape = [num_pairs, 2], pairs (i, j) with i < j
+        """
+        return self._close_pairs(self.hashes)
+
+    def links(self):
+        """ Pairs that connect the same components as pairs().
+            Each hash is linked to the first one equal to it, and only
+            distinct hashes are compared, so many equal hashes (e.g. blank
+            images) give a linear number of links instead of all pairs.
+            Return
+            ------
+            links: array, shape = [num_links, 2], pairs (i, j) with i < j
+        """
+        values, first, inverse = np.unique(
+            self.hashes, return_index=True, return_inverse=True)
+        ids = np.arange(len(self.hashes))
+        same = np.c_[first[inverse], ids][first[inverse] != ids]
+        close = np.sort(first[self._close_pairs(values)], axis=1)
+        return np.vstack((same, close)).astype(np.int64)
+
+
+def cluster(names, pairs):
+    """ Connected components of names linked by pairs
+        Return
+        ------
+        canonical: Pairs of {name: canonical name} for names that are not
+            canonical, the canonical name is the smallest in its component
+    """
+    parent = list(range(len(names)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            if names[root_i] < names[root_j]:
+                parent[root_j] = root_i
+            else:
+                parent[root_i] = root_j
+    canonical = {}
+    for i, name in enumerate(names):
+        root = find(i)
+        if root != i:
+            canonical[name] = names[root]
+    return canonical
+
+
+@recorder.stage('near_duplicates')
+def find_near_duplicates(image_dir, radius=4, num_workers=None):
+    """ Find near-duplicate item images in each category.
+        Parameters
+        ----------
+        image_dir: processed images folder, e.g.
+                   /data/polyvore/processed/images, whose items/top,
+                   items/bottom and items/shoe are searched
+        radius: maximum hamming distance of dhash() for near duplicates
+        num_workers: number of processes to hash images
+        Return
+        ------
+        canonical: Pairs of {image name: canonical image name} for images
+            that are near duplicates of a canonical one
+    """
+    canonical = {}
+    for cate in cfg.ClassName:
+        folder = os.path.join(image_dir, 'items', cate)
+        names = sorted(list_files(folder, ('jpg', 'png')))
+        hashes = hash_images([os.path.join(folder, name) for name in names],
+                             num_workers)
+        names = [name for name, h in zip(names, hashes) if h is not None]
+        hashes = [h for h in hashes if h is not None]
+        pairs = MultiIndexHash(hashes, radius).links()
+        mapping = cluster(names, pairs)
+        recorder.count('images', len(names))
+        recorder.count('near_duplicates', len(mapping))
+        canonical.update(mapping)
+    return canonical
+
+
+def save_remapping(canonical, fn):
+    with open(fn, 'w') as f:
+        json.dump(canonical, f, indent=0, sort_keys=True)
+
+
+def load_remapping(fn):
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+def remap_sets(sets, canonical):
+    """ Rename images of fashion tuples with canonical names
+        Parameters
+        ----------
+        sets: fashion tuples for each user, e.g. concise_sets.iter_sets()
+        canonical: see find_near_duplicates()
+        Yield
+        -----
+        Type of set, remapped tuples of each user, which can be passed to
+        polyvore_spliter
+    """
+    for user_sets in sets:
+        yield set(tuple(canonical.get(name, name) for name in tpl)
+                  for tpl in user_sets)
@@ -0,0 +1,399 @@
+""" Run the whole preprocessing pipeline as a graph of cached stages.
+    Each stage is keyed by the sha1 of its parameters, the signatures of
+    the raw files and the runs of the stages it depends on: every run of a
+    stage saves a new run id in its state, so the stages that depend on it
+    run again. A stage whose key and outputs are unchanged since its last
+    run is skipped, and stages that do not depend on each other run
+    concurrently.
+    Usage
+    -----
+    python -m utils.pipeline ~/data/polyvore/raw ~/data/polyvore/processed
+    python -m utils.pipeline raw processed --min-size 20 5 5 --usize 8
+    python -m utils.pipeline raw processed --stages split --force split
+    Stages
+    ------
+    parse: polyvore_parser.run() and savez(), {out_dir}/pickles
+    images: move_images(), {out_dir}/images
+    split: concise_sets.run(), polyvore_spliter.run() and save_list(),
+           {out_dir}/image_list
+    tuples: Dataset.run() and save(), {out_dir}/tuples
+    prices: save_prices(), {out_dir}/image_list
+    The state of each stage and the intermediate results are saved in
+    {out_dir}/.pipeline, and the timings of the last run in
+    {out_dir}/.pipeline/report.json.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from . import config as cfg
+from .instrument import recorder
+from .polyvore import polyvore_parser, load_pkl, copy_images
+from .polyvore import concise_sets, polyvore_spliter, Dataset
+from .data_utils import DataFile, save_prices, file_signature
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+def raw_signature(raw_dir):
+    """ Signatures of the jsonl files and image folders of the raw data.
+        Images are only listed by the parser, so the modification time of
+        each image folder stands for its images.
+    """
+    signature = {}
+    for sub_dir in ['items', 'sets']:
+        folder = os.path.join(raw_dir, sub_dir)
+        for fn in sorted(os.listdir(folder)):
+            if fn.endswith('.jsonl'):
+                signature[os.path.join(sub_dir, fn)] = file_signature(
+                    os.path.join(folder, fn))
+    image_dir = os.path.join(raw_dir, 'images')
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        signature[os.path.relpath(root, raw_dir)] = os.stat(root).st_mtime
+    return signature
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class Task(object):
+    """ One stage of a Pipeline
+        Parameters
+        ----------
+        name: name of the stage
+        func: function to run the stage, called without arguments
+        deps: names of the stages it depends on
+        params: parameters of the stage, which must be JSON serializable
+        outputs: files or folders written by the stage, removed before it
+                 runs again
+    """
+    def __init__(self, name, func, deps, params, outputs):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = params
+        self.outputs = list(outputs)
+
+
+class Pipeline(object):
+    """ Stages with dependencies, cached by the keys of their inputs
+        Usage
+        -----
+        >> pipeline = Pipeline(state_dir)
+        >> pipeline.add('parse', parse, params={...}, outputs=[...])
+        >> pipeline.add('split', split, deps=['parse'], outputs=[...])
+        >> pipeline.run(num_workers=2)
+        Methods
+        -------
+        add(name, func, deps, params, outputs): Add a stage
+        key(name): Key of a stage, from the last runs of its deps
+        is_fresh(name): Whether a stage can be skipped
+        run(targets, force, num_workers): Run stages
+    """
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.tasks = OrderedDict()
+
+    def add(self, name, func, deps=(), params=None, outputs=()):
+        """ Add a stage, stages it depends on must be added before it
+        """
+        for dep in deps:
+            assert dep in self.tasks, 'Unknown stage {}'.format(dep)
+        self.tasks[name] = Task(name, func, deps, params, outputs)
+
+    def key(self, name):
+        """ sha1 of the parameters of a stage and the run ids of its deps.
+            The outputs of a stage are not hashed, instead a stage that
+            runs again changes the keys of the stages depending on it,
+            whether its outputs changed or not.
+        """
+        task = self.tasks[name]
+        runs = {}
+        for dep in task.deps:
+            state = self._state(dep)
+            runs[dep] = state.get('run') if state else None
+        content = json.dumps(
+            {'stage': name, 'params': task.params, 'deps': runs},
+            sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _state_file(self, name):
+        return os.path.join(self.state_dir, '{}.json'.format(name))
+
+    def _state(self, name):
+        """ State saved by the last run of a stage, None if there is none
+        """
+        fn = self._state_file(name)
+        if not os.path.isfile(fn):
+            return None
+        with open(fn, 'r') as f:
+            return json.load(f)
+
+    def is_fresh(self, name):
+        """ Whether the stage ran with the same key and its outputs exist
+        """
+        state = self._state(name)
+        if state is None:
+            return False
+        return state['key'] == self.key(name) and all(
+            os.path.exists(path) for path in self.tasks[name].outputs)
+
+    def _closure(self, targets):
+        """ targets and the stages they depend on, in the order added
+        """
+        names = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in names:
+                names.add(name)
+                stack.extend(self.tasks[name].deps)
+        return [name for name in self.tasks if name in names]
+
+    def _run_task(self, name):
+        task = self.tasks[name]
+        # remove the state first, so an interrupted stage runs again
+        _remove(self._state_file(name))
+        for path in task.outputs:
+            _remove(path)
+        key = self.key(name)
+        with recorder.stage('pipeline.' + name):
+            task.func()
+        with open(self._state_file(name), 'w') as f:
+            json.dump({'key': key, 'run': uuid.uuid4().hex,
+                       'params': task.params,
+                       'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}, f,
+                      indent=2, sort_keys=True)
+
+    def run(self, targets=None, force=(), num_workers=2):
+        """ Run targets and the stages they depend on.
+            A stage runs once all its deps are done, if it is not fresh,
+            it is in force or one of its deps ran. Stages that are ready
+            run concurrently in num_workers threads.
+            Return
+            ------
+            status: Pairs of {stage: 'skipped' or 'ran'}
+        """
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        names = self._closure(targets or list(self.tasks))
+        status = OrderedDict()
+        pending = list(names)
+        running = set()
+        done = Queue.Queue()
+        pool = ThreadPool(max(1, num_workers))
+
+        def work(name):
+            try:
+                self._run_task(name)
+                done.put((name, None))
+            except BaseException as e:
+                traceback.print_exc()
+                done.put((name, e))
+
+        error = None
+        try:
+            while pending or running:
+                if error is None:
+                    ready = [name for name in pending
+                             if all(dep in status
+                                    for dep in self.tasks[name].deps)]
+                    for name in ready:
+                        pending.remove(name)
+                        stale = name in force or any(
+                            status[dep] == 'ran'
+                            for dep in self.tasks[name].deps)
+                        if not stale and self.is_fresh(name):
+                            print ("Stage {} is up to date".format(name))
+                            status[name] = 'skipped'
+                            continue
+                        print ("Running stage {}".format(name))
+                        running.add(name)
+                        pool.apply_async(work, (name, ))
+                    if ready and not running:
+                        # skipped stages may make others ready
+                        continue
+                if not running:
+                    break
+                name, e = done.get()
+                running.remove(name)
+                if e is None:
+                    status[name] = 'ran'
+                elif error is None:
+                    print ("Stage {} failed: {}".format(name, e))
+                    error = e
+        finally:
+            pool.close()
+            pool.join()
+        if error is not None:
+            raise error
+        return OrderedDict((name, status[name]) for name in names)
+
+
+def build_pipeline(raw_dir, out_dir, min_size=(250, 20, 20), usize=80,
+                   clip=None, ratio=5, factor=2, seed=0, num_shards=None,
+                   pipelined=False):
+    """ Pipeline of all preprocessing stages, see the module docstring
+        Parameters
+        ----------
+        min_size: minimal size for train / val / test
+        usize: number of users to leave out, see polyvore_spliter.run()
+        clip: users with fewer tuples are removed, sum(min_size) if None
+        ratio, factor: see Dataset.run()
+        seed: seed for splitting and negative tuples
+        num_shards: see Dataset.save()
+        pipelined: see polyvore_parser.run()
+    """
+    raw_dir = os.path.abspath(raw_dir)
+    state_dir = os.path.join(out_dir, '.pipeline')
+    pkl_dir = os.path.join(out_dir, 'pickles')
+    image_dir = os.path.join(out_dir, 'images')
+    list_dir = os.path.join(out_dir, 'image_list')
+    tuple_dir = os.path.join(out_dir, 'tuples')
+    sources_fn = os.path.join(state_dir, 'image_sources.json')
+    datasets_fn = os.path.join(state_dir, 'datasets.pickle')
+    if clip is None:
+        clip = sum(min_size)
+    # the global random state of numpy is used by Dataset.run()
+    random_lock = threading.Lock()
+
+    def parse():
+        parser = polyvore_parser(raw_dir)
+        parser.run(pipelined)
+        parser.savez(pkl_dir)
+        item_images, set_images = parser.image_sources()
+        with open(sources_fn, 'w') as f:
+            json.dump({'items': item_images, 'sets': set_images}, f)
+
+    def images():
+        with open(sources_fn, 'r') as f:
+            sources = json.load(f)
+        copy_images(sources['items'], sources['sets'], image_dir)
+
+    def split():
+        fashion_sets, _ = load_pkl(pkl_dir)
+        sets = concise_sets(fashion_sets).run(clip)
+        del fashion_sets
+        spliter = polyvore_spliter(sets, list(min_size), seed)
+        spliter.run(usize)
+        spliter.save_list(list_dir)
+        with open(datasets_fn, 'wb') as f:
+            pickle.dump(spliter.get_datesets(False), f,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def tuples():
+        with open(datasets_fn, 'rb') as f:
+            dataset = Dataset(pickle.load(f))
+        with random_lock:
+            np.random.seed(seed)
+            dataset.run(ratio, factor)
+        if not os.path.isdir(tuple_dir):
+            os.makedirs(tuple_dir)
+        dataset.save(tuple_dir, num_shards)
+
+    def prices():
+        _, fashion_items = load_pkl(pkl_dir)
+        image_list = DataFile(tuple_dir, list_dir).image_list
+        save_prices(fashion_items, image_list, list_dir)
+
+    pipeline = Pipeline(state_dir)
+    pipeline.add('parse', parse,
+                 params={'raw': raw_signature(raw_dir),
+                         'pipelined': pipelined},
+                 outputs=[os.path.join(pkl_dir, fn) for fn in
+                          ['fashion_sets.pickle', 'fashion_items.pickle']] +
+                 [sources_fn])
+    pipeline.add('images', images, deps=['parse'],
+                 outputs=[os.path.join(image_dir, sub_dir)
+                          for sub_dir in ['items', 'sets']])
+    pipeline.add('split', split, deps=['parse'],
+                 params={'min_size': list(min_size), 'usize': usize,
+                         'clip': clip, 'seed': seed},
+                 outputs=[os.path.join(list_dir, 'image_list_{}.txt'.format(
+                     cate)) for cate in cfg.ClassName] + [datasets_fn])
+    pipeline.add('tuples', tuples, deps=['split'],
+                 params={'ratio': ratio, 'factor': factor, 'seed': seed,
+                         'num_shards': num_shards},
+                 outputs=[tuple_dir])
+    pipeline.add('prices', prices, deps=['parse', 'split'],
+                 outputs=[os.path.join(list_dir, '{}_{}.npy'.format(
+                     kind, cate)) for kind in ['price', 'currency']
+                     for cate in cfg.ClassName] +
+                 [os.path.join(list_dir, 'prices.json')])
+    return pipeline
+
+
+def format_report(status, records):
+    """ One line for each stage, with its status and seconds
+    """
+    seconds = dict((record['name'], record['seconds'])
+                   for record in records
+                   if record['name'].startswith('pipeline.'))
+    lines = ['{:<8}{:>10}{:>10}'.format('stage', 'status', 'seconds')]
+    for name, state in status.items():
+        lines.append('{:<8}{:>10}{:>10.2f}'.format(
+            name, state, seconds.get('pipeline.' + name, 0.)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Preprocess polyvore raw data, skipping stages that '
+                    'are up to date')
+    parser.add_argument('raw_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--min-size', type=int, nargs=3,
+                        default=[250, 20, 20],
+                        help='minimal size for train / val / test')
+    parser.add_argument('--usize', type=int, default=80,
+                        help='number of users to leave out')
+    parser.add_argument('--clip', type=int, default=None,
+                        help='users with fewer tuples are removed, '
+                             'sum of min-size by default')
+    parser.add_argument('--ratio', type=int, default=5)
+    parser.add_argument('--factor', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num-shards', type=int, default=None)
+    parser.add_argument('--pipelined', action='store_true',
+                        help='parse items and sets in one pass')
+    parser.add_argument('--stages', nargs='*', default=None,
+                        help='stages to run, with the ones they depend on')
+    parser.add_argument('--force', nargs='*', default=[],
+                        help='stages to run even if they are up to date')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of stages that run at once')
+    args = parser.parse_args()
+    pipeline = build_pipeline(
+        args.raw_dir, args.out_dir, args.min_size, args.usize, args.clip,
+        args.ratio, args.factor, args.seed, args.num_shards, args.pipelined)
+    for name in (args.stages or []) + args.force:
+        if name not in pipeline.tasks:
+            parser.error('unknown stage {}, choose from {}'.format(
+                name, ', '.join(pipeline.tasks)))
+    recorder.reset()
+    status = pipeline.run(args.stages, args.force, args.workers)
+    recorder.save(os.path.join(pipeline.state_dir, 'report.json'))
+    print (format_report(status, recorder.records))
+
+
+if __name__ == '__main__':
+    main()
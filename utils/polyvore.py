@@ -1,18 +1,143 @@
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 import shutil
 import pandas as pd
 import numpy as np
 from . import config as cfg
 from .check_utils import check_files, list_files, check_dir
+from .check_utils import image_file_name, file_checksum
+from .instrument import recorder
+from .data_utils import shard_file
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from progress import ProgressBar
 
 
+class ItemRecord(object):
+    """ Compact record of a fashion item, which can be read like item_info
+        of polyvore_parser, e.g. item['class'] or item['image']['name'].
+        Members
+        -------
+        cls, categories (tuple), name, price, text: see item_info
+        image_dir, image_name, checksum: image of the item, None for items
+            of fashion_items
+    """
+    __slots__ = ('cls', 'categories', 'name', 'price', 'text',
+                 'image_dir', 'image_name', 'checksum')
+    # keys of item_info in fashion_items
+    keys = ('class', 'categories', 'name', 'price', 'text')
+
+    def __init__(self, cls, categories, name, price, text,
+                 image_dir=None, image_name=None, checksum=None):
+        self.cls = cls
+        self.categories = categories
+        self.name = name
+        self.price = price
+        self.text = text
+        self.image_dir = image_dir
+        self.image_name = image_name
+        self.checksum = checksum
+
+    @property
+    def image_path(self):
+        return os.path.join(self.image_dir, self.image_name)
+
+    def __getitem__(self, key):
+        if key == 'class':
+            return self.cls
+        if key == 'image':
+            return {'name': self.image_name, 'path': self.image_path}
+        if key in ('categories', 'name', 'price', 'text', 'checksum'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def to_dict(self):
+        """ item_info of fashion_items
+        """
+        info = dict((key, self[key]) for key in self.keys)
+        info['categories'] = list(self.categories)
+        return info
+
+
+class SetRecord(object):
+    """ Compact record of a fashion set, which can be read like a dict of
+        {'url', 'image', 'items'}, see polyvore_parser.
+        Members
+        -------
+        url: set url
+        image_dir, image_name: image of the set, image_name is None if the
+            image has not been downloaded
+        items: list of items for each category, None if not resolved yet
+        item_urls: item urls of a set that is not resolved yet
+    """
+    __slots__ = ('url', 'image_dir', 'image_name', 'items', 'item_urls')
+    keys = ('url', 'image', 'items')
+
+    def __init__(self, url, image_dir, image_name, items=None,
+                 item_urls=None):
+        self.url = url
+        self.image_dir = image_dir
+        self.image_name = image_name
+        self.items = items
+        self.item_urls = item_urls
+
+    @property
+    def image(self):
+        """ Path of the set image, '' if it has not been downloaded
+        """
+        if self.image_name is None:
+            return ''
+        return os.path.join(self.image_dir, self.image_name)
+
+    def __getitem__(self, key):
+        if key in self.keys:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key != 'items':
+            raise KeyError(key)
+        self.items = value
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys)
+
+
+def copy_images(item_images, set_images, outdir, progress_bar=None):
+    """ Copy item images to outdir/items/{class} and set images to
+        outdir/sets, see polyvore_parser.image_sources()
+    """
+    if progress_bar is None:
+        progress_bar = ProgressBar()
+    progress_bar.reset(len(item_images), 'Moving item images')
+    itemdir = os.path.join(outdir, 'items')
+    for subdir in cfg.ClassName:
+        check_dir(os.path.join(itemdir, subdir), action='mkdir')
+    for image_path, subdir in item_images:
+        progress_bar.forward()
+        shutil.copy2(image_path, os.path.join(itemdir, subdir))
+        recorder.count('item_images')
+    progress_bar.end()
+    progress_bar.reset(len(set_images), 'Moving set images')
+    setdir = os.path.join(outdir, 'sets')
+    check_dir(setdir, action='mkdir')
+    for image_path in set_images:
+        progress_bar.forward()
+        shutil.copy2(image_path, setdir)
+        recorder.count('set_images')
+    progress_bar.end()
+
+
 class polyvore_parser(object):
     """ Polyvore parser for loading items and sets information from raw data.
         Constructor
@@ -22,7 +147,8 @@ class polyvore_parser(object):
         Data Structure
         --------------
         fashion_items: Type of ditc, maintains fasion items with
-            pairs of `{image name: item_info}`. item_info is type of dict:
+            pairs of `{image name: item_info}`. item_info is an ItemRecord,
+            which is saved as a dict by savez():
             { 'class': item class in {'top', 'bottom', 'shoe'},
               'name' : the name of item
               'categories' : a list of possible categories,
@@ -30,7 +156,8 @@ class polyvore_parser(object):
               'text': the description for this item}
         fashion_sets: Type of list. Maintains fashion sets for each user
             fashion_sets[n]: All fashion sets for n-th user, type of list
-            Each set in fashion_sets[n] is a dictionary of
+            Each set in fashion_sets[n] is a SetRecord, which is saved as a
+            dictionary by savez():
                 {'url': set url,
                  'items': Type of list, each one is the
                           list of fashion items of each class.
@@ -40,6 +167,8 @@ class polyvore_parser(object):
         get_all_user_name(): Get all users' name
         parse_items(): Load all fashion items
         parse_sets(): Load all fashion sets
+        parse(): Load items and sets of each user in one pass
+        image_groups(): Group items of the same image
         clean(): Clean items and sets
         Usage
         -----
@@ -47,8 +176,13 @@ class polyvore_parser(object):
         >> parser.run()
         >> parser.move_images('~/data/polyvore/processed/images')
         >> parser.savez('~/data/polyvore/processed/pickles')
+        >> utils.instrument.recorder.save('report.json') # stage timings
 
     """
+    # image folders for xxx_items.jsonl and xxx_items_append.jsonl
+    item_sub_dirs = {'.jsonl': 'items/full',
+                     '_append.jsonl': 'items_append/full'}
+
     def __init__(self, raw_dir):
         # save data folders
         raw_dir = os.path.abspath(raw_dir)
@@ -66,11 +200,17 @@ class polyvore_parser(object):
         self.items = None
         self.sets = None
         self.failed_images = None
+        self.duplicate_report = None
+        # shared strings and category tuples, see _intern()
+        self._interned = {}
         self.progress_bar = ProgressBar()
 
-    def run(self):
-        self.parse_items()
-        self.parse_sets()
+    def run(self, pipelined=False):
+        if pipelined:
+            self.parse()
+        else:
+            self.parse_items()
+            self.parse_sets()
         self.clean()
 
     @staticmethod
@@ -86,7 +226,9 @@ class polyvore_parser(object):
                         Otherwise return False
             downloaded_info:
                 1. If the image has been recorded as downloaded,
-                   and in downloaded_images, return image name
+                   and in downloaded_images, return image name.
+                   An image that was not recorded but fetched later (named
+                   by the sha1 of its url) is also found this way
                 2. If the image has been recorded as downloaded,
                    but not in deed, return (image_url, 1)
                 3. If the image has not been recorded as downloaded,
@@ -94,7 +236,13 @@ class polyvore_parser(object):
         """
         downloaded_flag = False
         if len(item['images']) == 0:  # has not been downloaded
-            downloaded_info = (item['image_urls'], 0)
+            image_name = image_file_name(item['image_urls'][0]) \
+                if item['image_urls'] else None
+            if image_name in downloaded_images:  # fetched later
+                downloaded_flag = True
+                downloaded_info = image_name
+            else:
+                downloaded_info = (item['image_urls'], 0)
         else:  # image has been recorded as downloaded but not in deed
             image_name = item['images'][0]['path'].split('/')[-1]
             if image_name not in downloaded_images:
@@ -165,12 +313,21 @@ class polyvore_parser(object):
         # extract items in one set
         set_items = [[] for n in xrange(cfg.NumCate)]
         for url in urls:
-            if url in self.items:
-                image_name = self.items[url]['image']['name']
-                cate = cfg.ClassIdx[self.items[url]['class']]
-                set_items[cate].append(image_name)
+            item = self.items.get(url)
+            if item is not None:
+                set_items[cfg.ClassIdx[item.cls]].append(item.image_name)
         return set_items
 
+    def _intern(self, value):
+        """ The shared copy of an equal string or tuple of strings
+        """
+        return self._interned.setdefault(value, value)
+
+    def _intern_categories(self, categories):
+        return self._intern(tuple(self._intern(category)
+                                  for category in categories))
+
+    @recorder.stage('parse_items')
     def parse_items(self):
         """ Parse all fashion items.
         Postconditions
@@ -184,11 +341,11 @@ class polyvore_parser(object):
                 'name' : 'item name, one like 3.1 Phillip Lim tops',
                 'price' : "the price like $ 81",
                 'text': 'the description'}
-        self.failed_images : failed downloaded image urls for each user
+        self.failed_images : failed downloaded images for each user, a list
+            of (image_urls, status, sub_dir) where status is that of
+            check_download() and sub_dir the image folder of the user,
+            see utils.downloader for fetching them again
         """
-        # two types of json files xxx_items.jsonl and xxx_items_append.jsonl
-        sub_dirs = {'.jsonl': 'items/full',
-                    '_append.jsonl': 'items_append/full'}
         # failed images for each user
         failed_images = {}
         # record {image_url: image info} into all_items
@@ -200,53 +357,82 @@ class polyvore_parser(object):
             # split the name of json file
             user_name, ftype = self.item_jsonls[n].split('_items')
             # if ignore then skip this user_name
-            if user_name in cfg.IgnoreUsers:
-                continue
-            # only parse watch user for debug
-            if cfg.WatchUsersFlag and user_name not in cfg.WatchUsers:
+            if not self._is_parsed_user(user_name):
                 continue
             # image folder for items
-            imgdir = os.path.join(self.image_dir, user_name, sub_dirs[ftype])
+            imgdir = os.path.join(self.image_dir, user_name,
+                                  self.item_sub_dirs[ftype])
             # list downloaded images
-            downloaded_images = list_files(imgdir, ('jpg', 'png'))
+            downloaded_images = set(list_files(imgdir, ('jpg', 'png')))
             # open the corresponding JOSN file for this user
             with open(os.path.join(self.item_dir, self.item_jsonls[n])) as f:
                 item_jsonl = f.readlines()
-            # update the number of items
-            for line in item_jsonl:
-                # read one item
-                item = json.loads(line)
-                # skip non-fashion item
-                if not item['isfashion']:
-                    continue
-                downloaded, info = self.check_download(item, downloaded_images)
-                if downloaded:  # if downloaded, save the information of item
-                    image_name = info
-                    image_path = os.path.join(imgdir, image_name)
-                    item_url = item['url']
-                    checksum = item['images'][0]['checksum']
-                    cate = self.find_category(item['categories'], item['name'])
-                    if cate == -1 or item_url in all_items:
-                        # if not the category we want or has been recorded
-                        continue
-                    else:
-                        # save this item
-                        all_items[item_url] = {
-                            'class': cfg.ClassName[cate],
-                            'image': {'name': image_name, 'path': image_path},
-                            'categories': item['categories'],
-                            'name': item['name'],
-                            'price': item['price'],
-                            'text': item['description'],
-                            'checksum': checksum}
-                else:
-                    # if image failed downloaded
-                    failed_images.setdefault(user_name, [])
-                    failed_images[user_name].append(info)
+            self._parse_item_lines(user_name, imgdir, downloaded_images,
+                                   item_jsonl, all_items, failed_images)
         self.progress_bar.end()
+        recorder.count('items_parsed', len(all_items))
+        recorder.count('images_skipped',
+                       sum(len(urls) for urls in failed_images.values()))
         self.items = all_items
         self.failed_images = failed_images
 
+    def _is_parsed_user(self, user_name):
+        # if ignore then skip this user_name
+        if user_name in cfg.IgnoreUsers:
+            return False
+        # only parse watch user for debug
+        if cfg.WatchUsersFlag and user_name not in cfg.WatchUsers:
+            return False
+        return True
+
+    def _parse_item_lines(self, user_name, imgdir, downloaded_images,
+                          item_jsonl, all_items, failed_images,
+                          rejected_urls=None):
+        """ Parse lines of one item file into all_items and failed_images.
+            Urls of items that are never saved, whoever lists them, are
+            added to rejected_urls if given.
+        """
+        recorder.count('item_files')
+        recorder.count('item_lines', len(item_jsonl))
+        # update the number of items
+        for line in item_jsonl:
+            # read one item
+            item = json.loads(line)
+            # skip non-fashion item
+            if not item['isfashion']:
+                if rejected_urls is not None:
+                    rejected_urls.add(item['url'])
+                continue
+            downloaded, info = self.check_download(item, downloaded_images)
+            if downloaded:  # if downloaded, save the information of item
+                image_name = info
+                image_path = os.path.join(imgdir, image_name)
+                item_url = item['url']
+                if item['images']:
+                    checksum = item['images'][0]['checksum']
+                else:
+                    checksum = file_checksum(image_path)
+                cate = self.find_category(item['categories'], item['name'])
+                if cate == -1 or item_url in all_items:
+                    # if not the category we want or has been recorded
+                    if cate == -1 and rejected_urls is not None:
+                        rejected_urls.add(item_url)
+                    continue
+                else:
+                    # save this item
+                    all_items[item_url] = ItemRecord(
+                        cfg.ClassName[cate],
+                        self._intern_categories(item['categories']),
+                        item['name'], self._intern(item['price']),
+                        item['description'], imgdir, image_name, checksum)
+            else:
+                # if image failed downloaded
+                sub_dir = os.path.relpath(
+                    imgdir, os.path.join(self.image_dir, user_name))
+                failed_images.setdefault(user_name, [])
+                failed_images[user_name].append(info + (sub_dir,))
+
+    @recorder.stage('parse_sets')
     def parse_sets(self):
         """ Parse sets for each user.
             Postconditions
@@ -255,6 +441,7 @@ class polyvore_parser(object):
                 paris of `{user name: all_sets}`. For each user, it stores:
                 all_sets['invalid']: an unsuccessful downloaded
                 all_sets['valid']: type of list, for each valid set
+                    valid_set: a SetRecord, read like a dict
                     valid_set['url']: set url
                     valid_set['image']: path to fashion set image
                     valid_set['items']: fashion items indicting by item urls
@@ -270,142 +457,372 @@ class polyvore_parser(object):
             self.progress_bar.forward()
             # user name and its set image folder
             user = self.set_jsonls[n].split('_sets')[0]
-            # image directory for sets
-            image_dir = os.path.join(self.image_dir, user, 'sets/full/')
-            if (user in cfg.IgnoreUsers):
-                continue
-            if cfg.WatchUsersFlag and (user not in cfg.WatchUsers):
+            if not self._is_parsed_user(user):
                 continue
             with open(os.path.join(self.set_dir, self.set_jsonls[n])) as f:
                 set_jsonl = f.readlines()
-            valid_sets = list([])
-            invalid_sets = list([])
-            for line in set_jsonl:
-                one_set = json.loads(line)
-                item_urls = [cfg.BaseUrl + u.lstrip('.')
-                             for u in one_set['item_urls']]
-                # extract items in one set
-                set_items = self.get_set_items_by_image(item_urls)
-                if self.check_item_num(set_items):
-                    # size = [len(items) for items in set_items]
-                    # assert(any(size) > 0)
-                    set_image = one_set['images']
-                    if len(set_image) is 0:
-                        image_path = ''
-                    else:
-                        image_name = set_image[0]['path'].split('/')[-1]
-                        image_path = os.path.join(image_dir, image_name)
-                    valid_sets.append({'url': one_set['url'],
-                                       'items': set_items,
-                                       'image': image_path})
-                else:
-                    invalid_sets.append(one_set['url'])
+            entries = self._parse_set_lines(user, set_jsonl)
             # store all information about sets, organized by user name
-            sets[user] = {'valid': valid_sets, 'invalid': invalid_sets}
+            sets[user] = self._split_set_entries(entries)
         self.sets = sets
         self.progress_bar.end()
 
+    def _parse_set_lines(self, user, set_jsonl, rejected_urls=None):
+        """ Parse lines of one set file.
+            If rejected_urls is given, sets that refer to items which have
+            not been parsed yet, but are not in rejected_urls, are deferred:
+            their items is None and item_urls are kept for
+            _resolve_set_entry().
+            Return
+            ------
+            entries: list of SetRecord for each set
+        """
+        # image directory for sets
+        image_dir = os.path.join(self.image_dir, user, 'sets/full/')
+        entries = []
+        for line in set_jsonl:
+            one_set = json.loads(line)
+            item_urls = [cfg.BaseUrl + u.lstrip('.')
+                         for u in one_set['item_urls']]
+            set_image = one_set['images']
+            if len(set_image) == 0:
+                image_name = None
+            else:
+                image_name = set_image[0]['path'].split('/')[-1]
+            entry = SetRecord(one_set['url'], image_dir, image_name)
+            if rejected_urls is not None and any(
+                    url not in self.items and url not in rejected_urls
+                    for url in item_urls):
+                entry.item_urls = item_urls
+            else:
+                # extract items in one set
+                entry.items = self.get_set_items_by_image(item_urls)
+            entries.append(entry)
+        return entries
+
+    def _resolve_set_entry(self, entry):
+        """ Extract items of a deferred set after all items are parsed
+        """
+        entry.items = self.get_set_items_by_image(entry.item_urls)
+        entry.item_urls = None
+
+    def _split_set_entries(self, entries):
+        """ Split set entries into valid sets and urls of invalid sets
+        """
+        valid_sets = list([])
+        invalid_sets = list([])
+        for entry in entries:
+            if self.check_item_num(entry.items):
+                valid_sets.append(entry)
+            else:
+                invalid_sets.append(entry.url)
+        recorder.count('set_files')
+        recorder.count('sets_valid', len(valid_sets))
+        recorder.count('sets_invalid', len(invalid_sets))
+        return {'valid': valid_sets, 'invalid': invalid_sets}
+
+    @recorder.stage('parse')
+    def parse(self, prefetch=4):
+        """ Parse items and sets of each user in one pass, the pipelined
+            version of parse_items() and parse_sets().
+            Files of the next users are read by a thread while the current
+            one is decoded. Sets are resolved against the items parsed so
+            far, and only sets that refer to items which have not been
+            parsed yet are deferred to a final pass. Items whose image (see
+            image_groups()) no valid set refers to are dropped at the end.
+            If an item is listed by more than one user, the first user in
+            the order of item files wins as in parse_items(), except that
+            all item files of a user are parsed together.
+            Parameter
+            ---------
+            prefetch: number of users read ahead
+            Postconditions
+            --------------
+            self.items, self.failed_images: see parse_items()
+            self.sets: see parse_sets()
+        """
+        # item files and set file of each user, in the order of item files
+        users = OrderedDict()
+        for jsonl in self.item_jsonls:
+            user_name = jsonl.split('_items')[0]
+            users.setdefault(user_name, ([], []))[0].append(jsonl)
+        for jsonl in self.set_jsonls:
+            user_name = jsonl.split('_sets')[0]
+            users.setdefault(user_name, ([], []))[1].append(jsonl)
+        jobs = [(user, item_files, set_files)
+                for user, (item_files, set_files) in users.items()
+                if self._is_parsed_user(user)]
+        self.items = {}
+        self.failed_images = {}
+        sets = {}
+        # users that have deferred sets
+        deferred = OrderedDict()
+        rejected_urls = set()
+        self.progress_bar.reset(max(len(jobs), 1), 'Parsing users')
+        for user, item_files, set_files in self._prefetch(jobs, prefetch):
+            self.progress_bar.forward()
+            # lines of each file are released as soon as they are parsed
+            while item_files:
+                imgdir, downloaded_images, item_jsonl = item_files.pop(0)
+                self._parse_item_lines(user, imgdir, downloaded_images,
+                                       item_jsonl, self.items,
+                                       self.failed_images, rejected_urls)
+                downloaded_images = item_jsonl = None
+            entries = []
+            has_sets = len(set_files) > 0
+            while set_files:
+                entries += self._parse_set_lines(user, set_files.pop(0),
+                                                 rejected_urls)
+            if not has_sets:
+                continue
+            if any(entry.items is None for entry in entries):
+                deferred[user] = entries
+            else:
+                sets[user] = self._split_set_entries(entries)
+        self.progress_bar.end()
+        # resolve the deferred sets against all items
+        for user, entries in deferred.items():
+            for entry in entries:
+                if entry.items is None:
+                    self._resolve_set_entry(entry)
+                    recorder.count('sets_deferred')
+            sets[user] = self._split_set_entries(entries)
+        self.sets = sets
+        # drop items whose image is not in any valid set
+        canonical = self.image_groups()
+        image_names = set()
+        for all_sets in sets.values():
+            for one_set in all_sets['valid']:
+                for names in one_set.items:
+                    image_names.update(canonical[name] for name in names)
+        num_items = len(self.items)
+        self.items = dict(
+            (url, info) for url, info in self.items.items()
+            if canonical[info.image_name] in image_names)
+        recorder.count('items_parsed', num_items)
+        recorder.count('items_dropped', num_items - len(self.items))
+        recorder.count('images_skipped', sum(
+            len(urls) for urls in self.failed_images.values()))
+
+    def _prefetch(self, jobs, prefetch):
+        """ Read files of each user in a thread.
+            Yield
+            -----
+            (user, item_files, set_files), where item_files is a list of
+            (image folder, downloaded images, lines) and set_files a list of
+            lines
+        """
+        queue = Queue.Queue(maxsize=prefetch)
+        # set when the consumer stops, e.g. on an exception
+        stop = threading.Event()
+
+        def put(job):
+            while not stop.is_set():
+                try:
+                    queue.put(job, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for user, item_jsonls, set_jsonls in jobs:
+                    item_files = []
+                    for jsonl in item_jsonls:
+                        ftype = jsonl.split('_items')[1]
+                        imgdir = os.path.join(self.image_dir, user,
+                                              self.item_sub_dirs[ftype])
+                        downloaded_images = set(
+                            list_files(imgdir, ('jpg', 'png')))
+                        with open(os.path.join(self.item_dir, jsonl)) as f:
+                            item_files.append(
+                                (imgdir, downloaded_images, f.readlines()))
+                    set_files = []
+                    for jsonl in set_jsonls:
+                        with open(os.path.join(self.set_dir, jsonl)) as f:
+                            set_files.append(f.readlines())
+                    if not put((user, item_files, set_files)):
+                        return
+                    del item_files, set_files
+                put(None)
+            except Exception as e:
+                put(e)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                job = queue.get()
+                if job is None:
+                    break
+                if isinstance(job, Exception):
+                    raise job
+                yield job
+                # do not hold the files of this user while reading the next
+                job = None
+        finally:
+            stop.set()
+            reader.join()
+
+    def image_groups(self):
+        """ Group images of items that are the same, that is the image
+            names are the same or the images have the same checksum (and the
+            items are in the same class).
+            Return
+            ------
+            canonical: Pairs of {image name: canonical image name}, the
+                canonical name is the smallest name in its group
+        """
+        parent = {}
+
+        def find(name):
+            root = name
+            while parent[root] != root:
+                root = parent[root]
+            # path compression
+            while parent[name] != root:
+                parent[name], name = root, parent[name]
+            return root
+
+        first_name = {}
+        for info in self.items.itervalues():
+            image_name = info.image_name
+            parent.setdefault(image_name, image_name)
+            key = (info.checksum, info.cls)
+            if key not in first_name:
+                first_name[key] = image_name
+                continue
+            root_a, root_b = find(image_name), find(first_name[key])
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        return dict((image_name, find(image_name)) for image_name in parent)
+
+    @recorder.stage('clean')
     def clean(self):
         """ Clean sets and items
+            Items of the same image (see image_groups()) are merged into
+            one fashion item named by the canonical image name, and sets
+            refer to it by that name.
             Postconditions
             --------------
             self.fashion_items: for all fashion items
             self.fashion_sets: for all fashion sets
+            self.duplicate_report: Type of dict
+                {'images': number of images shared by more than one item,
+                 'items_merged': number of items merged into others,
+                 'files': number of duplicate image files,
+                 'bytes_avoided': total size of duplicate image files}
         """
         if (self.sets is None):
             print ("No sets has been parsed, "
                    "so automatically run parse_sets() first!")
             self.parse_sets()
+        canonical = self.image_groups()
+        # rename images in sets with canonical names
         item_image_set = set()
         fashion_sets = []
         size = len(self.sets)
         self.progress_bar.reset(size, 'Cleaning fashion sets')
-        for key, all_sets in self.sets.iteritems():
+        # in the order of users, so that the output does not depend on the
+        # order of the dict
+        for key in sorted(self.sets):
             self.progress_bar.forward()
+            all_sets = self.sets[key]
             if len(all_sets['valid']) == 0:
                 continue
             for one_set in all_sets['valid']:
-                for i in xrange(cfg.NumCate):
-                    for image_name in one_set['items'][i]:
-                        item_image_set.add(image_name)
+                one_set.items = [
+                    [canonical[image_name] for image_name in image_names]
+                    for image_names in one_set.items]
+                for image_names in one_set.items:
+                    item_image_set.update(image_names)
             fashion_sets.append(all_sets['valid'])
         self.progress_bar.end()
-        # check duplicate items url that points to the same image
-        duplicate_image_url = {}
-        for url, info in self.items.iteritems():
-            image_name = info['image']['name']
-            if image_name in duplicate_image_url:
-                duplicate_image_url[image_name].append(url)
-            else:
-                duplicate_image_url[image_name] = [url]
-        # clean fashion items
+        # clean fashion items, merge items in the same group
         fashion_items = {}
-        size = len(duplicate_image_url)
-        self.progress_bar.reset(size, 'Cleaning fashion items')
-        for image_name, urls in duplicate_image_url.iteritems():
+        image_pathes = {}
+        num_items = 0
+        self.progress_bar.reset(len(self.items), 'Cleaning fashion items')
+        # in the order of urls, so that merging is reproducible
+        for url in sorted(self.items):
             self.progress_bar.forward()
+            item = self.items[url]
+            image_name = canonical[item.image_name]
             # item must in at least one fashion set
             if image_name not in item_image_set:
                 continue
-            for url in urls:
-                # more than one images
-                item = self.items[url]
-                if image_name not in fashion_items:
-                    fashion_items[image_name] = {
-                        'class': item['class'],
-                        'categories': item['categories'],
-                        'name': item['name'],
-                        'price': item['price'],
-                        'text': item['text']}
-                else:
-                    # add category
-                    category = fashion_items[image_name]['categories']
-                    category += item['categories']
-                    category = list(set(category))
-                    fashion_items[image_name]['categories'] = category
-                    # if previous item has no name
-                    name = fashion_items[image_name]['name']
-                    if len(name) == 0:
-                        fashion_items[image_name]['name'] = item['name']
-                    # if previous item has no description
-                    text = fashion_items[image_name]['text']
-                    if len(text) == 0:
-                        fashion_items[image_name]['text'] = item['text']
+            num_items += 1
+            image_pathes.setdefault(image_name, set()).add(item.image_path)
+            if image_name not in fashion_items:
+                fashion_items[image_name] = ItemRecord(
+                    item.cls, item.categories, item.name, item.price,
+                    item.text)
+                continue
+            merged = fashion_items[image_name]
+            # add category
+            added = []
+            for category in item.categories:
+                if category not in merged.categories and \
+                        category not in added:
+                    added.append(category)
+            if added:
+                merged.categories = self._intern(
+                    merged.categories + tuple(added))
+            # if previous item has no name
+            if len(merged.name) == 0:
+                merged.name = item.name
+            # if previous item has no description
+            if len(merged.text) == 0:
+                merged.text = item.text
         self.progress_bar.end()
+        # size of duplicate image files
+        report = {'images': 0, 'files': 0, 'bytes_avoided': 0,
+                  'items_merged': num_items - len(fashion_items)}
+        for image_name, pathes in image_pathes.iteritems():
+            if len(pathes) == 1:
+                continue
+            report['images'] += 1
+            # keep one file of each image
+            for path in sorted(pathes)[1:]:
+                report['files'] += 1
+                if os.path.isfile(path):
+                    report['bytes_avoided'] += os.path.getsize(path)
+        print ("{} duplicate image files ({} bytes) are merged".format(
+            report['files'], report['bytes_avoided']))
+        recorder.count('users', len(fashion_sets))
+        recorder.count('items', len(fashion_items))
+        recorder.count('items_merged', report['items_merged'])
+        recorder.count('bytes_avoided', report['bytes_avoided'])
         self.fashion_items = fashion_items
         self.fashion_sets = fashion_sets
+        self.duplicate_report = report
 
-    def move_images(self, outdir):
-        """ Move items and sets images
+    def image_sources(self):
+        """ Images of fashion items and sets to move
+            Return
+            ------
+            item_images: list of (image path, item class)
+            set_images: list of image paths of sets that have an image
         """
         if (self.fashion_items is None):
             self.clean()
-        self.progress_bar.reset(len(self.fashion_items), 'Moving item images')
         image_pathes = {}
         for url, info in self.items.iteritems():
-            image_name = info['image']['name']
-            image_pathes[image_name] = info['image']['path']
-        itemdir = os.path.join(outdir, 'items')
-        for subdir in cfg.ClassName:
-            check_dir(os.path.join(itemdir, subdir), action='mkdir')
-        for image_name, info in self.fashion_items.iteritems():
-            self.progress_bar.forward()
-            image_path = image_pathes[image_name]
-            subdir = info['class']
-            shutil.copy2(image_path, os.path.join(itemdir, subdir))
-        self.progress_bar.end()
-        self.progress_bar.reset(len(self.fashion_sets), 'Moving set images')
-        setdir = os.path.join(outdir, 'sets')
-        check_dir(setdir, action='mkdir')
-        for sets in self.fashion_sets:
-            self.progress_bar.forward()
-            for one_set in sets:
-                image_path = one_set['image']
-                if len(image_path) == 0:
-                    continue
-                else:
-                    shutil.copy2(image_path, setdir)
-        self.progress_bar.end()
+            image_pathes[info.image_name] = info.image_path
+        item_images = [(image_pathes[image_name], info.cls)
+                       for image_name, info in self.fashion_items.iteritems()]
+        set_images = [one_set.image for sets in self.fashion_sets
+                      for one_set in sets if len(one_set.image) > 0]
+        return item_images, set_images
+
+    @recorder.stage('move_images')
+    def move_images(self, outdir):
+        """ Move items and sets images
+        """
+        item_images, set_images = self.image_sources()
+        copy_images(item_images, set_images, outdir, self.progress_bar)
 
     def savez(self, outdir):
         """ Save all_items and all_sets
@@ -418,10 +835,15 @@ class polyvore_parser(object):
         if check_files(file_list, 'any', verbose=False):
             print ("Failed to save, in case of overriding previous files.")
             return
+        fashion_sets = [[one_set.to_dict() for one_set in sets]
+                        for sets in self.fashion_sets]
         with open(os.path.join(outdir, 'fashion_sets.pickle'), 'wb') as f:
-            pickle.dump(self.fashion_sets, f)
+            pickle.dump(fashion_sets, f)
+        del fashion_sets
+        fashion_items = dict((image_name, info.to_dict()) for image_name, info
+                             in self.fashion_items.iteritems())
         with open(os.path.join(outdir, 'fashion_items.pickle'), 'wb') as f:
-            pickle.dump(self.fashion_items, f)
+            pickle.dump(fashion_items, f)
 
 
 def load_pkl(pkl_dir):
@@ -451,23 +873,54 @@ def take_users(idxs, data_set):
     return [data_set[u] for u in idxs]
 
 
-def clip_data(data_set, clip):
+def clip_data(data_set, clip, random=None):
     """ Clip fasion sets for each user
         Parameter
         ---------
         data_set: Type of list, fashhion sets for each user
                   data_set[i]: Type of set
         clip: Maximum number of fashion sets
+        random: np.random.RandomState to choose which sets are kept,
+                if None the first clip sets in sorted order are kept
         Return
         ------
         clipped data sets
     """
-    return [set(list(sets)[0:clip]) for sets in data_set]
+    clipped = []
+    for sets in data_set:
+        sets = sorted(sets)
+        if random is not None:
+            random.shuffle(sets)
+        clipped.append(set(sets[0:clip]))
+    return clipped
+
+
+def hash_sets(data_set):
+    """ Content hash of fashion sets for each user
+        Parameter
+        ---------
+        data_set: Type of list, fashhion sets for each user
+                  data_set[i]: Type of set
+        Return
+        ------
+        sha1 hex digest, independent of the iteration order of each set
+    """
+    sha1 = hashlib.sha1()
+    for uid, sets in enumerate(data_set):
+        for tpl in sorted(sets):
+            line = u'{}\t{}\n'.format(uid, u'\t'.join(
+                u'{}'.format(t) for t in tpl))
+            sha1.update(line.encode('utf-8'))
+    return sha1.hexdigest()
 
 
 class concise_sets(object):
     """ Convert fashion_sets to concise_sets
         Override method convert_set() to define how to convert one fashion set
+        Usage
+        -----
+        >> sets = utils.polyvore.concise_sets(fashion_sets).iter_sets(clip)
+        >> spliter = utils.polyvore.polyvore_spliter(sets)
     """
     def __init__(self, fashion_sets, clip=0):
         self.fashion_sets = fashion_sets
@@ -495,35 +948,52 @@ class concise_sets(object):
                 sets.append(tuple(one_set))
         return sets
 
-    def run(self, clip=0):
-        """ Read the origin data to a concise data structure and remove users
-            that have insufficient fashion sets.
+    def iter_sets(self, clip=0):
+        """ Generator version of run(), yield one user's concise sets at a time
+            so that only the current user is held in memory.
+            Parameters
+            ----------
+            clip: Users with fewer than clip fashion tuples are skipped
+            Yield
+            -----
+            set_tuples: Type of set, deduplicated tuples for one user
         """
-        concise_sets = []
         for all_sets in self.fashion_sets:
             # parse one user's fashion sets
-            set_tuples = []
+            set_tuples = set()
+            num_tuples = 0
             for one_set in all_sets:
                 # parse each valid set
-                set_tuples += self.convert_set(one_set['items'])
-            concise_sets.append(set_tuples)
-        clipped_sets = []
-        for sets in concise_sets:
-            if len(sets) < clip:
+                tuples = self.convert_set(one_set['items'])
+                num_tuples += len(tuples)
+                set_tuples.update(tuples)
+            # duplicated tuples are counted as run() always did
+            if num_tuples < clip:
                 continue
-            clipped_sets.append(set(sets))
-        return clipped_sets
+            yield set_tuples
+
+    def run(self, clip=0):
+        """ Read the origin data to a concise data structure and remove users
+            that have insufficient fashion sets.
+            Use iter_sets() to stream users into polyvore_spliter instead.
+        """
+        return list(self.iter_sets(clip))
 
 
 class polyvore_spliter(object):
     """ Class for generating polyvore training, validation and test data
         Constructor
         -----------
-        polyvore_data(sets, min_size)
+        polyvore_data(sets, min_size, seed)
             sets: Type of list
                   sets[i]: Type of set, save a set of (top, bottom, shoe)
                            for i-th user
+                  or an iterable yielding such a set for each user, e.g.
+                  concise_sets.iter_sets(). An iterable is consumed once.
             min_size: minimal size for train / val / test
+            seed: seed for splitting and leaving users out, the same input
+                  and seed always give the same data sets, whether sets is
+                  a list or an iterable
         Attribute
         ---------
         datasets: Separated data sets for each pahse
@@ -543,12 +1013,15 @@ class polyvore_spliter(object):
                 if dtype == 'raw' the fashion sets is
                     (top image, bottom image, top image)
             is_leaved: If True, return data set that leaved out (S0) else S1
+        digest(is_leaved): Content hash of data set for each phase
     """
-    def __init__(self, sets, min_size=[250, 20, 20]):
+    def __init__(self, sets, min_size=[250, 20, 20], seed=None):
         self.min_size = min_size
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
         self.num_items, self.num_sets = None, None
         self.image_dict, self.image_list = None, None
-        self.num_users = len(sets)
+        self.num_users = None
         self.raw_sets = sets
         self.datasets = [set(), set(), set()]
         # splited data sets for training / val / test
@@ -568,6 +1041,17 @@ class polyvore_spliter(object):
         else:
             return datasets
 
+    def digest(self, is_leaved=False):
+        """ Content hash of data set for each phase, which can be used as
+            the key to cache results of later stages.
+            Return
+            ------
+            digests: Pairs of {phase: sha1 hex digest}
+        """
+        datasets = self.get_datesets(is_leaved, dtype='raw')
+        return dict((phase, hash_sets(datasets[n]))
+                    for n, phase in enumerate(cfg.Phase))
+
     def run(self, usize=80):
         """ Run spliter, split the data set and leave some users out randomly
             Postconditions
@@ -587,7 +1071,7 @@ class polyvore_spliter(object):
         """
         if not self._splited_:
             self.split()
-        idxs = np.random.permutation(self.num_users)
+        idxs = self.random.permutation(self.num_users)
         small_idx = idxs[0:usize]
         large_idx = idxs[usize:]
         S0, S1 = [], []
@@ -609,7 +1093,7 @@ class polyvore_spliter(object):
                 for one_set in sets:
                     for n in xrange(cfg.NumCate):
                         image_set[n].add(one_set[n])
-        image_list = [list(image_set[n]) for n in xrange(cfg.NumCate)]
+        image_list = [sorted(image_set[n]) for n in xrange(cfg.NumCate)]
         nitems = [len(image_list[n]) for n in xrange(cfg.NumCate)]
         image_dict = [{} for n in xrange(cfg.NumCate)]
         for n in xrange(cfg.NumCate):
@@ -638,7 +1122,7 @@ class polyvore_spliter(object):
             for one_set in sets:
                 for n in xrange(cfg.NumCate):
                     item_set[n].add(one_set[n])
-        image_list = [list(item_set[n]) for n in xrange(cfg.NumCate)]
+        image_list = [sorted(item_set[n]) for n in xrange(cfg.NumCate)]
         num_items = [len(image_list[n]) for n in xrange(cfg.NumCate)]
         for n in xrange(cfg.NumCate):
             for idx in xrange(num_items[n]):
@@ -657,7 +1141,7 @@ class polyvore_spliter(object):
         for n in xrange(cfg.NumPhase):
             id_sets = [set() for u in xrange(num_users)]
             for uid, sets in enumerate(datasets[n]):
-                for one_set in sets:
+                for one_set in sorted(sets):
                     id_tpl = tuple(self.image_dict[c][one_set[c]]
                                    for c in xrange(cfg.NumCate))
                     id_sets[uid].add(id_tpl)
@@ -681,71 +1165,97 @@ class polyvore_spliter(object):
             --------------
             self.datasets: Fashion sets for each phase
         """
+        # restart the random state so that every split is reproducible
+        self.random = np.random.RandomState(self.seed)
         self.datasets = self._split_()
         self.update()
         self._splited_ = True
 
     def _split_(self):
-        # split data set into three sets
-        print ("Spliting data coarsely...")
-        log = "Spliting data for training..."
-        train, left = self._split_once(self.raw_sets, self.min_size[0], log)
-        # split the left set into two sets
-        log = "Spliting data for test ..."
-        test, val = self._split_once(left, self.min_size[2], log)
-        print("Done! Hold left data for validation")
-        datasets = [train, val, test]
-        # Check the partition for fashion sets
-        assert (len(datasets[0]) == len(datasets[1]) == len(datasets[2]))
-        num_users = len(datasets[0])
-        # check whcih user satisfies the minimal constrains
-        idxs = [u for u in xrange(num_users) if (
-            len(datasets[0][u]) >= self.min_size[0] and
-            len(datasets[1][u]) >= self.min_size[1] and
-            len(datasets[2][u]) >= self.min_size[2])]
-        # clean data set
-        for n in xrange(cfg.NumPhase):
-            datasets[n] = take_users(idxs, datasets[n])
-            datasets[n] = clip_data(datasets[n], self.min_size[n] + 10)
+        return self._split_users(self.raw_sets)
+
+    def _user_random(self, uid):
+        """ Random state of the uid-th user of the input, seeded by
+            (seed, uid) so that it does not depend on other users
+        """
+        if self.seed is None:
+            return np.random.RandomState()
+        return np.random.RandomState([self.seed, uid])
+
+    @recorder.stage('split_users')
+    def _split_users(self, sets):
+        """ Split fashion sets into train / val / test one user at a time.
+            sets is a list or an iterable of each user's sets, users that
+            do not satisfy the minimal constrains are dropped as soon as
+            they are split, so only one user's raw sets of an iterable are
+            held. Each user is split with its own random state, so a list
+            and an iterable of the same sets give the same data sets.
+        """
+        print ("Spliting data user by user...")
+        datasets = [[], [], []]
+        num_read = 0
+        for uid, user_sets in enumerate(sets):
+            num_read += 1
+            recorder.count('sets', len(user_sets))
+            phases = self._split_phases(user_sets, self._user_random(uid))
+            if phases is None:
+                continue
+            for n in xrange(cfg.NumPhase):
+                datasets[n].append(phases[n])
+            recorder.count('users_kept')
+        print ("Done! {} of {} users are kept".format(
+            len(datasets[0]), num_read))
         return datasets
 
-    def _split_once(self, sets, min_size, log='Spliting'):
-        """ To split at least min_size positive outfits for each user.
-            Separated outfits has no overlap with left outfits for each user.
-            Parameter
-            ---------
-            sets: Fashion sets (type of tuple) for each user, type of list
-            min_size: Minimum number of sets for each user
+    def _split_phases(self, user_sets, random):
+        """ Split one user's fashion sets into train / val / test
             Return
             ------
-            sept_sets: Separated fashion sets, each user has at least min_size
-            rest_sets: Fashion sets have been left
+            phases: [train, val, test] clipped to min_size + 10 sets, None
+                    if the user does not satisfy the minimal constrains
         """
-        sept_sets = [set() for u in xrange(len(sets))]
-        rest_sets = [set() for u in xrange(len(sets))]
-        self.progress_bar.reset(len(sets), log)
-        for u in xrange(len(sets)):
-            self.progress_bar.forward()
-            # parted and left outfits for this users
-            num = len(sets[u])
-            part_set = set()
-            left_set = sets[u]
-            while (min_size >= len(part_set) != num):
-                # do split once
-                pset, left_set = self._atom_split(left_set)
-                # append posi_tuples
-                part_set |= pset
-            rest_sets[u] = left_set
-            sept_sets[u] = part_set
-        self.progress_bar.end()
-        return sept_sets, rest_sets
+        train, left = self._split_user(user_sets, self.min_size[0], random)
+        test, val = self._split_user(left, self.min_size[2], random)
+        phases = [train, val, test]
+        if any(len(phases[n]) < self.min_size[n]
+               for n in xrange(cfg.NumPhase)):
+            return None
+        return [clip_data([phases[n]], self.min_size[n] + 10, random)[0]
+                for n in xrange(cfg.NumPhase)]
 
-    def _atom_split(self, tuple_set):
+    def _split_user(self, tuple_set, min_size, random):
+        """ Split at least min_size fashion sets from one user's sets.
+            random is the random state of the user, see _user_random()
+            Return
+            ------
+            part_set: Separated fashion sets
+            left_set: Fashion sets have been left
+        """
+        # parted and left outfits for this users
+        num = len(tuple_set)
+        part_set = set()
+        left_set = tuple_set
+        # start each partition in a seeded order rather than set order
+        order = sorted(tuple_set)
+        random.shuffle(order)
+        pos = 0
+        while (min_size >= len(part_set) != num):
+            # skip the tuples that have been separated
+            while order[pos] in part_set:
+                pos += 1
+            # do split once
+            pset, left_set = self._atom_split(left_set, order[pos])
+            # append posi_tuples
+            part_set |= pset
+        return part_set, left_set
+
+    def _atom_split(self, tuple_set, start=None):
         """ Split one user's fashion sets that two separated sets have no
             overlapping items.
             Parameter
             ---------
             tuple_set: A set of fashion tuples
+            start: The tuple to start partition, pop one if None
             Return
             ------
             part_set: minimal separated set
@@ -759,7 +1269,11 @@ class polyvore_spliter(object):
         if len(tuple_set) == 0:
             return items, part_set, left_set
         # pop one tuple
-        tpl = left_set.pop()
+        if start is None:
+            tpl = left_set.pop()
+        else:
+            tpl = start
+            left_set.remove(tpl)
         part_set.add(tpl)
         items = [set(tpl[n]) for n in xrange(cfg.NumCate)]
         # loop until the size of part_set not increase
@@ -778,11 +1292,36 @@ class polyvore_spliter(object):
         return part_set, left_set
 
 
+def shard_users(counts, num_shards):
+    """ Split users into contiguous ranges with about the same number of
+        tuples.
+        Parameters
+        ----------
+        counts: number of tuples of each user
+        num_shards: number of ranges
+        Return
+        ------
+        bounds: array of shape (num_shards + 1, ), users of i-th shard are
+                range(bounds[i], bounds[i + 1])
+    """
+    cumsum = np.cumsum(counts)
+    total = cumsum[-1] if len(cumsum) else 0
+    targets = total * np.arange(1, num_shards) / float(num_shards)
+    bounds = np.searchsorted(cumsum, targets, side='left') + 1
+    bounds = np.minimum(bounds, len(counts))
+    return np.concatenate(([0], bounds, [len(counts)])).astype(np.int64)
+
+
 class Dataset(object):
     """ A class for data set for each phase
         Constructor
         -----------
         Dateset(datasets): Initialize a set of data for given phase
+        Methods
+        -------
+        run(ratio, factor): Create negative tuples
+        save(outdir, num_shards=None): Save tuples, in num_shards shards of
+            users if given, see DataFile.get_tuples() to read them
     """
 
     def __init__(self, datasets):
@@ -804,9 +1343,37 @@ class Dataset(object):
         for generators in self.generators:
             generators.run(ratio, factor)
 
-    def save(self, outdir):
+    def save(self, outdir, num_shards=None):
+        """ Save tuples of each phase.
+            If num_shards is given, users are split into num_shards
+            contiguous ranges balanced by their number of training tuples,
+            tuples of each range are saved in their own files (see
+            shard_file()), and manifest.json records the user range and the
+            number of rows of each file for each shard:
+            {'num_shards': num_shards, 'num_users': num_users,
+             'shards': [{'users': [start, end],
+                         'rows': {phase: {'posi': rows, 'nega': rows}}}]}
+        """
+        if num_shards is None:
+            for generators in self.generators:
+                generators.save(outdir)
+            return
+        train = self.generators[cfg.PhaseIdx['train']]
+        counts = np.bincount(train.positive_array[:, 0],
+                             minlength=self.num_users)
+        counts += np.bincount(train.negative_array[:, 0],
+                              minlength=self.num_users)
+        bounds = shard_users(counts, num_shards)
+        shards = [{'users': [int(bounds[i]), int(bounds[i + 1])], 'rows': {}}
+                  for i in xrange(num_shards)]
         for generators in self.generators:
-            generators.save(outdir)
+            rows = generators.save(outdir, bounds)
+            for shard, shard_rows in zip(shards, rows):
+                shard['rows'][generators.phase] = shard_rows
+        manifest = {'num_shards': num_shards, 'num_users': self.num_users,
+                    'shards': shards}
+        with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
 
 
 class NegativeGenerator(object):
@@ -889,6 +1456,10 @@ class NegativeGenerator(object):
         return negative
 
     def run(self, ratio, factor=2):
+        with recorder.stage('negative_{}'.format(self.phase)):
+            self._run(ratio, factor)
+
+    def _run(self, ratio, factor):
         # create negative tuples for each user
         self.negative_array = np.ndarray((0, self.col), dtype=np.int)
         self.progress_bar.reset(self.num_users, 'Creating negative tuples')
@@ -903,12 +1474,15 @@ class NegativeGenerator(object):
             negative2 = self.negative_tuples_type2(u, nrequired)
             negative = np.vstack((negative1, negative2))
             idxs = []
+            rejected = 0
             for idx, tpl in enumerate(negative):
                 if len(idxs) == nrequired:
                     break
                 if tuple(tpl[1:]) in self.positive_set:
+                    rejected += 1
                     continue
                 idxs.append(idx)
+            recorder.count('negatives_rejected', rejected)
             # take out qualified neg tuples, according to row idx
             negative = negative.take(idxs, axis=0)
             np.random.shuffle(negative)
@@ -916,19 +1490,45 @@ class NegativeGenerator(object):
             # nega tuples number of this user should be at least the ratio
             if len(negative) < nrequired:
                 print ("Need to increase factor, now it is {}".format(factor))
+                recorder.count('users_short')
+            recorder.count('negatives', len(negative))
         self.progress_bar.end()
 
-    def save(self, outdir):
+    def save(self, outdir, bounds=None):
         """ Save tuples.
+            Parameter
+            ---------
+            bounds: user bounds of shards, see shard_users(), tuples are
+                    saved in one file for each shard if given
+            Return
+            ------
+            rows: None, or {'posi': rows, 'nega': rows} for each shard
         """
         check_dir(outdir, action='mkdir')
         cols = ['user'] + cfg.ClassName
-        posi = pd.DataFrame(self.positive, columns=cols)
-        posi_fn = os.path.join(outdir, "tuples_{}_posi".format(self.phase))
-        posi.to_csv(posi_fn, index=False)
-        nega = pd.DataFrame(self.negative, columns=cols)
-        nega_fn = os.path.join(outdir, "tuples_{}_nega".format(self.phase))
-        nega.to_csv(nega_fn, index=False)
+        if bounds is None:
+            posi = pd.DataFrame(self.positive, columns=cols)
+            posi_fn = os.path.join(outdir,
+                                   "tuples_{}_posi".format(self.phase))
+            posi.to_csv(posi_fn, index=False)
+            nega = pd.DataFrame(self.negative, columns=cols)
+            nega_fn = os.path.join(outdir,
+                                   "tuples_{}_nega".format(self.phase))
+            nega.to_csv(nega_fn, index=False)
+            return None
+        num_shards = len(bounds) - 1
+        rows = [{} for _ in xrange(num_shards)]
+        for kind, array in [('posi', self.positive),
+                            ('nega', self.negative)]:
+            # tuples are in the order of users
+            starts = np.searchsorted(array[:, 0], bounds)
+            for n in xrange(num_shards):
+                shard = array[starts[n]:starts[n + 1]]
+                pd.DataFrame(shard, columns=cols).to_csv(
+                    shard_file(outdir, self.phase, kind, n, num_shards),
+                    index=False)
+                rows[n][kind] = len(shard)
+        return rows
 
     def _convert(self, array):
         res_array = np.empty_like(array)
@@ -3,6 +3,11 @@ from time import time as _time
 from collections import deque as _deque
 
 
+def _isatty():
+    isatty = getattr(_sys.stdout, 'isatty', None)
+    return bool(isatty is not None and isatty())
+
+
 class ProgressBar(object):
     """ Class for progress bar
         Usage
@@ -12,6 +17,10 @@ class ProgressBar(object):
             progress.forward()
             # executions
         progress.end() # finish
+        The bar is redrawn at most refresh_rate times per second, and nothing
+        is written if stdout is not a terminal (unless enabled=True), so
+        forward() is cheap enough for per-item loops. Use forward(n) to
+        advance n iterations at once.
     """
     # configuration of ProgressBar
     info = '%(cur)d/%(size)d'
@@ -24,8 +33,12 @@ class ProgressBar(object):
     # prefix and suffix to define marks
     prefix = ' |'
     suffix = '| '
-    # windos size of moving average for computing the speed
-    smooth_window = 100
+    # windos size (number of redraws) of moving average for the speed
+    smooth_window = 10
+    # maximum number of redraws per second
+    refresh_rate = 10
+    # whether to draw the bar, None to draw only if stdout is a terminal
+    enabled = None
 
     def __init__(self, size=1, message="Progress bar", **kwargs):
         # the message before the progress bar
@@ -35,14 +48,12 @@ class ProgressBar(object):
         assert (size > 0), 'None-negative size'
         # max iterations
         self._max_iter = size
-        # start time
-        self._start_time = _time()
-        # time queue for moving average
-        self._time_queue = _deque(maxlen=self.smooth_window + 1)
-        self._time_queue.append(self._start_time)
         # update configurations fo progress bar
         for key, value in kwargs.iteritems():
             self[key] = value
+        if self.enabled is None:
+            self.enabled = _isatty()
+        self._restart()
 
     @property
     def max(self):
@@ -54,6 +65,10 @@ class ProgressBar(object):
         # read only for current iteration
         return self._now_iter
 
+    # names used in info
+    size = max
+    cur = now
+
     def __getitem__(self, key):
         if key.startswith('_'):
             return None
@@ -63,6 +78,16 @@ class ProgressBar(object):
         if not key.startswith('_'):
             setattr(self, key, value)
 
+    def _restart(self):
+        # start time
+        self._start_time = _time()
+        # (time, iteration) of recent redraws for moving average
+        self._time_queue = _deque(maxlen=self.smooth_window + 1)
+        self._time_queue.append((self._start_time, 0))
+        # the earliest time and the iteration of next and last redraw
+        self._next_draw = self._start_time
+        self._drawn_iter = 0
+
     def line(self):
         """ Current line
         """
@@ -72,16 +97,14 @@ class ProgressBar(object):
         empty = self.empty * empty_size
         mesg = self._mesg % self
         info = self.info % self
-        now = _time()
-        self._time_queue.append(now)
-        elapsed_time = self._time_queue[-1] - self._time_queue[0]
-        second_per_iter = 1. * elapsed_time / (len(self._time_queue) - 1)
+        self._time_queue.append((_time(), self._now_iter))
+        first_time, first_iter = self._time_queue[0]
+        last_time, last_iter = self._time_queue[-1]
+        second_per_iter = 1. * (last_time - first_time) / max(
+            last_iter - first_iter, 1)
         speed = '({:.2e}s/iter)'.format(second_per_iter)
         line = ''.join([mesg, self.prefix, full, empty, self.suffix,
                         info, speed])
-        # drop the very first time
-        if self._now_iter == 1:
-            self._time_queue.popleft()
         return line
 
     def reset(self, size=None, message=None):
@@ -89,23 +112,38 @@ class ProgressBar(object):
             self._max_iter = size
         if message is not None:
             self._mesg = '\r' + message
-        self._start_time = _time()
         self._now_iter = 0
+        self._restart()
 
     def __iter__(self):
         return self
 
     def next(self):
         if self.cur < self.size:
-            self._now_iter += 1
-            _sys.stdout.write(self.line())
-            _sys.stdout.flush()
+            self.forward()
             return self.cur - 1
         else:
             raise StopIteration()
 
     def end(self):
+        if not self.enabled:
+            return
+        if self._drawn_iter != self._now_iter:
+            self._draw(_time())
         _sys.stdout.write('\n')
 
-    def forward(self):
-        self.next()
+    def forward(self, n=1):
+        """ Advance n iterations, redraw if it is time to
+        """
+        self._now_iter = min(self._now_iter + n, self._max_iter)
+        if not self.enabled:
+            return
+        now = _time()
+        if now >= self._next_draw or self._now_iter == self._max_iter:
+            self._draw(now)
+
+    def _draw(self, now):
+        _sys.stdout.write(self.line())
+        _sys.stdout.flush()
+        self._next_draw = now + 1. / self.refresh_rate
+        self._drawn_iter = self._now_iter
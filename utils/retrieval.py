@@ -0,0 +1,220 @@
+""" Exact top-k outfit retrieval for factorized compatibility scores.
+    The score of outfit (top, bottom, shoe) for a user is
+        sum_n unary_n[i_n] + sum_{m < n} pair_mn[i_m, i_n]
+    where unary_n[i] = <user, E_n[i]> and pair_mn[i, j] = <E_m[i], E_n[j]>.
+    Usage
+    -----
+    >> scorer = OutfitScorer(item_embs, user_emb)
+    >> outfits, scores = topk_outfits(scorer, k=10)
+"""
+import numpy as np
+from . import config as cfg
+
+
+class OutfitScorer(object):
+    """ User-additive and pairwise score of outfits
+        Constructor
+        -----------
+        OutfitScorer(item_embs, user_emb=None, pair_weight=1.)
+            item_embs: list of item embeddings for each category, the n-th
+                       one is of shape (num_items[n], dim), rows are in the
+                       order of DataFile.image_list[n]
+            user_emb: user embedding of shape (dim, ), None for no user term
+            pair_weight: weight of the pairwise terms
+        Methods
+        -------
+        unary(n): array of shape (num_items[n], )
+        pair(m, n, rows=None): pairwise scores of rows of m-th category
+                               with all items of n-th category
+        score(outfits): scores of outfits of shape (N, NumCate)
+    """
+    def __init__(self, item_embs, user_emb=None, pair_weight=1.):
+        assert (len(item_embs) == cfg.NumCate)
+        self.item_embs = [np.asarray(emb, dtype=np.float64)
+                          for emb in item_embs]
+        self.num_items = [len(emb) for emb in self.item_embs]
+        self.pair_weight = pair_weight
+        if user_emb is None:
+            self._unary = [np.zeros(n) for n in self.num_items]
+        else:
+            user_emb = np.asarray(user_emb, dtype=np.float64)
+            self._unary = [emb.dot(user_emb) for emb in self.item_embs]
+
+    def unary(self, n):
+        return self._unary[n]
+
+    def pair(self, m, n, rows=None):
+        emb = self.item_embs[m] if rows is None else self.item_embs[m][rows]
+        return self.pair_weight * emb.dot(self.item_embs[n].T)
+
+    def score(self, outfits):
+        outfits = np.asarray(outfits)
+        scores = np.zeros(len(outfits))
+        for n in range(cfg.NumCate):
+            scores += self._unary[n][outfits[:, n]]
+        for m in range(cfg.NumCate):
+            for n in range(m + 1, cfg.NumCate):
+                scores += self.pair_weight * np.einsum(
+                    'ij,ij->i', self.item_embs[m][outfits[:, m]],
+                    self.item_embs[n][outfits[:, n]])
+        return scores
+
+
+class _TopK(object):
+    """ The k best (score, outfit) seen so far
+    """
+    def __init__(self, k):
+        self.k = k
+        self.scores = np.zeros(0)
+        self.outfits = np.zeros((0, cfg.NumCate), dtype=np.int64)
+
+    @property
+    def threshold(self):
+        if len(self.scores) < self.k:
+            return -np.inf
+        return self.scores.min()
+
+    def push(self, scores, outfits):
+        scores = np.concatenate((self.scores, scores))
+        outfits = np.vstack((self.outfits, outfits))
+        if len(scores) > self.k:
+            idx = np.argpartition(-scores, self.k - 1)[:self.k]
+            scores, outfits = scores[idx], outfits[idx]
+        self.scores, self.outfits = scores, outfits
+
+    def result(self):
+        order = np.lexsort(self.outfits.T[::-1].tolist() + [-self.scores])
+        return self.outfits[order], self.scores[order]
+
+
+def _row_max(scorer, m, n, bias, batch_size):
+    """ max_j (bias[j] + pair_mn[i, j]) for each item i of m-th category
+    """
+    res = np.empty(scorer.num_items[m])
+    for start in range(0, scorer.num_items[m], batch_size):
+        rows = np.arange(start, min(start + batch_size, len(res)))
+        res[rows] = (scorer.pair(m, n, rows) + bias).max(axis=1)
+    return res
+
+
+class _PairRows(object):
+    """ Rows of pair(m, n) + bias computed on demand and kept for reuse,
+        if all rows fit in max_cells values, otherwise computed each time.
+        The kept rows are float64, so they take at most 8 * max_cells
+        bytes, 32MB for the default max_cells of topk_outfits().
+    """
+    def __init__(self, scorer, m, n, bias, max_cells):
+        self.scorer = scorer
+        self.m, self.n = m, n
+        self.bias = bias
+        self.num_computed = 0
+        shape = (scorer.num_items[m], scorer.num_items[n])
+        self.cache = None
+        if shape[0] * shape[1] <= max_cells:
+            self.cache = np.empty(shape)
+            self.computed = np.zeros(shape[0], dtype=bool)
+
+    def get(self, rows):
+        rows = np.asarray(rows)
+        if self.cache is None:
+            self.num_computed += len(rows)
+            return self.scorer.pair(self.m, self.n, rows) + self.bias
+        missing = rows[~self.computed[rows]]
+        if len(missing):
+            self.cache[missing] = self.scorer.pair(
+                self.m, self.n, missing) + self.bias
+            self.computed[missing] = True
+            self.num_computed += len(missing)
+        return self.cache[rows]
+
+
+def topk_outfits(scorer, k=10, batch_size=256, tol=1e-9, stats=None,
+                 max_cells=1 << 22):
+    """ Exact top-k outfits by branch and bound.
+        Tops are visited in the order of an upper bound of their best
+        outfit, and the search stops once the bound falls below the k-th
+        best score. For each top, bottoms are pruned by an upper bound of
+        (top, bottom, any shoe), and the left ones are scored with all
+        shoes at once. Bottom-shoe scores do not depend on the top, so
+        each row of them is computed once and reused by all tops.
+        Parameters
+        ----------
+        scorer: OutfitScorer
+        k: number of outfits
+        batch_size: number of rows scored at once
+        tol: slack for rounding errors of the bounds
+        stats: dict to save the number of 'tops' visited, 'outfits'
+               scored and bottom-shoe 'pair_rows' computed, if given
+        max_cells: bottom-shoe scores are kept for reuse if there are at
+                   most max_cells of them (8 bytes each, 32MB by default),
+                   and computed for each top otherwise
+        Return
+        ------
+        outfits: array of shape (k, NumCate), best first
+        scores: array of shape (k, )
+    """
+    top, bot, sho = 0, 1, 2
+    unary = [scorer.unary(n) for n in range(cfg.NumCate)]
+    k = min(k, int(np.prod(scorer.num_items)))
+    # best shoe for each bottom, and the largest top-shoe term of each top
+    best_sho = _row_max(scorer, bot, sho, unary[sho], batch_size)
+    max_top_sho = _row_max(scorer, top, sho, 0., batch_size)
+    # upper bound of the outfits of each top
+    bot_bias = unary[bot] + best_sho
+    top_bound = unary[top] + max_top_sho + _row_max(
+        scorer, top, bot, bot_bias, batch_size)
+    result = _TopK(k)
+    pair_bs = _PairRows(scorer, bot, sho, unary[sho], max_cells)
+    num_scored = 0
+    visited = 0
+    for t in np.argsort(-top_bound, kind='mergesort'):
+        if top_bound[t] + tol < result.threshold:
+            break
+        visited += 1
+        pair_tb = scorer.pair(top, bot, [t])[0]
+        pair_ts = scorer.pair(top, sho, [t])[0]
+        base = unary[top][t] + unary[bot] + pair_tb
+        bound = base + best_sho + max_top_sho[t]
+        bots = np.flatnonzero(bound + tol >= result.threshold)
+        bots = bots[np.argsort(-bound[bots], kind='mergesort')]
+        for start in range(0, len(bots), batch_size):
+            rows = bots[start:start + batch_size]
+            rows = rows[bound[rows] + tol >= result.threshold]
+            if len(rows) == 0:
+                break
+            scores = (base[rows, None] + pair_bs.get(rows) +
+                      pair_ts[None, :])
+            num_scored += scores.size
+            if scores.size > k:
+                flat = np.argpartition(-scores.ravel(), k - 1)[:k]
+            else:
+                flat = np.arange(scores.size)
+            b, s = np.unravel_index(flat, scores.shape)
+            outfits = np.c_[np.repeat(t, len(flat)), rows[b], s]
+            result.push(scores[b, s], outfits)
+    if stats is not None:
+        stats['tops'] = visited
+        stats['outfits'] = num_scored
+        stats['pair_rows'] = pair_bs.num_computed
+    return result.result()
+
+
+def brute_force_topk(scorer, k=10):
+    """ Top-k outfits by scoring all of them, see topk_outfits()
+    """
+    top, bot, sho = 0, 1, 2
+    unary = [scorer.unary(n) for n in range(cfg.NumCate)]
+    k = min(k, int(np.prod(scorer.num_items)))
+    pair_bs = unary[bot][:, None] + scorer.pair(bot, sho) + unary[sho]
+    result = _TopK(k)
+    for t in range(scorer.num_items[top]):
+        pair_tb = scorer.pair(top, bot, [t])[0]
+        pair_ts = scorer.pair(top, sho, [t])[0]
+        scores = unary[top][t] + pair_tb[:, None] + pair_bs + pair_ts
+        if scores.size > k:
+            flat = np.argpartition(-scores.ravel(), k - 1)[:k]
+        else:
+            flat = np.arange(scores.size)
+        b, s = np.unravel_index(flat, scores.shape)
+        result.push(scores[b, s], np.c_[np.repeat(t, len(flat)), b, s])
+    return result.result()
@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import numpy as np
+from . import config as cfg
+from .check_utils import check_dir, image_file_name
+
+# categories and names of synthetic items for each class
+_categories = [['Tops', 'Clothing'], ['Skirts', 'Clothing'], ['Shoes']]
+_names = [['tank', 'blouse', 'tee', 'jacket'], ['skirt', 'jeans', 'shorts'],
+          ['sandals', 'boots', 'pumps']]
+
+
+def _write_image(path, random, size, real_images):
+    """ Write an image and return its md5 checksum
+    """
+    if real_images:
+        # smooth random images, so near duplicates can be made
+        from PIL import Image
+        pixels = random.randint(0, 256, (4, 4, 3)).astype(np.uint8)
+        image = Image.fromarray(pixels).resize((64, 64), Image.BILINEAR)
+        image.save(path, 'JPEG')
+    else:
+        with open(path, 'wb') as f:
+            f.write(random.bytes(size))
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def make_raw(raw_dir, num_users=100, sets_per_user=60, skew=1.,
+             overlap=0.1, items_per_set=2., failed=0.02, duplicate=0.02,
+             image_size=2048, real_images=False, seed=0):
+    """ Make synthetic raw data in the layout of the Polyvore crawl.
+        raw_dir
+          |- items/{user}_items.jsonl
+          |- sets/{user}_sets.jsonl
+          |- images/{user}/items/full/*.jpg
+          |- images/{user}/sets/full/*.jpg
+        Parameters
+        ----------
+        raw_dir: where to write the raw data
+        num_users: number of users
+        sets_per_user: average number of sets of each user
+        skew: the number of sets of the r-th user is proportional to
+              r ** -skew, 0 for the same number of sets for all users
+        overlap: probability that an item in a set belongs to another user
+        items_per_set: average number of times each item is used in sets of
+                       its user, larger for more shared items
+        failed: fraction of items whose images failed to download
+        duplicate: fraction of items whose image is a copy of another one
+        image_size: size of each image in bytes, if not real_images
+        real_images: write small JPEG images (requires PIL) instead of
+                     random bytes
+        seed: seed for the generator
+        Return
+        ------
+        raw_dir
+    """
+    random = np.random.RandomState(seed)
+    raw_dir = os.path.abspath(raw_dir)
+    item_dir = os.path.join(raw_dir, 'items')
+    set_dir = os.path.join(raw_dir, 'sets')
+    check_dir(item_dir, action='mkdir')
+    check_dir(set_dir, action='mkdir')
+    users = ['user{:06d}'.format(u) for u in range(num_users)]
+    # number of sets for each user
+    weights = (np.arange(num_users) + 1.) ** -skew
+    num_sets = np.maximum(np.round(
+        weights / weights.mean() * sets_per_user), 1).astype(int)
+    # item urls of each user in each category
+    num_items = np.maximum(np.round(
+        num_sets / items_per_set), 1).astype(int)
+    item_urls = [[['/{}/item?id={}{}'.format(user, cfg.CateName[c], i)
+                   for i in range(num_items[u])]
+                  for c in range(cfg.NumCate)]
+                 for u, user in enumerate(users)]
+    # checksums of written images for duplicates
+    checksums = []
+    for u, user in enumerate(users):
+        image_dir = os.path.join(raw_dir, 'images', user, 'items', 'full')
+        check_dir(image_dir, action='mkdir')
+        with open(os.path.join(item_dir, user + '_items.jsonl'), 'w') as f:
+            for c in range(cfg.NumCate):
+                for url in item_urls[u][c]:
+                    item_url = cfg.BaseUrl + url
+                    image_url = item_url + '&image'
+                    name = image_file_name(image_url)
+                    images = []
+                    if random.rand() >= failed:
+                        path = os.path.join(image_dir, name)
+                        if checksums and random.rand() < duplicate:
+                            # copy the image of a previous item
+                            src = checksums[random.randint(len(checksums))]
+                            with open(src[0], 'rb') as src_file:
+                                data = src_file.read()
+                            with open(path, 'wb') as dst_file:
+                                dst_file.write(data)
+                            checksum = src[1]
+                        else:
+                            checksum = _write_image(
+                                path, random, image_size, real_images)
+                            checksums.append((path, checksum))
+                        images.append({'url': image_url,
+                                       'path': 'full/' + name,
+                                       'checksum': checksum})
+                    item = {
+                        'url': item_url,
+                        'isfashion': True,
+                        'images': images,
+                        'image_urls': [image_url],
+                        'categories': _categories[c],
+                        'name': 'Brand {} {}'.format(
+                            url.split('=')[-1],
+                            _names[c][random.randint(len(_names[c]))]),
+                        'price': '${}'.format(random.randint(5, 500)),
+                        'description': 'A synthetic item of {}'.format(user)}
+                    f.write(json.dumps(item) + '\n')
+    for u, user in enumerate(users):
+        image_dir = os.path.join(raw_dir, 'images', user, 'sets', 'full')
+        check_dir(image_dir, action='mkdir')
+        with open(os.path.join(set_dir, user + '_sets.jsonl'), 'w') as f:
+            for n in range(num_sets[u]):
+                set_url = '{}/{}/set?id={}'.format(cfg.BaseUrl, user, n)
+                urls = []
+                for c in range(cfg.NumCate):
+                    # mostly one item for each category, sometimes two tops
+                    size = 2 if c == 0 and random.rand() < 0.2 else 1
+                    for i in range(size):
+                        owner = u
+                        if num_users > 1 and random.rand() < overlap:
+                            owner = random.randint(num_users)
+                        idx = random.randint(num_items[owner])
+                        urls.append('.' + item_urls[owner][c][idx])
+                name = image_file_name(set_url)
+                _write_image(os.path.join(image_dir, name), random,
+                             image_size, real_images)
+                one_set = {'url': set_url,
+                           'item_urls': urls,
+                           'images': [{'url': set_url + '&image',
+                                       'path': 'full/' + name}]}
+                f.write(json.dumps(one_set) + '\n')
+    return raw_dir
@@ -0,0 +1,161 @@
+""" TF-IDF features of the name, description and categories of items.
+    Usage
+    -----
+    >> datafile = DataFile(tuple_dir, list_dir)
+    >> features, vocab = datafile.get_text_features(pkl_dir)
+    >> features[0] # csr_matrix, one row for each image in image_list[0]
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import multiprocessing
+from collections import Counter
+import numpy as np
+from . import config as cfg
+from .data_utils import count_matrix, image_list_sha1
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_word = re.compile(r"[a-z0-9]+(?:['&-][a-z0-9]+)*")
+# prefix of category tokens, so that categories and words are not mixed
+CatePrefix = 'cate:'
+
+
+def tokenize(item):
+    """ Tokens of one item
+        Parameters
+        ----------
+        item: (name, text, categories) of an item
+        Return
+        ------
+        tokens: lower case words of the name and text, and one token
+                CatePrefix + category for each category
+    """
+    name, text, categories = item
+    tokens = _word.findall(u'{} {}'.format(name, text).lower())
+    tokens += [CatePrefix + cate.lower() for cate in categories]
+    return tokens
+
+
+def config_vocab():
+    """ Tokens that are always in the vocabulary
+    """
+    return set(cfg.FashionWords) | set(
+        CatePrefix + cate.lower() for cate in cfg.FashonCategories)
+
+
+def _file_sha1(fn):
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def build_text_features(fashion_items, image_list, min_df=5,
+                        max_features=20000, num_workers=None):
+    """ TF-IDF features of items in image_list.
+        Parameters
+        ----------
+        fashion_items: pairs of {image name: item_info}, see load_pkl()
+        image_list: image names of each category, see DataFile.image_list
+        min_df: minimum number of items for a learned token
+        max_features: maximum number of learned tokens, the most frequent
+                      ones are kept
+        num_workers: number of processes to tokenize items
+        Return
+        ------
+        features: list of scipy.sparse.csr_matrix for each category, of
+                  shape (len(image_list[n]), len(vocab)), rows are l2
+                  normalized, rows of missing items are empty
+        vocab: sorted list of tokens
+    """
+    from scipy import sparse
+    names = [name for images in image_list for name in images]
+    items = []
+    for name in names:
+        info = fashion_items.get(name)
+        if info is None:
+            items.append((u'', u'', []))
+        else:
+            items.append((info['name'], info['text'], info['categories']))
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        docs = pool.map(tokenize, items, chunksize=1024)
+    finally:
+        pool.close()
+        pool.join()
+    # learned tokens by document frequency
+    doc_freq = Counter()
+    for tokens in docs:
+        doc_freq.update(set(tokens))
+    learned = sorted((token for token, df in doc_freq.items()
+                      if df >= min_df),
+                     key=lambda token: (-doc_freq[token], token))
+    vocab = sorted(config_vocab() | set(learned[:max_features]))
+    token_ids = dict((token, n) for n, token in enumerate(vocab))
+    rows, cols = [], []
+    for n, tokens in enumerate(docs):
+        ids = [token_ids[token] for token in tokens if token in token_ids]
+        rows.append(np.full(len(ids), n, dtype=np.int64))
+        cols.append(np.array(ids, dtype=np.int64))
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    tf = count_matrix(rows, cols, (len(docs), len(vocab)))
+    # smoothed idf as in scikit-learn
+    df = np.bincount(tf.indices, minlength=len(vocab))
+    idf = np.log((1. + len(docs)) / (1. + df)) + 1.
+    data = tf.data * idf[tf.indices]
+    row_ids = np.repeat(np.arange(len(docs)), np.diff(tf.indptr))
+    norms = np.sqrt(np.bincount(row_ids, data ** 2, minlength=len(docs)))
+    data /= norms[row_ids]
+    tfidf = sparse.csr_matrix((data, tf.indices, tf.indptr), shape=tf.shape)
+    offsets = np.cumsum([0] + [len(images) for images in image_list])
+    features = [tfidf[offsets[n]:offsets[n + 1]]
+                for n in range(len(image_list))]
+    return features, vocab
+
+
+def load_text_features(pkl_dir, image_list, cache_dir, min_df=5,
+                       max_features=20000, num_workers=None):
+    """ build_text_features() of fashion_items.pickle in pkl_dir, cached in
+        cache_dir. The cache is keyed by the sha1 of the pickle, the image
+        list, the vocabulary of config and the parameters. Only the latest
+        cache is kept, older text_features_*.npz files are removed when a
+        new one is written.
+    """
+    from scipy import sparse
+    items_pkl = os.path.join(pkl_dir, 'fashion_items.pickle')
+    key = hashlib.sha1(json.dumps({
+        'pickle': _file_sha1(items_pkl),
+        'image_list': image_list_sha1(image_list),
+        'vocab': sorted(config_vocab()),
+        'min_df': min_df, 'max_features': max_features},
+        sort_keys=True).encode('utf-8')).hexdigest()
+    fn = os.path.join(cache_dir, 'text_features_{}.npz'.format(key[:16]))
+    if os.path.isfile(fn):
+        with np.load(fn) as data:
+            vocab = data['vocab'].tolist()
+            features = [sparse.csr_matrix(
+                (data['data_{}'.format(n)], data['indices_{}'.format(n)],
+                 data['indptr_{}'.format(n)]),
+                shape=(len(image_list[n]), len(vocab)))
+                for n in range(len(image_list))]
+        return features, vocab
+    with open(items_pkl, 'rb') as f:
+        fashion_items = pickle.load(f)
+    features, vocab = build_text_features(
+        fashion_items, image_list, min_df, max_features, num_workers)
+    arrays = {'vocab': np.array(vocab)}
+    for n, matrix in enumerate(features):
+        arrays['data_{}'.format(n)] = matrix.data
+        arrays['indices_{}'.format(n)] = matrix.indices
+        arrays['indptr_{}'.format(n)] = matrix.indptr
+    for old_fn in glob.glob(os.path.join(cache_dir, 'text_features_*.npz')):
+        os.remove(old_fn)
+    np.savez(fn, **arrays)
+    return features, vocab